@@ -1,30 +1,740 @@
 import os
-import subprocess
 import uuid
 import json
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import http.client
+import socket
+import queue
+import shutil
+import zipfile
+from urllib.parse import urlsplit
 import threading
 import time
 import streamlit as st
+from routing import RoutingClient
+from cluster import load_cluster_config
+from result_cache import ResultCache, content_hash, cache_key
+from jobs import JobQueue
+from preprocess import prepare_images, preprocess_params
 
 # ---- Configuration ----
-# Define the target VM IP address for processing.
-VM1_IP = "192.168.56.101"  # Set to your active VM's IP
-VM2_IP = "192.168.56.103"
-# For now, support only the sketch endpoint.
+# VMs and Cloud Run URLs come from cluster.json (see cluster.py).
+CLUSTER = load_cluster_config()
+# Mapping from VM name to its IP address.
+VM_IPS = {vm["name"]: vm["ip"] for vm in CLUSTER["vms"]}
+# Endpoint path for each operation.
 ENDPOINTS = {
     "sketch": "/sketch",
     "bg_remove": "/remove_bg",
     "caption": "/caption"
 }
+# Every service also accepts many images at once on this endpoint.
+BATCH_ENDPOINT = "/batch"
+# Images routed to the same target are sent together, at most this many per request.
+BATCH_SIZE = 8
+# Port each operation's Flask service listens on inside the VMs.
+VM_PORTS = CLUSTER["service_ports"]
+# Cloud Run base URLs used when the load balancer picks "GCP".
+GCP_URLS = CLUSTER["gcp_urls"]
 
 # Folders to store the temporarily saved input images and processed outputs.
 INPUT_FOLDER = "uploaded"
 PROCESSED_FOLDER = "processed"
+# Downscaled, re-encoded copies of the inputs that are uploaded instead (see preprocess.py),
+# kept until their task has been dispatched.
+PREPARED_FOLDER = "prepared"
+# Set to False to send the original uploads unchanged.
+PREPROCESS_UPLOADS = True
+# Images whose target failed are sent to another target at most this many times.
+MAX_FAILOVERS = 2
+# HTTP statuses that mean the target failed rather than the image being rejected.
+TARGET_ERROR_STATUSES = (429, 500, 502, 503, 504)
+# Seconds between two log lines with the result cache and job queue counters, printed
+# when they changed (0 turns them off).
+STATS_LOG_INTERVAL = 60
 
 # Create folders if they do not exist.
 os.makedirs(INPUT_FOLDER, exist_ok=True)
 os.makedirs(PROCESSED_FOLDER, exist_ok=True)
+os.makedirs(PREPARED_FOLDER, exist_ok=True)
+
+# Size of the chunks used when streaming uploads and responses.
+CHUNK_SIZE = 64 * 1024
+
+
+def target_url(operation, choice_value, batch=False):
+    """
+    Returns the full URL of the service for the given operation on the chosen target,
+    or of its multi-image endpoint if batch is True.
+    Anything that is not a configured VM name is sent to the GCP (Cloud Run) endpoint.
+    """
+    endpoint = BATCH_ENDPOINT if batch else ENDPOINTS[operation]
+    if choice_value in VM_IPS:
+        return f"http://{VM_IPS[choice_value]}:{VM_PORTS[operation]}{endpoint}"
+    return f"{GCP_URLS[operation]}{endpoint}"
+
+
+class DispatchResult:
+    """
+    Outcome of a single dispatched request.
+
+    Attributes:
+        url (str): The URL the image was posted to.
+        status (int): HTTP status code returned by the service.
+        elapsed (float): Wall-clock seconds from sending the first byte to reading the last one.
+        bytes_sent (int): Size of the multipart request body.
+        bytes_received (int): Size of the response body.
+        output_path (str or None): Where the response body was written, if a path was given.
+        body (bytes or None): The response body, if no output path was given.
+        content_type (str or None): Content-Type header of the response.
+    """
+
+    def __init__(self, url, status, elapsed, bytes_sent, bytes_received, output_path=None, body=None,
+                 content_type=None):
+        self.url = url
+        self.status = status
+        self.elapsed = elapsed
+        self.bytes_sent = bytes_sent
+        self.bytes_received = bytes_received
+        self.output_path = output_path
+        self.body = body
+        self.content_type = content_type
+
+    def __repr__(self):
+        return (f"DispatchResult(url={self.url!r}, status={self.status}, "
+                f"elapsed={self.elapsed:.3f}s, sent={self.bytes_sent}, received={self.bytes_received})")
+
+
+class DispatchClient:
+    """
+    Shared in-process HTTP client used to post images to the VMs and Cloud Run.
+
+    Keeps a pool of keep-alive connections for every target (scheme, host, port), so
+    consecutive images sent to the same VM or Cloud Run service reuse one TCP/TLS
+    connection instead of forking a new curl process each time. Uploads are streamed
+    from disk as multipart/form-data and responses can be streamed straight to a file.
+    """
+
+    def __init__(self, pool_size=16, timeout=120):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self._pools = {}
+        self._pools_lock = threading.Lock()
+
+    def _pool(self, key):
+        with self._pools_lock:
+            pool = self._pools.get(key)
+            if pool is None:
+                pool = queue.LifoQueue(maxsize=self.pool_size)
+                self._pools[key] = pool
+            return pool
+
+    def _acquire(self, key):
+        """
+        Returns (connection, reused) for the target, reusing an idle connection when possible.
+        """
+        try:
+            return self._pool(key).get_nowait(), True
+        except queue.Empty:
+            scheme, host, port = key
+            if scheme == "https":
+                conn = http.client.HTTPSConnection(host, port, timeout=self.timeout)
+            else:
+                conn = http.client.HTTPConnection(host, port, timeout=self.timeout)
+            conn.connect()
+            # The multipart body is sent in several writes; don't let Nagle delay the last one.
+            conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            return conn, False
+
+    def _release(self, key, conn):
+        try:
+            self._pool(key).put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def close(self):
+        """
+        Closes every idle pooled connection.
+        """
+        with self._pools_lock:
+            pools = list(self._pools.values())
+            self._pools.clear()
+        for pool in pools:
+            while True:
+                try:
+                    pool.get_nowait().close()
+                except queue.Empty:
+                    break
+
+    def post_image(self, url, input_path, output_path=None, field="image"):
+        """
+        Posts an image file to the given URL as multipart/form-data.
+
+        Parameters:
+            url (str): Full URL of the service endpoint.
+            input_path (str): Path of the image to upload.
+            output_path (str, optional): If given, the response body is streamed into this file.
+            field (str): Name of the multipart form field, "image" for all our services.
+
+        Returns:
+            DispatchResult: Status, timing and the response (as a file or as bytes).
+        """
+        return self.post_files(url, [(field, input_path)], output_path)
+
+    def post_files(self, url, files, output_path=None):
+        """
+        Posts several files in one multipart/form-data request, streaming each from disk.
+
+        Parameters:
+            url (str): Full URL of the service endpoint.
+            files (list): (field name, file path) pairs, sent in order.
+            output_path (str, optional): If given, the response body is streamed into this file.
+
+        Returns:
+            DispatchResult: Status, timing and the response (as a file or as bytes).
+        """
+        parts = urlsplit(url)
+        scheme = parts.scheme or "http"
+        port = parts.port or (443 if scheme == "https" else 80)
+        key = (scheme, parts.hostname, port)
+        path = parts.path or "/"
+        if parts.query:
+            path = f"{path}?{parts.query}"
+
+        boundary = uuid.uuid4().hex
+        # Each part is (header bytes, file path); the body is streamed from these.
+        body_parts = []
+        content_length = 0
+        for index, (field, input_path) in enumerate(files):
+            filename = os.path.basename(input_path)
+            # Every part after the first starts with the CRLF that ends the previous one.
+            separator = "" if index == 0 else "\r\n"
+            head = (
+                f"{separator}--{boundary}\r\n"
+                f'Content-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+                f"Content-Type: application/octet-stream\r\n\r\n"
+            ).encode()
+            body_parts.append((head, input_path))
+            content_length += len(head) + os.path.getsize(input_path)
+        tail = f"\r\n--{boundary}--\r\n".encode()
+        content_length += len(tail)
+
+        # A pooled connection may have been closed by the server while idle; in that
+        # case retry once on a fresh connection.
+        for attempt in range(2):
+            conn, reused = self._acquire(key)
+            start = time.perf_counter()
+            try:
+                conn.putrequest("POST", path)
+                conn.putheader("Content-Type", f"multipart/form-data; boundary={boundary}")
+                conn.putheader("Content-Length", str(content_length))
+                conn.putheader("Connection", "keep-alive")
+                conn.endheaders()
+                for head, input_path in body_parts:
+                    conn.send(head)
+                    with open(input_path, "rb") as f:
+                        while True:
+                            chunk = f.read(CHUNK_SIZE)
+                            if not chunk:
+                                break
+                            conn.send(chunk)
+                conn.send(tail)
+                response = conn.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                conn.close()
+                if reused and attempt == 0:
+                    continue
+                raise
+            except Exception:
+                conn.close()
+                raise
+            break
+
+        try:
+            received = 0
+            body = None
+            if output_path is not None:
+                with open(output_path, "wb") as out:
+                    while True:
+                        chunk = response.read(CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        out.write(chunk)
+                        received += len(chunk)
+            else:
+                body = response.read()
+                received = len(body)
+        except Exception:
+            conn.close()
+            raise
+        elapsed = time.perf_counter() - start
+
+        if response.will_close:
+            conn.close()
+        else:
+            self._release(key, conn)
+
+        return DispatchResult(url, response.status, elapsed, content_length, received,
+                              output_path=output_path, body=body,
+                              content_type=response.getheader("Content-Type"))
+
+
+class TargetError(RuntimeError):
+    """
+    Raised when a target failed a request itself (unreachable, timed out, overloaded,
+    or answered with a server error or an unexpected kind of response), as opposed
+    to rejecting one image. Images that fail this way are sent to another target.
+    """
+
+
+# One client shared by every Streamlit session, so connection pools are reused across uploads.
+dispatch_client = DispatchClient()
+
+
+# Client for the load balancer's routing decision API (falls back to choice.txt).
+routing_client = RoutingClient()
+
+# Results of earlier jobs, keyed by image content, operation and parameters.
+result_cache = ResultCache()
+
+
+def cache_stats():
+    """
+    Returns the result cache's hit/miss/eviction counters and size.
+    """
+    return result_cache.stats()
+
+
+def _acquire_target(operation, exclude=None):
+    """
+    Asks the load balancer where to send one request of the operation, avoiding the
+    targets in exclude if it can. The target is picked at submit time and counted as
+    in flight until the request is reported finished. Defaults to GCP if the balancer
+    cannot be reached.
+    Returns (target, trial): trial tells whether the request is the trial of the
+    target's half-open circuit breaker, and is passed back to _release.
+    """
+    return routing_client.acquire(operation, exclude)
+
+
+def _new_counts():
+    """
+    Returns a fresh per-target counter: one entry per configured VM, GCP, and the
+    result cache.
+    """
+    counts = {name: 0 for name in VM_IPS}
+    counts["GCP"] = 0
+    counts["Cache"] = 0
+    return counts
+
+
+def _save_upload(file):
+    """
+    Saves an uploaded file into INPUT_FOLDER under a unique name.
+    Returns (unique filename, SHA-256 of the content).
+    """
+    # Generate a unique filename using the original file extension.
+    ext = os.path.splitext(file.name)[1]  # includes the dot
+    unique_filename = f"{uuid.uuid4()}{ext}"
+    input_path = os.path.join(INPUT_FOLDER, unique_filename)
+    data = file.read()
+    with open(input_path, "wb") as f:
+        f.write(data)
+    return unique_filename, content_hash(data)
+
+
+def _from_cache(operation, key, unique_filename):
+    """
+    Returns the cached result of a job (output path or caption), or None on a miss.
+    """
+    if operation == "caption":
+        return result_cache.get_text(key)
+    output_path = os.path.join(PROCESSED_FOLDER, unique_filename)
+    if result_cache.get_file(key, output_path):
+        return output_path
+    return None
+
+
+def _to_cache(operation, key, result):
+    try:
+        if operation == "caption":
+            result_cache.put_text(key, result)
+        else:
+            result_cache.put_file(key, result)
+    except OSError as e:
+        print(f"Unable to cache result: {e}")
+
+
+def _release(operation, target, latency, ok=None, trial=False):
+    """
+    Releases an in-flight slot taken by _acquire_target and feeds the latency estimate,
+    and the target's circuit breaker if ok (whether the target served the request)
+    is given.
+    """
+    routing_client.report("finish", target, operation, latency, ok, trial)
+
+
+def _upload_path(unique_filename):
+    """
+    Returns the file to upload for a saved image: its prepared copy if there is one.
+    """
+    prepared_path = os.path.join(PREPARED_FOLDER, unique_filename)
+    if os.path.exists(prepared_path):
+        return prepared_path
+    return os.path.join(INPUT_FOLDER, unique_filename)
+
+
+def _prepare_uploads(operation, unique_filenames):
+    """
+    Writes downscaled, re-encoded copies of the saved images to PREPARED_FOLDER (in the
+    preprocessing process pool). Images that fail, or that would not get smaller, are
+    sent as they are.
+    """
+    pairs = [(os.path.join(INPUT_FOLDER, name), os.path.join(PREPARED_FOLDER, name))
+             for name in unique_filenames]
+    original_total = prepared_total = 0
+    for name, outcome in zip(unique_filenames, prepare_images(operation, pairs)):
+        if isinstance(outcome, Exception):
+            print(f"Unable to preprocess {name}, sending the original: {outcome}")
+            continue
+        original_size, prepared_size, _ = outcome
+        original_total += original_size
+        prepared_total += prepared_size
+    print(f"Preprocessed {len(unique_filenames)} images for {operation}: "
+          f"{original_total} B -> {prepared_total} B")
+
+
+def _discard_prepared(unique_filenames):
+    """
+    Deletes the prepared copies of the saved images, once no attempt will upload them.
+    """
+    for name in unique_filenames:
+        try:
+            os.remove(os.path.join(PREPARED_FOLDER, name))
+        except FileNotFoundError:
+            pass
+
+
+def _check_response(operation, target, result, batch):
+    """
+    Raises TargetError if the response shows that the target itself failed: a server
+    error or overload status, or a 200 whose content is not what the service returns.
+    """
+    if result.status in TARGET_ERROR_STATUSES:
+        raise TargetError(f"{target} returned HTTP {result.status}")
+    if result.status != 200:
+        return
+    if operation == "caption":
+        expected = "application/json"
+    else:
+        expected = "application/zip" if batch else "image/"
+    if not (result.content_type or "").startswith(expected):
+        raise TargetError(f"{target} returned {result.content_type!r} instead of {expected}")
+
+
+def _send_single(operation, target, unique_filename):
+    """
+    Sends one saved image to its target's per-image endpoint.
+    Returns ({unique_filename: result}, elapsed seconds); the result is an output
+    path, or a caption.
+    """
+    input_path = _upload_path(unique_filename)
+    url = target_url(operation, target)
+    print(f'Using {target} at {url} for the image {input_path}')
+    if operation == "caption":
+        output_path = None
+    else:
+        # The response is streamed straight into PROCESSED_FOLDER.
+        output_path = os.path.join(PROCESSED_FOLDER, unique_filename)
+    result = dispatch_client.post_image(url, input_path, output_path)
+    print(f"[{target}] {operation} {input_path}: HTTP {result.status} in {result.elapsed:.3f}s "
+          f"({result.bytes_sent} B up, {result.bytes_received} B down)")
+    try:
+        _check_response(operation, target, result, batch=False)
+        if result.status != 200:
+            raise RuntimeError(f"{target} returned HTTP {result.status} for {unique_filename}")
+    except RuntimeError:
+        # Don't leave an error page where an image is expected (or cache it).
+        if output_path is not None:
+            os.remove(output_path)
+        raise
+    if operation == "caption":
+        # Parse the JSON response to extract the caption.
+        return {unique_filename: json.loads(result.body)["caption"]}, result.elapsed
+    return {unique_filename: output_path}, result.elapsed
+
+
+def _send_batch(operation, target, unique_filenames):
+    """
+    Sends several saved images to their target's /batch endpoint in one request.
+    Returns ({unique_filename: result or Exception}, elapsed seconds).
+    """
+    url = target_url(operation, target, batch=True)
+    files = [("images", _upload_path(name)) for name in unique_filenames]
+    print(f'Using {target} at {url} for {len(files)} images')
+    if operation == "caption":
+        result = dispatch_client.post_files(url, files)
+    else:
+        # The ZIP archive is streamed to disk and unpacked into PROCESSED_FOLDER.
+        archive_path = os.path.join(PROCESSED_FOLDER, f"{uuid.uuid4()}.zip")
+        result = dispatch_client.post_files(url, files, archive_path)
+    print(f"[{target}] {operation} batch of {len(files)}: HTTP {result.status} in {result.elapsed:.3f}s "
+          f"({result.bytes_sent} B up, {result.bytes_received} B down)")
+
+    outcomes = {name: RuntimeError(f"No result for {name} in batch response") for name in unique_filenames}
+    try:
+        _check_response(operation, target, result, batch=True)
+        if result.status != 200:
+            raise RuntimeError(f"Batch request failed with HTTP {result.status}")
+    except RuntimeError as error:
+        if operation != "caption":
+            os.remove(archive_path)
+        return {name: error for name in unique_filenames}, result.elapsed
+
+    if operation == "caption":
+        for item in json.loads(result.body)["results"]:
+            if item["name"] in outcomes:
+                outcomes[item["name"]] = item["caption"] if "caption" in item else RuntimeError(item["error"])
+        return outcomes, result.elapsed
+
+    try:
+        with zipfile.ZipFile(archive_path) as archive:
+            for entry in archive.namelist():
+                if entry.endswith(".error.txt") and entry[:-len(".error.txt")] in outcomes:
+                    outcomes[entry[:-len(".error.txt")]] = RuntimeError(archive.read(entry).decode())
+                elif entry in outcomes:
+                    output_path = os.path.join(PROCESSED_FOLDER, entry)
+                    with archive.open(entry) as src, open(output_path, "wb") as dst:
+                        shutil.copyfileobj(src, dst, CHUNK_SIZE)
+                    outcomes[entry] = output_path
+    finally:
+        os.remove(archive_path)
+    return outcomes, result.elapsed
+
+
+def _run_task(operation, task):
+    """
+    Job queue runner: routes each image of a task individually, and sends the images
+    that landed on the same target together. task is a list of (unique_filename,
+    cache key) with at most BATCH_SIZE entries.
+
+    Images whose target failed (TargetError) are routed again, away from the targets
+    that already failed them, up to MAX_FAILOVERS times; so one bad VM only delays
+    its share of a batch instead of failing it.
+
+    The prepared copies of the images are deleted once the task is done.
+
+    Yields (unique_filename, result or Exception, target, latency); images sent in one
+    batch share its latency.
+    """
+    keys = dict(task)
+    if PREPROCESS_UPLOADS:
+        _prepare_uploads(operation, list(keys))
+    tried = {name: [] for name in keys}
+    errors = {}
+    pending = list(keys)
+    try:
+        for attempt in range(MAX_FAILOVERS + 1):
+            # Each image takes its own in-flight slot, so the task fans out across targets.
+            groups = {}
+            trials = set()
+            for name in pending:
+                acquired, trial = _acquire_target(operation, tried[name])
+                choice_value = acquired if acquired in VM_IPS else "GCP"
+                if choice_value in tried[name]:
+                    # Nowhere else to go: give the slot back and report the last failure.
+                    _release(operation, acquired, None, trial=trial)
+                    yield name, errors[name], choice_value, None
+                    continue
+                groups.setdefault((acquired, choice_value), []).append(name)
+                if trial:
+                    trials.add(name)
+
+            pending = []
+            for (acquired, choice_value), names in groups.items():
+                outcomes, latency = _send_group(operation, acquired, choice_value, names, trials)
+                for name, result in outcomes.items():
+                    if isinstance(result, TargetError) and attempt < MAX_FAILOVERS:
+                        print(f"{choice_value} failed {name}, failing over: {result}")
+                        tried[name].append(choice_value)
+                        errors[name] = result
+                        pending.append(name)
+                        continue
+                    if not isinstance(result, Exception):
+                        _to_cache(operation, keys[name], result)
+                    yield name, result, choice_value, latency
+            if not pending:
+                break
+    finally:
+        if PREPROCESS_UPLOADS:
+            _discard_prepared(list(keys))
+
+
+# Shared by every Streamlit session of this process. Tasks are lists of
+# (unique_filename, cache key).
+job_queue = JobQueue(_run_task, task_items=lambda task: [name for name, _ in task])
+
+
+def submit_job(owner, operation, uploaded_files):
+    """
+    Saves the uploads, answers repeat images from the result cache, and queues the rest
+    on the shared job queue in tasks of at most BATCH_SIZE images.
+
+    Parameters:
+        owner (str): ID of the submitting user; the queue is fair between owners.
+        operation (str): "sketch", "bg_remove" or "caption".
+        uploaded_files (list): A list of file-like objects (from st.file_uploader).
+
+    Returns:
+        str: The job ID, to be passed to get_job().
+    """
+    cached = []
+    misses = []
+    for file in uploaded_files:
+        name, digest = _save_upload(file)
+        # Preprocessing changes the input the service sees, so it is part of the key.
+        key = cache_key(digest, operation, preprocess_params(operation) if PREPROCESS_UPLOADS else None)
+        result = _from_cache(operation, key, name)
+        if result is not None:
+            cached.append((name, result, "Cache", 0.0))
+        else:
+            misses.append((name, key))
+    tasks = [misses[i:i + BATCH_SIZE] for i in range(0, len(misses), BATCH_SIZE)]
+    return job_queue.submit(owner, operation, tasks, len(uploaded_files), cached)
+
+
+def _with_input_paths(job):
+    if job is not None:
+        for entry in job["results"]:
+            entry["input"] = os.path.join(INPUT_FOLDER, entry["name"])
+    return job
+
+
+def get_job(job_id):
+    """
+    Returns the status of a job as a dict, or None if the ID is unknown.
+
+    The dict has "status" ("queued", "running", "done" or "interrupted"), "total",
+    "completed", per-target "counts", and "results": one entry per finished image
+    with "input" (input image path), "target", "latency", and either "result" (output
+    path or caption) or "error".
+    """
+    return _with_input_paths(job_queue.get(job_id))
+
+
+def wait_job(job_id, seen=0, timeout=None):
+    """
+    Like get_job(), but first waits (up to timeout seconds) until the job has more
+    than `seen` results or has finished.
+    """
+    return _with_input_paths(job_queue.wait(job_id, seen, timeout))
+
+
+def job_queue_stats():
+    """
+    Returns the shared pool's worker count and the tasks and owners waiting for it.
+    """
+    return job_queue.stats()
+
+
+def _log_stats(interval):
+    """
+    Prints the result cache and job queue counters every interval seconds, whenever
+    they changed since the last line.
+    """
+    last = None
+    while True:
+        time.sleep(interval)
+        cache, queue_stats = cache_stats(), job_queue_stats()
+        line = (f"Result cache: {cache['hits']} hits, {cache['misses']} misses, "
+                f"{cache['evictions']} evictions, {cache['entries']} entries ({cache['bytes']} B) | "
+                f"Job queue: {queue_stats['workers']} workers, {queue_stats['queued_tasks']} queued tasks "
+                f"from {queue_stats['waiting_owners']} owners")
+        if line != last:
+            print(line)
+            last = line
+
+
+if STATS_LOG_INTERVAL > 0:
+    threading.Thread(target=_log_stats, args=(STATS_LOG_INTERVAL,), daemon=True).start()
+
+
+def _process_uploads(operation, uploaded_files, counts, owner):
+    """
+    Runs the uploads as one job on the shared job queue and follows it.
+
+    Yields (unique_filename, result or Exception, target, latency) as soon as each
+    result is available: cache hits first (target "Cache", latency 0.0), then the
+    rest in completion order.
+    """
+    job_id = submit_job(owner, operation, uploaded_files)
+    seen = 0
+    while True:
+        job = job_queue.wait(job_id, seen)
+        for entry in job["results"][seen:]:
+            result = entry["result"] if "result" in entry else RuntimeError(entry["error"])
+            counts[entry["target"]] = counts.get(entry["target"], 0) + 1
+            yield entry["name"], result, entry["target"], entry["latency"]
+        seen = len(job["results"])
+        if job["status"] != "running" and job["status"] != "queued":
+            return
+
+
+def _send_group(operation, acquired, target, unique_filenames, trials=()):
+    """
+    Sends a group of images that were all routed to the same target, then releases
+    their in-flight slots (under the name they were acquired as) and reports whether
+    the target served them; trials holds the images that were acquired as a circuit
+    breaker's trial request. Connection errors and timeouts become TargetError.
+    Returns ({unique_filename: result or Exception}, elapsed seconds or None).
+    """
+    latency = None
+    outcomes = {}
+    try:
+        if len(unique_filenames) == 1:
+            outcomes, latency = _send_single(operation, target, unique_filenames[0])
+        else:
+            outcomes, latency = _send_batch(operation, target, unique_filenames)
+    except (OSError, http.client.HTTPException) as e:
+        error = TargetError(f"{target} failed: {e}")
+        outcomes = {name: error for name in unique_filenames}
+    except Exception as e:
+        outcomes = {name: e for name in unique_filenames}
+    finally:
+        # One round trip served every image of the group: each image is reported with
+        # its share of it, so the (operation, target) latency EWMA is per image and
+        # targets that receive bigger batches do not look slower.
+        per_image = None if latency is None else latency / len(unique_filenames)
+        for name in unique_filenames:
+            _release(operation, acquired, per_image, not isinstance(outcomes.get(name), TargetError),
+                     name in trials)
+    return outcomes, latency
+
+
+def process_uploaded_images_stream(operation, uploaded_files, counts=None, owner=None):
+    """
+    Processes uploaded images with the given operation and yields each result as soon
+    as it completes, so callers can show results progressively.
+
+    Parameters:
+        operation (str): "sketch", "bg_remove" or "caption".
+        uploaded_files (list): A list of file-like objects (from st.file_uploader).
+        counts (dict): Optional per-target counter to update (targets missing from it
+            are added).
+        owner (str): Optional user ID for fair scheduling on the shared job queue;
+            each call counts as a separate user by default.
+
+    Yields:
+        tuple: (input_image_path, result, target, latency), where result is the output
+        file path (or the caption), or the Exception that made the image fail; target
+        is the VM name, "GCP" or "Cache"; latency is the request time in seconds.
+    """
+    if counts is None:
+        counts = _new_counts()
+    if owner is None:
+        owner = uuid.uuid4().hex
+    for name, result, target, latency in _process_uploads(operation, uploaded_files, counts, owner):
+        yield os.path.join(INPUT_FOLDER, name), result, target, latency
+
 
 def process_uploaded_images_sketch(operation, uploaded_files):
     """
@@ -40,165 +750,43 @@ def process_uploaded_images_sketch(operation, uploaded_files):
         List[str]: A list of file paths for the processed (sketched) images.
     """
     processed_paths = []
-    dict={
-        "VM1":0,
-        "VM2":0,
-        "GCP":0
-    }
-
-    def process_file(file):
-        # Generate a unique filename using the original file extension.
-        ext = os.path.splitext(file.name)[1]  # includes the dot
-        unique_filename = f"{uuid.uuid4()}{ext}"
-
-        # Save the uploaded file into INPUT_FOLDER.
-        input_path = os.path.join(INPUT_FOLDER, unique_filename)
-        with open(input_path, "wb") as f:
-            f.write(file.read())
-
-        # Define the output path.
-        output_path = os.path.join(PROCESSED_FOLDER, unique_filename)
+    dict=_new_counts()
 
-        # Read the choice from choice.txt (defaulting to GCP if any error occurs).
-        choice_value = "GCP"
-        try:
-            with open("choice.txt", "r") as f:
-                choice_value = f.read().strip()
-        except Exception as e:
-            print(f"Unable to read choice.txt: {e}")
-            choice_value = "GCP"
-
-        # Determine the target URL based on the choice.
-        if choice_value == "VM1":
-            url = f"http://{VM1_IP}:8080/sketch"
-        elif choice_value == "VM2":
-            url = f"http://{VM2_IP}:8080/sketch"
+    for _, result, _, _ in process_uploaded_images_stream("sketch", uploaded_files, dict):
+        if isinstance(result, Exception):
+            print(f"Error processing file: {result}")
         else:
-            # When choice_value is "GCP" (or anything else), use the GCP endpoint.
-            url = "https://sketch-app-706743001441.asia-south1.run.app/sketch"
-        print(f'Using {choice_value} at {url} for the image {input_path}')
-        dict[choice_value]+=1
-        # Build the curl command.
-        command = [
-            "curl", "-s", "-X", "POST",
-            url,
-            "-F", f"image=@{input_path}",
-            "--output", output_path
-        ]
-
-        # Execute the curl command.
-        subprocess.run(command)
-        return output_path
-
-    # Create a ThreadPoolExecutor to process files concurrently.
-    with ThreadPoolExecutor(max_workers=len(uploaded_files)) as executor:
-        future_to_file = {}
-        # Submit each task with a 0.25-second delay between submissions.
-        for file in uploaded_files:
-            future = executor.submit(process_file, file)
-            future_to_file[future] = file
-            time.sleep(0.8)  # Delay between task submissions
-
-        # Collect results as they complete.
-        for future in as_completed(future_to_file):
-            try:
-                path = future.result()
-                processed_paths.append(path)
-            except Exception as e:
-                print(f"Error processing file: {e}")
+            processed_paths.append(result)
     for key, value in dict.items():
         st.write(f"{key}: {value}")
     return processed_paths
 
 def process_uploaded_images_bg_remove(operation, uploaded_files):
     """
-    Processes a list of uploaded image files using the specified operation.
-    
-    For now, only the "sketch" operation is supported.
-    
+    Processes a list of uploaded image files using the "bg_remove" operation.
+
     Parameters:
-        operation (str): Should be "sketch".
+        operation (str): Should be "bg_remove".
         uploaded_files (list): A list of file-like objects (from st.file_uploader).
-    
+
     Returns:
-        List[str]: A list of file paths for the processed (sketched) images.
-    
+        List[str]: A list of file paths for the processed images.
+
     The function:
       - Saves each uploaded image to disk with a unique name in INPUT_FOLDER.
-      - Constructs the target URL based on the value in "choice.txt".
-      - Executes a curl command (via subprocess.run) to perform image processing.
+      - Asks the load balancer for a target for each image at submit time.
+      - Posts the images through the shared dispatch client, using the /batch
+        endpoint when several images go to the same target.
       - Writes the processed output to PROCESSED_FOLDER with the same unique filename.
     """
-    import os
-    import uuid
-    import subprocess
-    import time
-    from concurrent.futures import ThreadPoolExecutor, as_completed
-    dict={
-        "VM1":0,
-        "VM2":0,
-        "GCP":0
-    }
+    dict=_new_counts()
     processed_paths = []
 
-    def process_file(file):
-        # Generate a unique filename using the original file extension.
-        ext = os.path.splitext(file.name)[1]  # includes the dot
-        unique_filename = f"{uuid.uuid4()}{ext}"
-
-        # Save the uploaded file into INPUT_FOLDER.
-        input_path = os.path.join(INPUT_FOLDER, unique_filename)
-        with open(input_path, "wb") as f:
-            f.write(file.read())
-
-        # Define the output path.
-        output_path = os.path.join(PROCESSED_FOLDER, unique_filename)
-
-        # Read the choice from "choice.txt" (defaulting to GCP on error).
-        choice_value = "GCP"
-        try:
-            with open("choice.txt", "r") as f:
-                choice_value = f.read().strip()
-        except Exception as e:
-            print(f"Unable to read choice.txt: {e}")
-            choice_value = "GCP"
-        dict[choice_value]+=1
-        # Build the target URL based on the choice.
-        if choice_value == "GCP":
-            url = "https://remove-bg-706743001441.asia-south1.run.app/remove_bg"
-        elif choice_value == "VM1":
-            target_ip = VM1_IP
-            url = f"http://{target_ip}:8082/remove_bg"
-        elif choice_value == "VM2":
-            target_ip = VM2_IP
-            url = f"http://{target_ip}:8082/remove_bg"
+    for _, result, _, _ in process_uploaded_images_stream("bg_remove", uploaded_files, dict):
+        if isinstance(result, Exception):
+            print(f"Error processing file: {result}")
         else:
-            url = "https://remove-bg-706743001441.asia-south1.run.app/remove_bg"
-        print(f'Using {choice_value} at {url} for the image {input_path}')
-        # Build and execute the curl command.
-        command = [
-            "curl", "-s", "-X", "POST",
-            url,
-            "-F", f"image=@{input_path}",
-            "--output", output_path
-        ]
-        subprocess.run(command)
-        return output_path
-
-    # Use ThreadPoolExecutor and delay task submissions by 0.4 seconds.
-    futures = []
-    with ThreadPoolExecutor(max_workers=len(uploaded_files)) as executor:
-        for file in uploaded_files:
-            futures.append(executor.submit(process_file, file))
-            time.sleep(0.8)  # Delay between task submissions
-
-        # Collect results as tasks complete.
-        for future in as_completed(futures):
-            try:
-                result = future.result()
-                processed_paths.append(result)
-            except Exception as e:
-                print(f"Error processing file: {e}")
+            processed_paths.append(result)
     for key, value in dict.items():
         st.write(f"{key}: {value}")
     return processed_paths
@@ -217,84 +805,20 @@ def process_uploaded_images_caption(operation, uploaded_files):
 
     The function:
       - Saves each uploaded image to disk with a unique name in INPUT_FOLDER.
-      - Determines the target endpoint based on the content of "choice.txt":
+      - Asks the load balancer for a target for each image at submit time:
             If "GCP": uses the GCP Flask API endpoint.
-            If "VM1"/"VM2": uses the corresponding virtual machine endpoint.
-      - Executes a curl command (via subprocess.run) to perform the image captioning.
+            If a VM name: uses the corresponding virtual machine endpoint.
+      - Posts the images through the shared dispatch client, using the /batch
+        endpoint when several images go to the same target.
       - Parses the JSON response and returns, for each image, its file path together with the generated caption.
     """
+    dict=_new_counts()
     processed_results = []
-    dict={
-        "VM1":0,
-        "VM2":0,
-        "GCP":0
-    }
-    def process_file(file):
-        # Generate a unique filename.
-        ext = os.path.splitext(file.name)[1]  # includes the dot
-        unique_filename = f"{uuid.uuid4()}{ext}"
-
-        # Save the uploaded file into INPUT_FOLDER.
-        input_path = os.path.join(INPUT_FOLDER, unique_filename)
-        with open(input_path, "wb") as f:
-            f.write(file.read())
-
-        # Determine the desired endpoint from choice.txt (default to "GCP").
-        choice_value = "GCP"
-        try:
-            with open("choice.txt", "r") as f:
-                choice_value = f.read().strip()
-        except Exception as e:
-            print(f"Unable to read choice.txt: {e}")
-            choice_value = "GCP"
-        dict[choice_value]+=1
-        # Select the target URL based on the choice.
-        if choice_value == "GCP":
-            url = "https://caption-service-706743001441.asia-south1.run.app/caption"
-        elif choice_value == "VM1":
-            target_ip = VM1_IP
-            url = f"http://{target_ip}:8081/caption"
-        elif choice_value == "VM2":
-            target_ip = VM2_IP
-            url = f"http://{target_ip}:8081/caption"
-        else:
-            # Fallback in case an unexpected choice value is found.
-            url = "https://caption-service-706743001441.asia-south1.run.app/caption"
-
-        # Build the curl command.
-        print(f'Using {choice_value} at {url} for the image {input_path}')
-        command = [
-            "curl.exe", "-s", "-X", "POST",
-            url,
-            "-F", f"image=@{input_path}"
-        ]
-
-        # Execute the curl command and capture the output.
-        output = subprocess.run(command, capture_output=True, text=True)
-        try:
-            # Parse the JSON response to extract the caption.
-            response = json.loads(output.stdout)["caption"]
-        except Exception as e:
-            response = f"Error generating caption: {e}"
-        return (input_path, response)
 
-    # Use ThreadPoolExecutor to process each file concurrently.
-    processed_results = []
-    futures = []
-
-    with ThreadPoolExecutor(max_workers=len(uploaded_files)) as executor:
-        # Submit each task with a delay between submissions.
-        for file in uploaded_files:
-            futures.append(executor.submit(process_file, file))
-            time.sleep(0.8)  # Delay between task submissions
-
-        # Optionally, process the futures as they complete.
-        for future in as_completed(futures):
-            try:
-                result = future.result()
-                processed_results.append(result)
-            except Exception as e:
-                print(f"Error processing file: {e}")
+    for input_path, result, _, _ in process_uploaded_images_stream("caption", uploaded_files, dict):
+        if isinstance(result, Exception):
+            result = f"Error generating caption: {result}"
+        processed_results.append((input_path, result))
     for key, value in dict.items():
         st.write(f"{key}: {value}")
     return processed_results
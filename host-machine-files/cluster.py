@@ -0,0 +1,60 @@
+import copy
+import json
+import os
+
+# Cluster description shared by the load balancer and the backend.
+CLUSTER_CONFIG = os.environ.get("CLUSTER_CONFIG", "cluster.json")
+
+# Used when the config file is missing or leaves a setting out.
+DEFAULT_CONFIG = {
+    "vms": [
+        {"name": "VM1", "ip": "192.168.56.101", "usage_dir": "./vm_usage/vm1", "monitor_port": 9876},
+        {"name": "VM2", "ip": "192.168.56.103", "usage_dir": "./vm_usage/vm2", "monitor_port": 9877}
+    ],
+    "gcp_urls": {
+        "sketch": "https://sketch-app-706743001441.asia-south1.run.app",
+        "bg_remove": "https://remove-bg-706743001441.asia-south1.run.app",
+        "caption": "https://caption-service-706743001441.asia-south1.run.app"
+    },
+    # Port of each service on the VMs.
+    "service_ports": {"sketch": 8080, "bg_remove": 8082, "caption": 8081},
+    "operations": {
+        "sketch": {"policy": "lowest_cpu", "spill_cpu": 40},
+        "bg_remove": {"policy": "lowest_cpu", "spill_cpu": 40},
+        "caption": {"policy": "lowest_cpu", "spill_cpu": 40}
+    },
+    # Number of recent CPU/RAM samples the policies look at.
+    "window": 5,
+    # Predictive CPU signal (see load_estimator.py), read from the metric store.
+    "metric_store": "./metrics",
+    "load_estimator": {"enabled": True, "half_life": 3.0, "trend_window": 20.0, "horizon": 5.0},
+    # Active /health probes and per-target circuit breakers (see health.py).
+    "health": {"enabled": True, "interval": 2.0, "gcp_interval": 30.0, "timeout": 1.0,
+               "unhealthy_after": 2,
+               "breaker": {"window": 20, "min_requests": 5, "error_rate": 0.5,
+                           "consecutive_failures": 3, "open_seconds": 10.0}}
+}
+
+
+def load_cluster_config(path=CLUSTER_CONFIG):
+    """
+    Reads the cluster config (VMs, Cloud Run URLs and per-operation policies).
+
+    Top-level keys missing from the file fall back to DEFAULT_CONFIG, and every
+    VM gets a usage_dir of ./vm_usage/<name in lower case> unless one is given.
+    A VM's metric_id (its id in the telemetry and the metric store) defaults to the
+    digits in its name, e.g. 1 for "VM1". Its monitor_port is where
+    parallel_monitor.py listens for its telemetry (MONITOR_PORT on the VM).
+    """
+    config = copy.deepcopy(DEFAULT_CONFIG)
+    if os.path.exists(path):
+        with open(path, "r") as f:
+            config.update(json.load(f))
+    else:
+        print(f"Cluster config {path} not found, using defaults.")
+    for vm in config["vms"]:
+        vm.setdefault("usage_dir", f"./vm_usage/{vm['name'].lower()}")
+        digits = "".join(c for c in vm["name"] if c.isdigit())
+        if digits:
+            vm.setdefault("metric_id", int(digits))
+    return config
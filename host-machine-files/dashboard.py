@@ -1,169 +1,152 @@
 import streamlit as st
-import matplotlib.pyplot as plt
-import numpy as np
+import pandas as pd
 import time
-import os
+from collections import deque
 from datetime import datetime
-from scipy.interpolate import make_interp_spline
+from cluster import load_cluster_config
+from metric_feed import MetricSubscriber
+from metric_store import MetricStore
 
 # Set Streamlit page configuration
-st.set_page_config(page_title="VM Load Monitor Dashboard", layout="centered")
+st.set_page_config(page_title="VM Load Monitor Dashboard", layout="wide")
 
 st.title("📊 Real-Time VM Load Monitor Dashboard")
 st.markdown("""
-This dashboard displays **live CPU and RAM usage** for two Virtual Machines (VMs).  
-Data is read from files:
-- **VM1 CPU:** `./vm_usage/vm1/cpu.txt`
-- **VM1 RAM:** `./vm_usage/vm1/ram.txt`
-- **VM2 CPU:** `./vm_usage/vm2/cpu.txt`
-- **VM2 RAM:** `./vm_usage/vm2/ram.txt`
-
-Each file contains comma-separated float values representing the latest usage readings.
+This dashboard displays **live CPU and RAM usage** for every Virtual Machine (VM) in `cluster.json`.
+The history comes from the metric store (`./metrics`); new samples are pushed by
+`parallel_monitor.py` over its local metric feed and appended to the charts as they arrive.
+Without the feed, the metric store is polled once a second instead.
 """)
 st.markdown("<hr style='margin-top: 1px; margin-bottom: 40px;'>", unsafe_allow_html=True)
 
-def read_values(file_path):
+# Seconds of history shown by default, and the most the slider allows.
+DEFAULT_HISTORY = 120
+MAX_HISTORY = 3600
+# Seconds between two reads of the metric store when the feed is not connected.
+POLL_INTERVAL = 1.0
+# Longest wait for a pushed sample before checking the feed connection again.
+FEED_TIMEOUT = 5.0
+COLUMNS = ["CPU (%)", "RAM (%)"]
+
+
+@st.cache_resource
+def metric_feed():
+    # One subscriber per Streamlit process, shared by every open dashboard.
+    return MetricSubscriber().start()
+
+
+@st.cache_resource
+def metric_store(root):
+    return MetricStore(root)
+
+
+def to_frame(samples):
     """
-    Reads comma-separated float values from a file and returns them as a list.
-    If the file does not exist or is empty, returns an empty list.
+    Turns (timestamp, cpu, ram) samples into a DataFrame indexed by local time.
     """
-    if not os.path.exists(file_path):
-        return []
-    try:
-        with open(file_path, "r") as f:
-            content = f.read().strip()
-            if not content:
-                return []
-            # Convert comma-separated values into a list of floats.
-            return [float(val.strip()) for val in content.split(",") if val.strip()]
-    except Exception as e:
-        st.error(f"Error reading {file_path}: {e}")
-        return []
-
-def smooth_line(x, y):
+    index = [datetime.fromtimestamp(timestamp) for timestamp, _, _ in samples]
+    return pd.DataFrame({"CPU (%)": [cpu for _, cpu, _ in samples],
+                         "RAM (%)": [ram for _, _, ram in samples]}, index=index, columns=COLUMNS)
+
+
+def service_summary(details):
     """
-    Returns a smoothed version of the line using spline interpolation.
-    If there are fewer than 4 points, no smoothing is applied.
+    Returns a one-line summary of the per-service counters of a VM, or "".
     """
-    if len(x) < 4:
-        return x, y
-    x_smooth = np.linspace(x.min(), x.max(), 300)
-    spline = make_interp_spline(x, y, k=3)
-    y_smooth = spline(x_smooth)
-    return x_smooth, y_smooth
-
-# Define file paths for each metric.
-vm_files = {
-    "VM1_CPU": "./vm_usage/vm1/cpu.txt",
-    "VM1_RAM": "./vm_usage/vm1/ram.txt",
-    "VM2_CPU": "./vm_usage/vm2/cpu.txt",
-    "VM2_RAM": "./vm_usage/vm2/ram.txt"
-}
-
-# Create column containers for layout: left for VM1, right for VM2.
-col_left, col_right = st.columns(2)
-
-# Create placeholders for each graph.
-ph_vm1_cpu = col_left.empty()   # Top left: VM1 CPU
-ph_vm1_ram = col_left.empty()   # Bottom left: VM1 RAM
-ph_vm2_cpu = col_right.empty()  # Top right: VM2 CPU
-ph_vm2_ram = col_right.empty()  # Bottom right: VM2 RAM
-
-# Main loop to update the dashboard continuously.
-while True:
-    # Read current values from each file.
-    vm1_cpu = read_values(vm_files["VM1_CPU"])
-    vm1_ram = read_values(vm_files["VM1_RAM"])
-    vm2_cpu = read_values(vm_files["VM2_CPU"])
-    vm2_ram = read_values(vm_files["VM2_RAM"])
-    
-    # Create indices for x-axis based on the length of each data series.
-    x_vm1_cpu = np.arange(len(vm1_cpu))
-    x_vm1_ram = np.arange(len(vm1_ram))
-    x_vm2_cpu = np.arange(len(vm2_cpu))
-    x_vm2_ram = np.arange(len(vm2_ram))
-    
-    # Apply smoothing if there are enough points (at least 4).
-    if len(vm1_cpu) >= 4:
-        x_vm1_cpu_s, y_vm1_cpu_s = smooth_line(x_vm1_cpu, np.array(vm1_cpu))
-    else:
-        x_vm1_cpu_s, y_vm1_cpu_s = x_vm1_cpu, vm1_cpu
+    if not details or not details.get("services"):
+        return ""
+    parts = []
+    for name, stats in details["services"].items():
+        p95 = f", p95 {stats['p95_ms']:.0f} ms" if stats.get("p95_ms") is not None else ""
+        parts.append(f"{name}: {stats.get('active', 0)} active, {stats.get('queued', 0)} queued{p95}")
+    return " · ".join(parts)
 
-    if len(vm1_ram) >= 4:
-        x_vm1_ram_s, y_vm1_ram_s = smooth_line(x_vm1_ram, np.array(vm1_ram))
-    else:
-        x_vm1_ram_s, y_vm1_ram_s = x_vm1_ram, vm1_ram
 
-    if len(vm2_cpu) >= 4:
-        x_vm2_cpu_s, y_vm2_cpu_s = smooth_line(x_vm2_cpu, np.array(vm2_cpu))
-    else:
-        x_vm2_cpu_s, y_vm2_cpu_s = x_vm2_cpu, vm2_cpu
+class VmPanel:
+    """
+    The metrics and chart of one VM. New samples are appended to the chart with
+    add_rows(); the chart is only rebuilt when it holds twice the history window,
+    to drop the samples that have scrolled out.
+    """
 
-    if len(vm2_ram) >= 4:
-        x_vm2_ram_s, y_vm2_ram_s = smooth_line(x_vm2_ram, np.array(vm2_ram))
-    else:
-        x_vm2_ram_s, y_vm2_ram_s = x_vm2_ram, vm2_ram
-
-    # Update VM1 CPU graph and latest value.
-    with ph_vm1_cpu.container():
-        fig1, ax1 = plt.subplots(figsize=(5, 3))
-        if len(x_vm1_cpu_s) > 0:
-            ax1.plot(x_vm1_cpu_s, y_vm1_cpu_s, label="VM1 CPU", color='royalblue')
-        ax1.set_title("VM1 CPU Usage")
-        ax1.set_ylabel("CPU (%)")
-        ax1.set_ylim(0, 100)
-        ax1.grid(True)
-        st.pyplot(fig1)
-        if vm1_cpu:
-            st.markdown(f"<p style='text-align: center; font-size: 16px;'><strong>Latest: {vm1_cpu[-1]:.2f}%</strong></p>", unsafe_allow_html=True)
-        else:
-            st.markdown("<p style='text-align: center; font-size: 16px;'><strong>Latest: No data</strong></p>", unsafe_allow_html=True)
-
-    # Update VM1 RAM graph and latest value.
-    with ph_vm1_ram.container():
-        fig2, ax2 = plt.subplots(figsize=(5, 3))
-        if len(x_vm1_ram_s) > 0:
-            ax2.plot(x_vm1_ram_s, y_vm1_ram_s, label="VM1 RAM", color='tomato')
-        ax2.set_title("VM1 RAM Usage")
-        ax2.set_ylabel("RAM (%)")
-        ax2.set_ylim(0, 100)
-        ax2.grid(True)
-        st.pyplot(fig2)
-        if vm1_ram:
-            st.markdown(f"<p style='text-align: center; font-size: 16px;'><strong>Latest: {vm1_ram[-1]:.2f}%</strong></p>", unsafe_allow_html=True)
+    def __init__(self, vm, history, samples):
+        self.name = vm["name"]
+        self.metric_id = vm["metric_id"]
+        self.history = history
+        self.samples = deque(samples)
+        self.rows = len(samples)
+        st.subheader(self.name)
+        col_cpu, col_ram, col_services = st.columns([1, 1, 3])
+        self.cpu = col_cpu.empty()
+        self.ram = col_ram.empty()
+        self.services = col_services.empty()
+        self.slot = st.empty()
+        self.chart = self.slot.line_chart(to_frame(samples), height=220)
+        self.show_latest(None)
+
+    @property
+    def last_timestamp(self):
+        return self.samples[-1][0] if self.samples else 0.0
+
+    def append(self, samples, details):
+        self.samples.extend(samples)
+        cutoff = samples[-1][0] - self.history
+        while self.samples[0][0] < cutoff:
+            self.samples.popleft()
+        if self.rows + len(samples) > 2 * max(len(self.samples), 1):
+            self.chart = self.slot.line_chart(to_frame(self.samples), height=220)
+            self.rows = len(self.samples)
         else:
-            st.markdown("<p style='text-align: center; font-size: 16px;'><strong>Latest: No data</strong></p>", unsafe_allow_html=True)
-
-    # Update VM2 CPU graph and latest value.
-    with ph_vm2_cpu.container():
-        fig3, ax3 = plt.subplots(figsize=(5, 3))
-        if len(x_vm2_cpu_s) > 0:
-            ax3.plot(x_vm2_cpu_s, y_vm2_cpu_s, label="VM2 CPU", color='seagreen')
-        ax3.set_title("VM2 CPU Usage")
-        ax3.set_ylabel("CPU (%)")
-        ax3.set_ylim(0, 100)
-        ax3.grid(True)
-        st.pyplot(fig3)
-        if vm2_cpu:
-            st.markdown(f"<p style='text-align: center; font-size: 16px;'><strong>Latest: {vm2_cpu[-1]:.2f}%</strong></p>", unsafe_allow_html=True)
-        else:
-            st.markdown("<p style='text-align: center; font-size: 16px;'><strong>Latest: No data</strong></p>", unsafe_allow_html=True)
-
-    # Update VM2 RAM graph and latest value.
-    with ph_vm2_ram.container():
-        fig4, ax4 = plt.subplots(figsize=(5, 3))
-        if len(x_vm2_ram_s) > 0:
-            ax4.plot(x_vm2_ram_s, y_vm2_ram_s, label="VM2 RAM", color='mediumvioletred')
-        ax4.set_title("VM2 RAM Usage")
-        ax4.set_ylabel("RAM (%)")
-        ax4.set_xlabel("Data Points")
-        ax4.set_ylim(0, 100)
-        ax4.grid(True)
-        st.pyplot(fig4)
-        if vm2_ram:
-            st.markdown(f"<p style='text-align: center; font-size: 16px;'><strong>Latest: {vm2_ram[-1]:.2f}%</strong></p>", unsafe_allow_html=True)
-        else:
-            st.markdown("<p style='text-align: center; font-size: 16px;'><strong>Latest: No data</strong></p>", unsafe_allow_html=True)
+            self.chart.add_rows(to_frame(samples))
+            self.rows += len(samples)
+        self.show_latest(details)
+
+    def show_latest(self, details):
+        if not self.samples:
+            self.cpu.metric("CPU", "No data")
+            self.ram.metric("RAM", "No data")
+            return
+        _, cpu, ram = self.samples[-1]
+        _, prev_cpu, prev_ram = self.samples[-2] if len(self.samples) > 1 else self.samples[-1]
+        self.cpu.metric("CPU", f"{cpu:.1f}%", f"{cpu - prev_cpu:+.1f}", delta_color="inverse")
+        self.ram.metric("RAM", f"{ram:.1f}%", f"{ram - prev_ram:+.1f}", delta_color="inverse")
+        self.services.caption(service_summary(details))
+
+
+config = load_cluster_config()
+history = st.sidebar.slider("History (seconds)", 30, MAX_HISTORY, DEFAULT_HISTORY, step=30)
+store = metric_store(config.get("metric_store", "./metrics"))
+feed = metric_feed()
+
+panels = []
+for vm in config["vms"]:
+    if "metric_id" not in vm:
+        st.warning(f"{vm['name']} has no metric_id in cluster.json")
+        continue
+    samples = [(timestamp, cpu, ram) for timestamp, _, cpu, ram in store.last(vm["metric_id"], history)]
+    panels.append(VmPanel(vm, history, samples))
+
+seen = None
+
+# Main loop: append new samples as they arrive.
+while True:
+    if feed.connected:
+        # Sleep until parallel_monitor.py pushes a new sample, not on a timer.
+        version = feed.wait(seen, timeout=FEED_TIMEOUT)
+        if version == seen:
+            continue
+        seen = version
+    else:
+        time.sleep(POLL_INTERVAL)
 
-    # Pause briefly before the next update.
-    time.sleep(0.2)
+    for panel in panels:
+        if feed.connected:
+            new = [s for s in zip(*feed.window(panel.metric_id)) if s[0] > panel.last_timestamp]
+            details = feed.details(panel.metric_id)
+        else:
+            start = max(panel.last_timestamp, time.time() - history)
+            new = [(timestamp, cpu, ram) for timestamp, _, cpu, ram in store.query(panel.metric_id, start)
+                   if timestamp > panel.last_timestamp]
+            details = None
+        if new:
+            panel.append(new, details)
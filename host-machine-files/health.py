@@ -0,0 +1,215 @@
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+# Defaults for the "health" section of cluster.json.
+# Seconds between two probes of a VM service, and of a Cloud Run service (probing
+# Cloud Run often would keep instances alive and cost money).
+PROBE_INTERVAL = 2.0
+GCP_PROBE_INTERVAL = 30.0
+# Seconds a probe may take before it counts as failed.
+PROBE_TIMEOUT = 1.0
+# Consecutive failed probes before a target is marked down.
+UNHEALTHY_AFTER = 2
+# Circuit breaker: the last BREAKER_WINDOW outcomes are kept; the breaker opens when
+# BREAKER_CONSECUTIVE_FAILURES requests in a row fail, or when at least
+# BREAKER_MIN_REQUESTS outcomes are known and BREAKER_ERROR_RATE of them failed.
+BREAKER_WINDOW = 20
+BREAKER_MIN_REQUESTS = 5
+BREAKER_ERROR_RATE = 0.5
+BREAKER_CONSECUTIVE_FAILURES = 3
+# Seconds an open breaker stays open before letting trial requests through.
+BREAKER_OPEN_SECONDS = 10.0
+
+HEALTH_ENDPOINT = "/health"
+# Services that only report ready after warming up are probed on their readiness
+# endpoint instead, so no traffic is routed to a cold instance.
+READY_ENDPOINTS = {"caption": "/ready"}
+
+
+class CircuitBreaker:
+    """
+    Per-target circuit breaker driven by request outcomes (errors and timeouts).
+
+    closed: requests flow and outcomes are counted.
+    open: the target is skipped for BREAKER_OPEN_SECONDS.
+    half_open: one trial request is let through (see admit()) and the others are
+        refused until its outcome closes the breaker (success) or opens it for
+        another period (failure). Outcomes of other requests, e.g. slow ones sent
+        before the breaker opened, are ignored meanwhile.
+    """
+
+    def __init__(self, window=BREAKER_WINDOW, min_requests=BREAKER_MIN_REQUESTS,
+                 error_rate=BREAKER_ERROR_RATE, consecutive_failures=BREAKER_CONSECUTIVE_FAILURES,
+                 open_seconds=BREAKER_OPEN_SECONDS):
+        self.window = window
+        self.min_requests = min_requests
+        self.error_rate = error_rate
+        self.consecutive_failures = consecutive_failures
+        self.open_seconds = open_seconds
+        self.state = "closed"
+        self._outcomes = []
+        self._failures_in_a_row = 0
+        self._opened_at = None
+        self._trial_started = None
+
+    def allow(self, now=None):
+        """
+        Returns True if requests may be sent to the target. While half open, that is
+        only until the trial request has been admitted; a trial whose outcome is still
+        unknown after open_seconds no longer blocks the next one.
+        """
+        now = time.monotonic() if now is None else now
+        if self.state == "open":
+            if now - self._opened_at < self.open_seconds:
+                return False
+            self.state = "half_open"
+            self._trial_started = None
+        if self.state == "half_open" and self._trial_started is not None:
+            return now - self._trial_started >= self.open_seconds
+        return True
+
+    def admit(self, now=None):
+        """
+        Records that a request is being sent to the target. Returns True if it is the
+        trial request (the breaker is half open); its outcome must then be recorded
+        with trial=True.
+        """
+        if self.state != "half_open":
+            return False
+        self._trial_started = time.monotonic() if now is None else now
+        return True
+
+    def record(self, ok, now=None, trial=False):
+        """
+        Records the outcome of one request; trial tells whether admit() made it the
+        trial request.
+        """
+        now = time.monotonic() if now is None else now
+        if self.state == "half_open":
+            if not trial:
+                return
+            if ok:
+                self._reset()
+            else:
+                self._open(now)
+            return
+        self._outcomes.append(ok)
+        del self._outcomes[:-self.window]
+        self._failures_in_a_row = 0 if ok else self._failures_in_a_row + 1
+        failures = self._outcomes.count(False)
+        if (self._failures_in_a_row >= self.consecutive_failures
+                or (len(self._outcomes) >= self.min_requests
+                    and failures >= self.error_rate * len(self._outcomes))):
+            self._open(now)
+
+    def _open(self, now):
+        self.state = "open"
+        self._opened_at = now
+        self._outcomes = []
+        self._failures_in_a_row = 0
+        self._trial_started = None
+
+    def _reset(self):
+        self.state = "closed"
+        self._outcomes = []
+        self._failures_in_a_row = 0
+        self._trial_started = None
+
+    def __repr__(self):
+        return f"CircuitBreaker(state={self.state!r})"
+
+
+def health_endpoints(config):
+    """
+    Returns {(operation, target): health URL} for every operation on every VM and on
+    Cloud Run, from the cluster config. The probed path of an operation can be set in
+    the "paths" of the config's "health" section (default READY_ENDPOINTS, else
+    HEALTH_ENDPOINT).
+    """
+    paths = dict(READY_ENDPOINTS, **config.get("health", {}).get("paths", {}))
+    endpoints = {}
+    for operation, port in config["service_ports"].items():
+        path = paths.get(operation, HEALTH_ENDPOINT)
+        for vm in config["vms"]:
+            endpoints[(operation, vm["name"])] = f"http://{vm['ip']}:{port}{path}"
+        if operation in config["gcp_urls"]:
+            endpoints[(operation, "GCP")] = f"{config['gcp_urls'][operation]}{path}"
+    return endpoints
+
+
+def probe(url, timeout=PROBE_TIMEOUT):
+    """
+    Returns True if GET url answers 200 within the timeout.
+    """
+    try:
+        with urllib.request.urlopen(url, timeout=timeout) as response:
+            return response.status == 200
+    except Exception:
+        return False
+
+
+class HealthChecker:
+    """
+    Probes the health endpoint of every (operation, target) in the background.
+
+    A target is considered down after UNHEALTHY_AFTER failed probes in a row, and up
+    again after one successful probe. Targets that have not been probed yet count
+    as healthy.
+    """
+
+    def __init__(self, endpoints, interval=PROBE_INTERVAL, gcp_interval=GCP_PROBE_INTERVAL,
+                 timeout=PROBE_TIMEOUT, unhealthy_after=UNHEALTHY_AFTER):
+        self.endpoints = endpoints
+        self.interval = interval
+        self.gcp_interval = gcp_interval
+        self.timeout = timeout
+        self.unhealthy_after = unhealthy_after
+        self._lock = threading.Lock()
+        self._failures = {key: 0 for key in endpoints}
+        self._next_probe = {key: 0.0 for key in endpoints}
+        self._pool = ThreadPoolExecutor(max_workers=max(1, min(8, len(endpoints))))
+
+    def start(self):
+        """
+        Starts probing in a daemon thread and returns self.
+        """
+        threading.Thread(target=self._run, daemon=True).start()
+        return self
+
+    def _run(self):
+        while True:
+            now = time.monotonic()
+            due = [key for key, when in self._next_probe.items() if when <= now]
+            for key in due:
+                interval = self.gcp_interval if key[1] == "GCP" else self.interval
+                self._next_probe[key] = now + interval
+            futures = {key: self._pool.submit(probe, self.endpoints[key], self.timeout) for key in due}
+            for key, future in futures.items():
+                self._record(key, future.result())
+            time.sleep(min(self.interval, self.gcp_interval) / 2)
+
+    def _record(self, key, ok):
+        with self._lock:
+            was_healthy = self._failures[key] < self.unhealthy_after
+            self._failures[key] = 0 if ok else self._failures[key] + 1
+            is_healthy = self._failures[key] < self.unhealthy_after
+        if was_healthy != is_healthy:
+            operation, target = key
+            print(f"{target} is {'up' if is_healthy else 'DOWN'} for {operation} ({self.endpoints[key]})")
+
+    def is_healthy(self, operation, target):
+        """
+        Returns False if the target's service for the operation failed its recent probes.
+        """
+        with self._lock:
+            return self._failures.get((operation, target), 0) < self.unhealthy_after
+
+    def snapshot(self):
+        """
+        Returns {"<operation>/<target>": healthy} for every probed endpoint.
+        """
+        with self._lock:
+            return {f"{op}/{target}": failures < self.unhealthy_after
+                    for (op, target), failures in self._failures.items()}
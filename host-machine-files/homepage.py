@@ -1,6 +1,7 @@
+import time
+import uuid
 import streamlit as st
-from backend import process_uploaded_images_sketch  # Ensure this import is correct
-from backend import process_uploaded_images_bg_remove, process_uploaded_images_caption
+from backend import submit_job, get_job
 # ---------- Page Config ----------
 st.set_page_config(page_title="Serverless Image Processing", layout="wide")
 
@@ -57,8 +58,18 @@ if "selected_operation" not in st.session_state:
     st.session_state.selected_operation = None
 if "uploaded_files" not in st.session_state:
     st.session_state.uploaded_files = []
-if "processed_files" not in st.session_state:
-    st.session_state.processed_files = []
+if "job_id" not in st.session_state:
+    st.session_state.job_id = None
+# The user and job IDs live in the URL too, so a page refresh finds the job again.
+if "user_id" not in st.session_state:
+    st.session_state.user_id = st.query_params.get("user") or uuid.uuid4().hex
+    st.query_params["user"] = st.session_state.user_id
+    if st.query_params.get("job"):
+        st.session_state.job_id = st.query_params["job"]
+        st.session_state.page = "result"
+
+# Seconds between two refreshes of the result page while a job is running.
+POLL_INTERVAL = 0.5
 
 # ---------- Navigation Functions ----------
 def go_to(operation=None):
@@ -139,36 +150,50 @@ elif st.session_state.page == "upload":
 # ---------- Page 4: Result ----------
 elif st.session_state.page == "result":
     st.markdown("<div class='custom-title'><h3>✅ Output</h3></div>", unsafe_allow_html=True)
-    
-    # Process images only if not already done
-    if st.session_state.selected_operation == "sketch" and st.session_state.uploaded_files and not st.session_state.processed_files:
-        processed_files = process_uploaded_images_sketch(st.session_state.selected_operation,
-                                                  st.session_state.uploaded_files)
-        st.session_state.processed_files = processed_files
-    
-    if st.session_state.selected_operation == "bg_remove" and st.session_state.uploaded_files and not st.session_state.processed_files:
-        processed_files = process_uploaded_images_bg_remove(st.session_state.selected_operation,
-                                                  st.session_state.uploaded_files)
-        st.session_state.processed_files = processed_files
-    
-    if st.session_state.selected_operation == "caption" and st.session_state.uploaded_files and not st.session_state.processed_files:
-        processed_files = process_uploaded_images_caption(st.session_state.selected_operation,
-                                                  st.session_state.uploaded_files)
-        st.session_state.processed_files = processed_files
 
-    if not st.session_state.uploaded_files:
+    # Submit once; the work runs on the host's shared job queue, not in this script.
+    if st.session_state.job_id is None and st.session_state.uploaded_files:
+        st.session_state.job_id = submit_job(st.session_state.user_id,
+                                             st.session_state.selected_operation,
+                                             st.session_state.uploaded_files)
+        st.query_params["job"] = st.session_state.job_id
+
+    job = get_job(st.session_state.job_id) if st.session_state.job_id else None
+    if job is None:
         st.warning("No images uploaded. Please go back and upload some.")
     else:
+        running = job["status"] in ("queued", "running")
+        if running:
+            st.progress(job["completed"] / max(job["total"], 1),
+                        text=f"Processed {job['completed']} of {job['total']} images")
+        elif job["status"] == "interrupted":
+            st.warning("Processing was interrupted; showing the images that finished.")
         # Removed the white banner: the <div class='result-box'> wrapper is no longer used.
-        if st.session_state.selected_operation == "caption":
-            # Here, processed_files is assumed to be a list of (image_path, caption) tuples.
-            for image_path, caption in st.session_state.processed_files:
-                st.image(image_path, width=300)
+        for entry in job["results"]:
+            if job["operation"] == "caption":
+                caption = entry.get("result", f"Error generating caption: {entry.get('error')}")
+                st.image(entry["input"], width=300)
                 st.markdown(f"**Caption:** {caption}")
-        else:
-            for file_path in st.session_state.processed_files:
-                st.image(file_path, width=300)
+            elif "error" in entry:
+                st.error(f"An image could not be processed: {entry['error']}")
+                continue
+            else:
+                st.image(entry["result"], width=300)
+            timing = f" in {entry['latency']:.2f}s" if entry["latency"] is not None else ""
+            st.caption(f"Served by {entry['target']}{timing}")
+        if not running:
+            for key, value in job["counts"].items():
+                st.write(f"{key}: {value}")
+
+    def start_over():
+        st.session_state.update({
+            "page": "home", "uploaded_files": [], "selected_operation": None, "job_id": None
+        })
+        st.query_params.pop("job", None)
+
     st.markdown("---")
-    st.button("🔁 Start Over", on_click=lambda: st.session_state.update({
-        "page": "home", "uploaded_files": [], "selected_operation": None, "processed_files": []
-    }))
+    st.button("🔁 Start Over", on_click=start_over)
+
+    if job is not None and running:
+        time.sleep(POLL_INTERVAL)
+        st.rerun()
@@ -0,0 +1,225 @@
+import json
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+
+# One pool of worker threads is shared by every user of this host.
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "16"))
+# Job records are written here, so a job can be looked up again after a page refresh.
+JOB_DIR = "jobs"
+# Finished jobs are dropped from memory (not from disk) after this many seconds.
+JOB_RETENTION = 3600
+# Target recorded for the items of a task whose runner raised before yielding them.
+FAILED_TARGET = "Error"
+
+
+class Job:
+    """
+    One submitted upload: its tasks run on the shared pool and append their results.
+    """
+
+    def __init__(self, job_id, owner, operation, total):
+        self.id = job_id
+        self.owner = owner
+        self.operation = operation
+        self.total = total
+        self.status = "queued"
+        self.results = []
+        self.counts = {}
+        self.created = time.time()
+        self.finished = None
+        self.pending_tasks = 0
+
+    def add_result(self, name, result, target, latency):
+        entry = {"name": name, "target": target, "latency": latency}
+        if isinstance(result, Exception):
+            entry["error"] = str(result)
+        else:
+            entry["result"] = result
+        self.results.append(entry)
+        self.counts[target] = self.counts.get(target, 0) + 1
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "owner": self.owner,
+            "operation": self.operation,
+            "status": self.status,
+            "total": self.total,
+            "completed": len(self.results),
+            "counts": dict(self.counts),
+            # Copies of the entries: callers may add fields (e.g. the input path) to
+            # them without the lock, while a worker serializes the job.
+            "results": [dict(entry) for entry in self.results],
+            "created": self.created,
+            "finished": self.finished,
+        }
+
+
+class JobQueue:
+    """
+    Host-side job queue with a bounded worker pool and per-user fairness.
+
+    A job is split into tasks (e.g. one batch of images each). Tasks wait in one queue
+    per owner, and idle workers take them from the owners in round-robin order, so a
+    200-image upload doesn't hold up a user who submitted 3 images afterwards.
+
+    runner(operation, task) does the work of one task and yields
+    (name, result or Exception, target, latency) for each of its items. If it raises
+    instead, every item of the task it has not yielded yet (task_items(task) returns
+    their names) is recorded with the exception, so the job still gets one result
+    per item.
+    """
+
+    def __init__(self, runner, max_workers=JOB_WORKERS, job_dir=JOB_DIR, retention=JOB_RETENTION,
+                 task_items=None):
+        self.runner = runner
+        self.task_items = task_items
+        self.max_workers = max_workers
+        self.job_dir = job_dir
+        self.retention = retention
+        self._cond = threading.Condition()
+        self._jobs = {}
+        # owner -> deque of (job, task); the first owner is served next.
+        self._pending = OrderedDict()
+        self._workers = []
+        os.makedirs(job_dir, exist_ok=True)
+
+    def submit(self, owner, operation, tasks, total, results=()):
+        """
+        Queues a job and returns its ID.
+
+        Parameters:
+            owner (str): Who submitted the job; tasks are interleaved across owners.
+            operation (str): Passed on to the runner.
+            tasks (list): Units of work for the runner.
+            total (int): Number of results the job will produce.
+            results (iterable): (name, result, target, latency) tuples that are
+                already known (e.g. cache hits).
+        """
+        job = Job(uuid.uuid4().hex, owner, operation, total)
+        for name, result, target, latency in results:
+            job.add_result(name, result, target, latency)
+        with self._cond:
+            self._jobs[job.id] = job
+            job.pending_tasks = len(tasks)
+            if tasks:
+                self._pending.setdefault(owner, deque()).extend((job, task) for task in tasks)
+                self._start_workers()
+                self._cond.notify(len(tasks))
+            else:
+                self._finish(job)
+            self._save(job)
+        return job.id
+
+    def _start_workers(self):
+        # Caller holds the lock. Workers are started lazily and live for the process.
+        while len(self._workers) < self.max_workers:
+            worker = threading.Thread(target=self._work, daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def _next_task(self):
+        # Caller holds the lock.
+        while not self._pending:
+            self._cond.wait()
+        owner, tasks = next(iter(self._pending.items()))
+        job, task = tasks.popleft()
+        if tasks:
+            self._pending.move_to_end(owner)
+        else:
+            del self._pending[owner]
+        return job, task
+
+    def _work(self):
+        while True:
+            with self._cond:
+                job, task = self._next_task()
+                if job.status == "queued":
+                    job.status = "running"
+                    self._save(job)
+            done = set()
+            try:
+                for name, result, target, latency in self.runner(job.operation, task):
+                    with self._cond:
+                        job.add_result(name, result, target, latency)
+                        done.add(name)
+                        self._cond.notify_all()
+            except Exception as e:
+                print(f"Job {job.id} task failed: {e}")
+                if self.task_items is not None:
+                    with self._cond:
+                        for name in self.task_items(task):
+                            if name not in done:
+                                job.add_result(name, e, FAILED_TARGET, None)
+            with self._cond:
+                job.pending_tasks -= 1
+                if job.pending_tasks == 0:
+                    self._finish(job)
+                self._save(job)
+                self._cond.notify_all()
+
+    def _finish(self, job):
+        # Caller holds the lock.
+        job.status = "done"
+        job.finished = time.time()
+        expired = [job_id for job_id, other in self._jobs.items()
+                   if other.finished is not None and job.finished - other.finished > self.retention]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+    def _path(self, job_id):
+        return os.path.join(self.job_dir, f"{job_id}.json")
+
+    def _save(self, job):
+        # Caller holds the lock. Written atomically so readers never see half a record.
+        path = self._path(job.id)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(job.to_dict(), f)
+        os.replace(tmp_path, path)
+
+    def get(self, job_id):
+        """
+        Returns the status and results of a job as a dict (see Job.to_dict), or None if
+        the ID is unknown. A job that was still running when this process stopped is
+        reported with status "interrupted".
+        """
+        with self._cond:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                return job.to_dict()
+        if not all(c in "0123456789abcdef" for c in job_id):
+            return None
+        try:
+            with open(self._path(job_id)) as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if record["status"] != "done":
+            record["status"] = "interrupted"
+        return record
+
+    def wait(self, job_id, seen=0, timeout=None):
+        """
+        Blocks until the job has more than `seen` results or is no longer running, or
+        until the timeout expires. Returns the same dict as get().
+        """
+        with self._cond:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                self._cond.wait_for(lambda: len(job.results) > seen or job.status == "done", timeout)
+        return self.get(job_id)
+
+    def stats(self):
+        """
+        Returns the number of workers, queued tasks and owners with queued tasks.
+        """
+        with self._cond:
+            return {
+                "workers": len(self._workers),
+                "queued_tasks": sum(len(tasks) for tasks in self._pending.values()),
+                "waiting_owners": len(self._pending),
+            }
@@ -1,16 +1,25 @@
+import os
 import time
+from routing import RoutingState, serve_routing_state, write_choice_file, ROUTING_HOST, ROUTING_PORT
+from cluster import load_cluster_config
+from policies import TargetStats, SpillGuard, make_policy, decide
+from metric_store import MetricStore
+from load_estimator import LoadEstimator
+from metric_feed import MetricSubscriber
+from health import CircuitBreaker, HealthChecker, health_endpoints
 
-# Mapping from VM ID to its IP address.
-vm_ips = {
-    "VM1": "192.168.56.101",
-    "VM2": "192.168.56.103"
-}
+# Also mirror a decision into choice.txt for readers that still use the file.
+WRITE_CHOICE_FILE = True
+# choice.txt and GET /choice without an operation return the decision of this operation.
+LEGACY_OPERATION = "sketch"
+
+# Seconds between two routing decisions when the metric feed is not connected
+# (the usage files are polled instead).
+TICK_INTERVAL = 0.15
+# With the feed connected, decisions are refreshed on every new sample, and at
+# least this often (in-flight counts and cooldowns change without new samples).
+FEED_TIMEOUT = 1.0
 
-# Mapping from VM ID to file path for CPU usage values.
-vm_cpu_files = {
-    "VM1": "./vm_usage/vm1/cpu.txt",
-    "VM2": "./vm_usage/vm2/cpu.txt"
-}
 
 def read_cpu_values(file_path):
     """
@@ -30,57 +39,176 @@ def read_cpu_values(file_path):
         print(f"Error reading {file_path}: {e}")
         return []
 
-def compute_average(values):
+
+def build_policies(config):
+    """
+    Returns {operation: (policy, spill_cpu, max_in_flight, guard)} from the "operations"
+    section of the config. guard is the SpillGuard that adds hysteresis ("spill_margin",
+    in CPU points) and a cooldown ("spill_cooldown", in seconds) to the spill decision.
+    """
+    policies = {}
+    for operation, settings in config["operations"].items():
+        policy = make_policy(settings.get("policy", "lowest_cpu"), **settings.get("params", {}))
+        spill_cpu = settings.get("spill_cpu", 40)
+        guard = SpillGuard(spill_cpu, settings.get("spill_margin", 5.0), settings.get("spill_cooldown", 10.0))
+        policies[operation] = (policy, spill_cpu, settings.get("max_in_flight"), guard)
+    return policies
+
+
+def build_estimator(config):
+    """
+    Returns the LoadEstimator described by the "load_estimator" section of the config,
+    or None if it is disabled.
+    """
+    settings = config.get("load_estimator", {})
+    if not settings.get("enabled", True):
+        return None
+    params = {key: settings[key] for key in ("half_life", "trend_window", "horizon") if key in settings}
+    return LoadEstimator(MetricStore(config.get("metric_store", "./metrics")), **params)
+
+
+def build_health(config):
+    """
+    Returns (health checker, circuit breaker factory) from the "health" section of the
+    config, or (None, None) if it is disabled. The checker is not started.
+    """
+    settings = config.get("health", {})
+    if not settings.get("enabled", True):
+        return None, None
+    params = {key: settings[key] for key in ("interval", "gcp_interval", "timeout", "unhealthy_after")
+              if key in settings}
+    checker = HealthChecker(health_endpoints(config), **params)
+    breaker = settings.get("breaker", {})
+    return checker, lambda: CircuitBreaker(**breaker)
+
+
+class Balancer:
     """
-    Computes the average of a list of numbers.
-    Returns 0 if the list is empty.
+    Turns the latest VM usage and the in-flight/latency accounting of a RoutingState
+    into routing decisions, using the configured policy of each operation.
+
+    choose() is installed as the state's chooser, so every request acquired through
+    the routing API is placed individually at submit time. Targets that fail their
+    health probes, or whose circuit breaker is open, are left out of the choice.
     """
-    if not values:
-        return 0.0
-    return sum(values) / len(values)
+
+    def __init__(self, config, state, estimator=None, feed=None, health=None):
+        self.vms = config["vms"]
+        self.window = config["window"]
+        self.policies = build_policies(config)
+        self.state = state
+        self.estimator = estimator
+        self.feed = feed
+        self.health = health
+        self.usage = {vm["name"]: ([], []) for vm in self.vms}
+        self.forecasts = {vm["name"]: None for vm in self.vms}
+
+    def refresh_usage(self):
+        """
+        Refreshes the recent CPU and RAM usage of every VM, and their forecasts. Uses
+        the samples pushed by the metric feed while it is connected, and falls back to
+        reading the usage files and the metric store otherwise.
+        """
+        usage = {}
+        forecasts = {}
+        use_feed = self.feed is not None and self.feed.connected
+        for vm in self.vms:
+            pushed = None
+            if use_feed and "metric_id" in vm:
+                timestamps, cpu, ram = self.feed.window(vm["metric_id"], max(self.window, 30))
+                pushed = list(zip(timestamps, cpu))
+                cpu, ram = cpu[-self.window:], ram[-self.window:]
+            else:
+                cpu = read_cpu_values(os.path.join(vm["usage_dir"], "cpu.txt"))[-self.window:]
+                ram = read_cpu_values(os.path.join(vm["usage_dir"], "ram.txt"))[-self.window:]
+            usage[vm["name"]] = (cpu, ram)
+            forecasts[vm["name"]] = None
+            if self.estimator is not None and "metric_id" in vm:
+                try:
+                    self.estimator.update(vm["name"], vm["metric_id"], samples=pushed)
+                except Exception as e:
+                    print(f"Error reading metrics of {vm['name']}: {e}")
+                estimate = self.estimator.estimate(vm["name"])
+                if estimate is not None:
+                    forecasts[vm["name"]] = estimate.forecast
+        self.usage = usage
+        self.forecasts = forecasts
+
+    def available(self, operation, target):
+        """
+        Returns False if the target is down for the operation (failed health probes or
+        open circuit breaker).
+        """
+        if self.health is not None and not self.health.is_healthy(operation, target):
+            return False
+        return self.state.target_available(operation, target)
+
+    def choose(self, operation, exclude=()):
+        """
+        Returns the target ("VM1", ... or "GCP") for one request of the operation,
+        avoiding targets in exclude and targets that are down.
+        """
+        if operation not in self.policies:
+            return "GCP"
+        policy, spill_cpu, max_in_flight, guard = self.policies[operation]
+        candidates = []
+        for name, (cpu, ram) in self.usage.items():
+            if name in exclude or not self.available(operation, name):
+                continue
+            in_flight, latency = self.state.target_stats(operation, name)
+            candidates.append(TargetStats(name, cpu, ram, in_flight, latency, self.forecasts.get(name)))
+        target = decide(policy, spill_cpu, candidates, max_in_flight, guard)
+        if target == "GCP" and candidates and ("GCP" in exclude or not self.available(operation, "GCP")):
+            # Cloud Run is down (or already failed this request): a busy VM beats an error.
+            target = policy.choose(candidates).name
+        return target
+
 
 def main():
     print("Load Balancer is running.")
-    
+
+    config = load_cluster_config()
+    # The decisions live in memory and are served to the backend over a local API.
+    health, breaker_factory = build_health(config)
+    state = RoutingState(breaker_factory=breaker_factory)
+    feed = MetricSubscriber().start() if config.get("metric_feed", True) else None
+    if health is not None:
+        health.start()
+    balancer = Balancer(config, state, build_estimator(config), feed, health)
+    state.chooser = balancer.choose
+    for operation, (policy, spill_cpu, max_in_flight, guard) in balancer.policies.items():
+        print(f"  {operation}: {policy!r}, spill to GCP above {spill_cpu}% CPU"
+              f" or {max_in_flight} requests in flight, {guard!r}")
+
+    serve_routing_state(state)
+    print(f"Routing decisions served on http://{ROUTING_HOST}:{ROUTING_PORT}/choice")
+    last_written = None
+    seen = 0
+
     while True:
-        
-        # Read CPU usage values from each VM's file.
-        vm1_values = read_cpu_values(vm_cpu_files["VM1"])
-        vm2_values = read_cpu_values(vm_cpu_files["VM2"])
-        
-        # Get the latest CPU usage value from each VM.
-        latest_vm1 = vm1_values[-1] if vm1_values else None
-        latest_vm2 = vm2_values[-1] if vm2_values else None
-        
-        # Compute the running average (of the last 5 values) for each VM.
-        avg_vm1 = compute_average(vm1_values)
-        avg_vm2 = compute_average(vm2_values)
-        
-        # print(f"Average CPU -> VM1: {avg_vm1:.2f}%, VM2: {avg_vm2:.2f}%")
-        
-        # Choose the VM with the lower average CPU usage.
-        if avg_vm1 < avg_vm2:
-            selected_vm = "VM1"
-            selected_avg = avg_vm1
-            choice_val=selected_vm
+        # React to samples as parallel_monitor.py pushes them; poll files without it.
+        if feed is not None and feed.connected:
+            seen = feed.wait(seen, FEED_TIMEOUT)
         else:
-            selected_vm = "VM2"
-            selected_avg = avg_vm2
-            choice_val=selected_vm
-            
-        if selected_avg > 40:
-            choice_val = "GCP"
-            
-        try:
-            with open("choice.txt", "w") as f:
-                f.write(choice_val)
-            # print(f"choice.txt updated with: {choice_val}")
-        except Exception as e:
-            time.sleep(0.15)
-            # print(f"Error writing to choice.txt: {e}")
-            
-        time.sleep(0.15)
-    
+            time.sleep(TICK_INTERVAL)
+        balancer.refresh_usage()
+
+        # Per-request placement happens in POST /acquire; the published decisions
+        # serve GET /choice and the choice.txt shim.
+        for operation in balancer.policies:
+            choice_val = state.choose(operation)
+            state.publish(choice_val, operation)
+            if operation == LEGACY_OPERATION:
+                state.publish(choice_val)
+
+            # Only touch the compatibility file when the decision actually changes.
+            if WRITE_CHOICE_FILE and operation == LEGACY_OPERATION and choice_val != last_written:
+                try:
+                    write_choice_file(choice_val)
+                    last_written = choice_val
+                except Exception as e:
+                    print(f"Error writing to choice.txt: {e}")
+
 
 if __name__ == "__main__":
     main()
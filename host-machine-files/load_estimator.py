@@ -0,0 +1,125 @@
+import time
+from collections import deque
+
+# Defaults for the "load_estimator" section of cluster.json.
+# Half-life (seconds) of the exponentially weighted moving average of CPU usage.
+EWMA_HALF_LIFE = 3.0
+# Seconds of recent samples the trend (least-squares slope) is fitted to.
+TREND_WINDOW = 20.0
+# How far ahead (seconds) the forecast looks; roughly the time a request takes.
+FORECAST_HORIZON = 5.0
+# Seconds of stored history replayed at startup, so estimates are warm right away.
+WARMUP_SECONDS = 120.0
+# An estimate whose newest sample is older than this is not used.
+STALE_AFTER = 5.0
+
+
+class LoadEstimate:
+    """
+    Smoothed CPU level, trend and short-horizon forecast of one VM.
+
+    Attributes:
+        ewma (float): Time-weighted moving average of CPU usage (%).
+        slope (float): Trend of CPU usage in % per second (0.0 with too few samples).
+        forecast (float): Expected CPU usage (%) FORECAST_HORIZON seconds from now,
+            clamped to 0-100.
+        timestamp (float): Time of the newest sample.
+    """
+
+    def __init__(self, ewma, slope, forecast, timestamp):
+        self.ewma = ewma
+        self.slope = slope
+        self.forecast = forecast
+        self.timestamp = timestamp
+
+    def __repr__(self):
+        return (f"LoadEstimate(ewma={self.ewma:.1f}, slope={self.slope:+.2f}/s, "
+                f"forecast={self.forecast:.1f})")
+
+
+class _Trend:
+    """
+    Incremental EWMA plus a sliding window for the slope, for one VM.
+    """
+
+    def __init__(self):
+        self.ewma = None
+        self.timestamp = None
+        self.window = deque()
+
+    def add(self, timestamp, cpu, half_life, trend_window):
+        if self.ewma is None:
+            self.ewma = cpu
+        else:
+            # Samples arrive roughly every second but not exactly; weight by elapsed time.
+            dt = max(timestamp - self.timestamp, 0.0)
+            self.ewma += (1.0 - 0.5 ** (dt / half_life)) * (cpu - self.ewma)
+        self.timestamp = timestamp
+        self.window.append((timestamp, cpu))
+        while self.window[0][0] < timestamp - trend_window:
+            self.window.popleft()
+
+    def slope(self):
+        # Ordinary least squares of CPU over time.
+        n = len(self.window)
+        if n < 3:
+            return 0.0
+        mean_t = sum(t for t, _ in self.window) / n
+        mean_c = sum(c for _, c in self.window) / n
+        var_t = sum((t - mean_t) ** 2 for t, _ in self.window)
+        if var_t == 0:
+            return 0.0
+        return sum((t - mean_t) * (c - mean_c) for t, c in self.window) / var_t
+
+
+class LoadEstimator:
+    """
+    Keeps an EWMA, a trend and a forecast of CPU usage per VM, fed incrementally on
+    every balancer tick: from the metric feed when it is connected, otherwise from
+    the metric store (see metric_store.py).
+
+    Each update only looks at the samples since the previous one, so the cost per
+    tick does not depend on the size of the history.
+    """
+
+    def __init__(self, store, half_life=EWMA_HALF_LIFE, trend_window=TREND_WINDOW,
+                 horizon=FORECAST_HORIZON, warmup=WARMUP_SECONDS, stale_after=STALE_AFTER):
+        self.store = store
+        self.half_life = half_life
+        self.trend_window = trend_window
+        self.horizon = horizon
+        self.warmup = warmup
+        self.stale_after = stale_after
+        self._trends = {}
+
+    def update(self, name, metric_id, now=None, samples=None):
+        """
+        Feeds new samples of one VM into its estimate: `samples`, (timestamp, cpu)
+        pairs pushed by the metric feed, if given; otherwise the samples stored since
+        the last update. The first update of a VM also replays WARMUP_SECONDS of
+        stored history. Samples not newer than the last one seen are skipped.
+        """
+        now = time.time() if now is None else now
+        trend = self._trends.setdefault(name, _Trend())
+        if trend.timestamp is None:
+            for timestamp, _, cpu, _ in self.store.last(metric_id, self.warmup, now):
+                trend.add(timestamp, cpu, self.half_life, self.trend_window)
+        if samples is None:
+            # Store timestamps never go backwards, so this skips what we have seen.
+            start = now if trend.timestamp is None else trend.timestamp
+            samples = [(s[0], s[2]) for s in self.store.query(metric_id, start)]
+        for timestamp, cpu in samples:
+            if trend.timestamp is None or timestamp > trend.timestamp:
+                trend.add(timestamp, cpu, self.half_life, self.trend_window)
+
+    def estimate(self, name, now=None):
+        """
+        Returns the LoadEstimate of a VM, or None if it has no recent samples.
+        """
+        now = time.time() if now is None else now
+        trend = self._trends.get(name)
+        if trend is None or trend.timestamp is None or now - trend.timestamp > self.stale_after:
+            return None
+        slope = trend.slope()
+        forecast = trend.ewma + slope * (self.horizon + now - trend.timestamp)
+        return LoadEstimate(trend.ewma, slope, min(max(forecast, 0.0), 100.0), trend.timestamp)
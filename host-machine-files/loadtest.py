@@ -0,0 +1,522 @@
+"""
+End-to-end load test of the host's dispatch path against local stand-ins.
+
+Starts one stand-in process per VM and one for Cloud Run, each serving the three
+operations (per-image endpoint, /batch and /health) with a configurable latency and
+CPU cost per image, and writing its CPU usage where the load balancer reads it. It
+then replays an upload workload with many concurrent users through the real
+backend (submit_job / wait_job, the job queue, the routing API and the dispatch
+client), once per load-balancing policy, and reports throughput, p50/p95/p99
+latency and where the images went.
+
+The VM stand-ins listen on 127.0.0.2, 127.0.0.3, ... (on Linux the whole 127/8
+block is loopback; on macOS add the addresses with `ifconfig lo0 alias`).
+
+Usage:
+    python loadtest.py                                  # synthetic workload, every policy
+    python loadtest.py --users 50 --uploads 4 --images 8 --operation caption
+    python loadtest.py --policies lowest_cpu,least_outstanding --json results.json
+    python loadtest.py --fail-vm VM2                    # one VM answers 503 to everything
+    python loadtest.py --replay jobs --inputs uploaded  # recorded jobs (see jobs.py)
+"""
+import argparse
+import copy
+import email.parser
+import email.policy
+import io
+import json
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+import zipfile
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+HOST_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Ports of the stand-in services (the real ones use 8080-8082).
+STANDIN_PORTS = {"sketch": 18080, "bg_remove": 18082, "caption": 18081}
+# Address of the Cloud Run stand-in; VM n listens on 127.0.0.<n + 1>.
+GCP_STANDIN_IP = "127.0.0.100"
+# Port of the routing API during the test (the real one uses 8765). Every policy run
+# serves it again on the same port once the previous run has closed it.
+LOADTEST_ROUTING_PORT = 18765
+# Per-image cost of each operation on a stand-in: fixed latency, latency per MB
+# uploaded, and CPU time burnt. The Cloud Run stand-in scales out, so it waits
+# for the CPU time instead of competing for one core.
+STANDIN_COST = {
+    "sketch": {"latency_ms": 20, "ms_per_mb": 40, "cpu_ms": 60},
+    "bg_remove": {"latency_ms": 50, "ms_per_mb": 40, "cpu_ms": 250},
+    "caption": {"latency_ms": 50, "ms_per_mb": 20, "cpu_ms": 400},
+}
+# Extra latency of every Cloud Run request (round trip to the region).
+GCP_EXTRA_MS = 150
+# Seconds between two CPU usage samples written by a VM stand-in.
+USAGE_INTERVAL = 0.5
+USAGE_WINDOW = 10
+ENDPOINTS = {"sketch": "/sketch", "bg_remove": "/remove_bg", "caption": "/caption"}
+MIMETYPES = {"sketch": "image/jpeg", "bg_remove": "image/png"}
+
+
+# ---- Stand-in services ----
+
+def parse_multipart(content_type, body):
+    """
+    Returns [(field name, filename, content)] of a multipart/form-data body.
+    """
+    message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+        f"Content-Type: {content_type}\r\n\r\n".encode() + body)
+    return [(part.get_param("name", header="content-disposition"), part.get_filename(),
+             part.get_payload(decode=True)) for part in message.iter_parts()]
+
+
+def burn(seconds):
+    """
+    Spins on the CPU for `seconds` of this thread's CPU time.
+    """
+    end = time.thread_time() + seconds
+    while time.thread_time() < end:
+        pass
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+    """
+    Answers like one of the real services: the per-image endpoint returns the image
+    (or a caption), /batch a ZIP (or JSON results), /health and /ready {"status": "ok"}.
+    """
+
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def _send(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path in ("/health", "/ready"):
+            self._send(200, b'{"status": "ok"}', "application/json")
+        else:
+            self._send(404, b"Not found", "text/plain")
+
+    def do_POST(self):
+        operation = self.server.operation
+        settings = self.server.settings
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+        if self.path not in (ENDPOINTS[operation], "/batch"):
+            self._send(404, b"Not found", "text/plain")
+            return
+        if random.random() < settings["error_rate"]:
+            self._send(503, b"Stand-in failure", "text/plain")
+            return
+        files = parse_multipart(self.headers["Content-Type"], body)
+        cost = settings["cost"][operation]
+        for _, _, content in files:
+            wait_ms = cost["latency_ms"] + cost["ms_per_mb"] * len(content) / (1024 * 1024) + settings["extra_ms"]
+            if settings["scale_out"]:
+                wait_ms += cost["cpu_ms"]
+            else:
+                burn(cost["cpu_ms"] / 1000)
+            time.sleep(wait_ms / 1000)
+
+        if operation == "caption":
+            captions = [{"name": filename, "caption": f"a stand-in caption of {len(content)} bytes"}
+                        for _, filename, content in files]
+            if self.path == "/batch":
+                self._send(200, json.dumps({"results": captions}).encode(), "application/json")
+            else:
+                self._send(200, json.dumps({"caption": captions[0]["caption"]}).encode(), "application/json")
+        elif self.path == "/batch":
+            archive = io.BytesIO()
+            with zipfile.ZipFile(archive, "w", zipfile.ZIP_STORED) as zf:
+                for _, filename, content in files:
+                    zf.writestr(filename, content)
+            self._send(200, archive.getvalue(), "application/zip")
+        else:
+            self._send(200, files[0][2], MIMETYPES[operation])
+
+    def log_message(self, format, *args):
+        pass
+
+
+def write_usage(usage_dir, cpu_window, ram_window):
+    # Same files and format as parallel_monitor.py, replaced atomically.
+    for filename, window in (("cpu.txt", cpu_window), ("ram.txt", ram_window)):
+        path = os.path.join(usage_dir, filename)
+        with open(f"{path}.tmp", "w") as f:
+            f.write(",".join(f"{value:.1f}" for value in window))
+        os.replace(f"{path}.tmp", path)
+
+
+def run_standin(ip, settings, usage_dir=None):
+    """
+    Serves the three operations on ip (one stand-in process per target) and, for a
+    VM, writes its CPU usage to usage_dir every USAGE_INTERVAL seconds. Runs forever.
+    """
+    for operation, port in STANDIN_PORTS.items():
+        server = ThreadingHTTPServer((ip, port), StandinHandler)
+        server.daemon_threads = True
+        server.operation = operation
+        server.settings = settings
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    if usage_dir is None:
+        threading.Event().wait()
+    os.makedirs(usage_dir, exist_ok=True)
+    cpu_window, ram_window = [0.0], [40.0]
+    write_usage(usage_dir, cpu_window, ram_window)
+    last_wall, last_cpu = time.monotonic(), time.process_time()
+    while True:
+        time.sleep(USAGE_INTERVAL)
+        wall, cpu = time.monotonic(), time.process_time()
+        # The stand-in competes for one core, so one busy core is 100%.
+        cpu_window = (cpu_window + [min(100.0 * (cpu - last_cpu) / (wall - last_wall), 100.0)])[-USAGE_WINDOW:]
+        ram_window = (ram_window + [40.0])[-USAGE_WINDOW:]
+        last_wall, last_cpu = wall, cpu
+        write_usage(usage_dir, cpu_window, ram_window)
+
+
+def wait_until_healthy(urls, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    for url in urls:
+        while True:
+            try:
+                with urllib.request.urlopen(url, timeout=1.0):
+                    break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise RuntimeError(f"Stand-in {url} did not start")
+                time.sleep(0.1)
+
+
+def build_cluster(vm_count, spill_cpu, max_in_flight):
+    """
+    Returns the cluster config pointing at the stand-ins.
+    """
+    operation = {"policy": "lowest_cpu", "spill_cpu": spill_cpu}
+    if max_in_flight is not None:
+        operation["max_in_flight"] = max_in_flight
+    return {
+        "vms": [{"name": f"VM{n}", "ip": f"127.0.0.{n + 1}", "usage_dir": f"./vm_usage/vm{n}"}
+                for n in range(1, vm_count + 1)],
+        "gcp_urls": {op: f"http://{GCP_STANDIN_IP}:{port}" for op, port in STANDIN_PORTS.items()},
+        "service_ports": dict(STANDIN_PORTS),
+        "operations": {op: dict(operation) for op in STANDIN_PORTS},
+        # The stand-ins write usage files only; there is no telemetry or metric store.
+        "metric_feed": False,
+        "load_estimator": {"enabled": False},
+    }
+
+
+def start_standins(config, args):
+    """
+    Starts one stand-in process per VM and one for Cloud Run; returns the processes.
+    """
+    cost = {op: {key: value * (args.cpu_scale if key == "cpu_ms" else args.latency_scale)
+                 for key, value in settings.items()}
+            for op, settings in STANDIN_COST.items()}
+    processes = []
+    for vm in config["vms"]:
+        settings = {"cost": cost, "extra_ms": 0, "scale_out": False,
+                    "error_rate": 1.0 if vm["name"] in args.fail_vm else args.error_rate}
+        processes.append(multiprocessing.Process(target=run_standin, args=(vm["ip"], settings, vm["usage_dir"]),
+                                                 daemon=True))
+    gcp = {"cost": cost, "extra_ms": GCP_EXTRA_MS * args.latency_scale, "scale_out": True,
+           "error_rate": args.error_rate}
+    processes.append(multiprocessing.Process(target=run_standin, args=(GCP_STANDIN_IP, gcp), daemon=True))
+    for process in processes:
+        process.start()
+    wait_until_healthy([f"http://{ip}:{port}/health"
+                        for ip in [vm["ip"] for vm in config["vms"]] + [GCP_STANDIN_IP]
+                        for port in STANDIN_PORTS.values()])
+    return processes
+
+
+# ---- Workloads ----
+
+class Upload(io.BytesIO):
+    """
+    Stands in for a Streamlit UploadedFile.
+    """
+
+    def __init__(self, name, data):
+        super().__init__(data)
+        self.name = name
+
+
+def synthetic_image(megapixels, seed):
+    """
+    Returns a JPEG of about `megapixels` with content that differs for every seed, so
+    uploads don't hit the result cache.
+    """
+    from PIL import Image, ImageDraw
+
+    width = int((megapixels * 1e6 * 4 / 3) ** 0.5)
+    height = int(width * 3 / 4)
+    rng = random.Random(seed)
+    image = Image.linear_gradient("L").resize((width, height)).convert("RGB")
+    draw = ImageDraw.Draw(image)
+    for _ in range(20):
+        x, y = rng.randrange(width), rng.randrange(height)
+        color = tuple(rng.randrange(256) for _ in range(3))
+        draw.ellipse((x, y, x + width // 8, y + height // 8), fill=color)
+    buffer = io.BytesIO()
+    image.save(buffer, "JPEG", quality=85)
+    return buffer.getvalue()
+
+
+def synthetic_workload(args):
+    """
+    Returns [(start offset, user, operation, [(filename, bytes)])]: args.uploads
+    uploads of args.images images per user, separated by exponential think times.
+    """
+    operations = list(STANDIN_PORTS) if args.operation == "mix" else [args.operation]
+    rng = random.Random(args.seed)
+    workload = []
+    seed = 0
+    for user in range(args.users):
+        at = rng.uniform(0, args.ramp_up)
+        for _ in range(args.uploads):
+            images = []
+            for _ in range(args.images):
+                seed += 1
+                images.append((f"u{user}-{seed}.jpg", synthetic_image(args.megapixels, f"{args.seed}-{seed}")))
+            workload.append((at, f"user-{user}", rng.choice(operations), images))
+            at += rng.expovariate(1 / args.think_time) if args.think_time > 0 else 0
+    return workload
+
+
+def recorded_workload(job_dir, input_dir):
+    """
+    Returns the workload recorded in job records (see jobs.py): every job replays at
+    its original offset, for its owner, with the original uploads from input_dir.
+    Images whose upload is no longer on disk are skipped.
+    """
+    records = []
+    for filename in sorted(os.listdir(job_dir)):
+        if filename.endswith(".json"):
+            with open(os.path.join(job_dir, filename)) as f:
+                records.append(json.load(f))
+    if not records:
+        raise SystemExit(f"No job records in {job_dir}")
+    start = min(record["created"] for record in records)
+    workload = []
+    missing = 0
+    for record in sorted(records, key=lambda r: r["created"]):
+        images = []
+        for entry in record["results"]:
+            path = os.path.join(input_dir, entry["name"])
+            if not os.path.exists(path):
+                missing += 1
+                continue
+            with open(path, "rb") as f:
+                images.append((entry["name"], f.read()))
+        if images:
+            workload.append((record["created"] - start, record["owner"], record["operation"], images))
+    if missing:
+        print(f"{missing} recorded images are no longer in {input_dir} and were skipped.")
+    return workload
+
+
+# ---- Running and reporting ----
+
+def percentile(values, p):
+    """
+    Returns the p-th percentile (nearest rank) of values, or None if there are none.
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(p / 100 * len(ordered))) - 1))]
+
+
+def run_user(backend, uploads, start, samples, lock):
+    """
+    Submits one user's uploads in order, waiting for each job to finish, and appends
+    (seconds from submit to result, target, error?) for every image to samples.
+    """
+    for at, owner, operation, images in uploads:
+        delay = start + at - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        submitted = time.monotonic()
+        job_id = backend.submit_job(owner, operation, [Upload(name, data) for name, data in images])
+        seen = 0
+        while True:
+            job = backend.wait_job(job_id, seen)
+            now = time.monotonic()
+            with lock:
+                for entry in job["results"][seen:]:
+                    samples.append((now - submitted, now, entry["target"], "error" in entry))
+            seen = len(job["results"])
+            if job["status"] not in ("queued", "running"):
+                break
+
+
+def run_policy(policy, config, workload, health, keep_cache, port):
+    """
+    Replays the workload with every operation routed by `policy`, with the routing API
+    on `port`, and returns its report.
+    """
+    import backend
+    from load_balancer import Balancer, build_health, TICK_INTERVAL
+    from result_cache import ResultCache
+    from routing import RoutingClient, RoutingState, serve_routing_state
+
+    config = copy.deepcopy(config)
+    for settings in config["operations"].values():
+        settings["policy"] = policy
+    if not keep_cache:
+        # Every policy starts from an empty result cache.
+        backend.result_cache = ResultCache(os.path.join("cache", policy))
+    _, breaker_factory = build_health(config)
+    state = RoutingState(breaker_factory=breaker_factory)
+    balancer = Balancer(config, state, health=health)
+    state.chooser = balancer.choose
+    balancer.refresh_usage()
+    server = serve_routing_state(state, port=port)
+    backend.routing_client = RoutingClient(port=port)
+
+    stop = threading.Event()
+
+    def tick():
+        while not stop.is_set():
+            balancer.refresh_usage()
+            stop.wait(TICK_INTERVAL)
+
+    ticker = threading.Thread(target=tick, daemon=True)
+    ticker.start()
+
+    users = {}
+    for upload in workload:
+        users.setdefault(upload[1], []).append(upload)
+    samples = []
+    lock = threading.Lock()
+    start = time.monotonic()
+    threads = [threading.Thread(target=run_user, args=(backend, uploads, start, samples, lock), daemon=True)
+               for uploads in users.values()]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stop.set()
+    server.shutdown()
+    server.server_close()
+
+    latencies = [latency for latency, _, _, error in samples if not error]
+    targets = {}
+    for _, _, target, _ in samples:
+        targets[target] = targets.get(target, 0) + 1
+    duration = max((finished for _, finished, _, _ in samples), default=start) - start
+    return {
+        "policy": policy,
+        "images": len(samples),
+        "errors": sum(1 for sample in samples if sample[3]),
+        "duration": round(duration, 3),
+        "throughput": round(len(samples) / duration, 2) if duration > 0 else None,
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "targets": dict(sorted(targets.items())),
+    }
+
+
+def print_report(reports):
+    print(f"\n{'policy':<20}{'images':>8}{'errors':>8}{'img/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}  targets")
+    for report in reports:
+        ms = ["-" if report[p] is None else f"{report[p] * 1000:.0f}" for p in ("p50", "p95", "p99")]
+        targets = ", ".join(f"{target} {100 * count / max(report['images'], 1):.0f}%"
+                            for target, count in report["targets"].items())
+        print(f"{report['policy']:<20}{report['images']:>8}{report['errors']:>8}"
+              f"{report['throughput'] or 0:>9.1f}{ms[0]:>9}{ms[1]:>9}{ms[2]:>9}  {targets}")
+
+
+def parse_args(argv=None):
+    from policies import POLICIES
+
+    parser = argparse.ArgumentParser(description="End-to-end load test against local stand-ins.")
+    parser.add_argument("--policies", default=",".join(sorted(POLICIES)),
+                        help="comma-separated load-balancing policies to compare (default: all)")
+    parser.add_argument("--vms", type=int, default=2, help="number of VM stand-ins")
+    parser.add_argument("--users", type=int, default=20, help="concurrent users")
+    parser.add_argument("--uploads", type=int, default=3, help="uploads per user")
+    parser.add_argument("--images", type=int, default=4, help="images per upload")
+    parser.add_argument("--operation", default="sketch", choices=list(STANDIN_PORTS) + ["mix"])
+    parser.add_argument("--megapixels", type=float, default=1.0, help="size of the synthetic images")
+    parser.add_argument("--think-time", type=float, default=1.0, help="mean seconds between a user's uploads")
+    parser.add_argument("--ramp-up", type=float, default=2.0, help="seconds over which users start")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--replay", metavar="JOB_DIR", help="replay the job records in JOB_DIR instead")
+    parser.add_argument("--inputs", metavar="DIR", help="original uploads of the replayed jobs "
+                        "(default: the uploaded folder next to JOB_DIR)")
+    parser.add_argument("--spill-cpu", type=float, default=40)
+    parser.add_argument("--max-in-flight", type=int)
+    parser.add_argument("--cpu-scale", type=float, default=1.0, help="multiplies the stand-ins' CPU cost")
+    parser.add_argument("--latency-scale", type=float, default=1.0, help="multiplies the stand-ins' latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered 503")
+    parser.add_argument("--fail-vm", action="append", default=[], help="VM whose stand-in always fails")
+    parser.add_argument("--no-preprocess", action="store_true", help="send the uploads as they are")
+    parser.add_argument("--keep-cache", action="store_true", help="share the result cache between policies")
+    parser.add_argument("--workdir", help="where uploads, results and job records go (default: a temp dir)")
+    parser.add_argument("--json", metavar="PATH", help="also write the results as JSON")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    sys.path.insert(0, HOST_DIR)
+    args = parse_args(argv)
+    if args.replay:
+        workload = recorded_workload(args.replay, args.inputs or os.path.join(os.path.dirname(
+            os.path.abspath(args.replay)), "uploaded"))
+    else:
+        print("Generating images...")
+        workload = synthetic_workload(args)
+    json_path = os.path.abspath(args.json) if args.json else None
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="loadtest-")
+    os.makedirs(workdir, exist_ok=True)
+    os.chdir(workdir)
+    config = build_cluster(args.vms, args.spill_cpu, args.max_in_flight)
+    with open("cluster.json", "w") as f:
+        json.dump(config, f, indent=2)
+    # backend.py reads it at import time.
+    os.environ["CLUSTER_CONFIG"] = os.path.join(workdir, "cluster.json")
+
+    processes = start_standins(config, args)
+    try:
+        import backend
+        from cluster import load_cluster_config
+        from load_balancer import build_health
+
+        backend.PREPROCESS_UPLOADS = not args.no_preprocess
+        config = load_cluster_config(os.environ["CLUSTER_CONFIG"])
+        health, _ = build_health(config)
+        health.start()
+        images = sum(len(upload[3]) for upload in workload)
+        users = len({upload[1] for upload in workload})
+        print(f"Replaying {len(workload)} uploads ({images} images) from {users} users "
+              f"against {args.vms} VMs and Cloud Run, in {workdir}")
+        reports = []
+        for policy in args.policies.split(","):
+            print(f"Running {policy}...")
+            reports.append(run_policy(policy, config, workload, health, args.keep_cache,
+                                      LOADTEST_ROUTING_PORT))
+        print_report(reports)
+        if json_path:
+            settings = {key: value for key, value in vars(args).items() if key != "json"}
+            with open(json_path, "w") as f:
+                json.dump({"settings": settings, "cost": STANDIN_COST, "results": reports}, f, indent=2)
+            print(f"Results written to {json_path}")
+    finally:
+        for process in processes:
+            process.terminate()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+import json
+import socket
+import threading
+import time
+from collections import deque
+
+# parallel_monitor.py publishes every sample here as it arrives.
+FEED_HOST = "127.0.0.1"
+FEED_PORT = 8766
+# Samples kept in memory per VM by a subscriber.
+FEED_HISTORY = 600
+# Seconds to wait before reconnecting after the publisher went away.
+RECONNECT_DELAY = 1.0
+
+
+class MetricSubscriber:
+    """
+    Client of the metric feed published by parallel_monitor.py.
+
+    The feed is newline-delimited JSON over a local TCP connection, one event per
+    sample:
+        {"type": "sample", "id": "1", "ts": <unix time>, "cpu": %, "ram": %,
+         "details": {...}}   (details only for version 2 telemetry)
+    On connect the publisher first replays the most recent samples of every VM.
+
+    A background thread keeps the latest samples of each VM in memory and wakes up
+    anyone blocked in wait(), so consumers react to new samples as they arrive
+    instead of polling files. It reconnects on its own if the publisher restarts.
+    """
+
+    def __init__(self, host=FEED_HOST, port=FEED_PORT, history=FEED_HISTORY):
+        self.host = host
+        self.port = port
+        self.history = history
+        self.connected = False
+        self.version = 0
+        self._cond = threading.Condition()
+        self._samples = {}   # id -> deque of (timestamp, cpu, ram)
+        self._details = {}   # id -> details of the latest version 2 message
+        self._thread = None
+
+    def start(self):
+        """
+        Starts the background thread (once) and returns self.
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        return self
+
+    def _run(self):
+        while True:
+            try:
+                with socket.create_connection((self.host, self.port)) as sock:
+                    with self._cond:
+                        self.connected = True
+                        self._cond.notify_all()
+                    for line in sock.makefile("r", encoding="utf-8"):
+                        self._handle(line)
+            except OSError:
+                pass
+            with self._cond:
+                if self.connected:
+                    print(f"Metric feed on {self.host}:{self.port} disconnected")
+                self.connected = False
+                self._cond.notify_all()
+            time.sleep(RECONNECT_DELAY)
+
+    def _handle(self, line):
+        try:
+            event = json.loads(line)
+        except ValueError:
+            return
+        if event.get("type") != "sample":
+            return
+        identifier = str(event["id"])
+        with self._cond:
+            samples = self._samples.setdefault(identifier, deque(maxlen=self.history))
+            # The replay after a reconnect repeats samples we already have.
+            if samples and event["ts"] <= samples[-1][0]:
+                return
+            samples.append((event["ts"], event["cpu"], event["ram"]))
+            if "details" in event:
+                self._details[identifier] = event["details"]
+            self.version += 1
+            self._cond.notify_all()
+
+    def wait(self, seen, timeout=None):
+        """
+        Blocks until there are samples newer than version `seen`, the connection state
+        changes, or the timeout expires. Returns the current version.
+        """
+        with self._cond:
+            connected = self.connected
+            self._cond.wait_for(lambda: self.version != seen or self.connected != connected, timeout)
+            return self.version
+
+    def vm_ids(self):
+        """
+        Returns the ids of every VM seen on the feed.
+        """
+        with self._cond:
+            return sorted(self._samples)
+
+    def window(self, identifier, n=None):
+        """
+        Returns the last n samples of a VM (all kept samples if n is None) as three
+        lists: timestamps, CPU and RAM, oldest first.
+        """
+        with self._cond:
+            samples = list(self._samples.get(str(identifier), ()))
+        if n is not None:
+            samples = samples[-n:]
+        return [s[0] for s in samples], [s[1] for s in samples], [s[2] for s in samples]
+
+    def details(self, identifier):
+        """
+        Returns the latest version 2 details of a VM (see parallel_monitor.py), or None.
+        """
+        with self._cond:
+            return self._details.get(str(identifier))
@@ -0,0 +1,306 @@
+import argparse
+import bisect
+import mmap
+import os
+import struct
+import threading
+import time
+
+# Root directory of the store. Each VM gets its own sub-directory of segment files.
+STORE_DIR = "./metrics"
+
+# Fixed-width little-endian record: timestamp (float64 seconds), VM id (uint16),
+# 2 padding bytes, CPU % (float32), RAM % (float32). 20 bytes per sample.
+RECORD = struct.Struct("<dHxxff")
+RECORD_SIZE = RECORD.size
+
+# A new segment file is started once the active one holds this many records
+# (65536 records is about 1.3 MB, or roughly 18 hours at one sample per second).
+SEGMENT_RECORDS = 65536
+
+SEGMENT_SUFFIX = ".seg"
+
+
+def _segment_name(first_timestamp):
+    # Zero-padded milliseconds, so lexical order is chronological order.
+    return f"{int(first_timestamp * 1000):015d}{SEGMENT_SUFFIX}"
+
+
+def _segment_start(name):
+    return int(name[:-len(SEGMENT_SUFFIX)]) / 1000.0
+
+
+class _Segment:
+    """
+    Read-only view of one segment file, memory-mapped on demand.
+    """
+
+    def __init__(self, path, start):
+        self.path = path
+        self.start = start
+        self._map = None
+        self._mapped_count = 0
+
+    def view(self):
+        """
+        Returns (buffer, record_count). Re-maps the file if it has grown since the last call.
+        """
+        count = os.path.getsize(self.path) // RECORD_SIZE
+        if count == 0:
+            return b"", 0
+        if self._map is None or count != self._mapped_count:
+            if self._map is not None:
+                self._map.close()
+            with open(self.path, "rb") as f:
+                self._map = mmap.mmap(f.fileno(), count * RECORD_SIZE, access=mmap.ACCESS_READ)
+            self._mapped_count = count
+        return self._map, count
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+
+def _lower_bound(buf, count, timestamp):
+    """
+    Index of the first record in buf whose timestamp is >= timestamp (binary search).
+    """
+    lo, hi = 0, count
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if struct.unpack_from("<d", buf, mid * RECORD_SIZE)[0] < timestamp:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+class MetricStore:
+    """
+    Append-only binary time-series store for VM CPU/RAM samples.
+
+    Records are fixed-width (see RECORD) and written to per-VM segment files named
+    after the timestamp of their first record. Timestamps within a VM never go
+    backwards, so a time-range query is a binary search over the segment names
+    followed by a binary search inside the memory-mapped segments.
+
+    One process (parallel_monitor.py) writes; any number of processes can read.
+    """
+
+    def __init__(self, root=STORE_DIR, segment_records=SEGMENT_RECORDS):
+        self.root = root
+        self.segment_records = segment_records
+        self._lock = threading.Lock()
+        self._writers = {}   # vm_id -> [file, record_count, last_timestamp]
+        self._segments = {}  # vm_id -> list of _Segment, oldest first
+        os.makedirs(root, exist_ok=True)
+
+    # ---- Writing ----
+
+    def _vm_dir(self, vm_id):
+        return os.path.join(self.root, f"vm{vm_id}")
+
+    def _open_writer(self, vm_id, timestamp):
+        """
+        Opens the newest segment for appending, or starts a new one if it is full.
+        """
+        vm_dir = self._vm_dir(vm_id)
+        os.makedirs(vm_dir, exist_ok=True)
+        names = sorted(n for n in os.listdir(vm_dir) if n.endswith(SEGMENT_SUFFIX))
+        if names:
+            path = os.path.join(vm_dir, names[-1])
+            size = os.path.getsize(path)
+            count = size // RECORD_SIZE
+            last_timestamp = 0.0
+            if size % RECORD_SIZE:
+                # Drop a partially written trailing record left by a crash.
+                with open(path, "r+b") as f:
+                    f.truncate(count * RECORD_SIZE)
+            if count:
+                with open(path, "rb") as f:
+                    f.seek((count - 1) * RECORD_SIZE)
+                    last_timestamp = RECORD.unpack(f.read(RECORD_SIZE))[0]
+            if count < self.segment_records:
+                return [open(path, "ab"), count, last_timestamp]
+            timestamp = max(timestamp, last_timestamp)
+            return self._new_segment(vm_id, timestamp, last_timestamp)
+        return self._new_segment(vm_id, timestamp, 0.0)
+
+    def _new_segment(self, vm_id, timestamp, last_timestamp):
+        path = os.path.join(self._vm_dir(vm_id), _segment_name(timestamp))
+        return [open(path, "ab"), 0, last_timestamp]
+
+    def append(self, vm_id, cpu, ram, timestamp=None):
+        """
+        Appends one sample. Timestamps earlier than the VM's last one are clamped to it.
+        """
+        self.append_many([(time.time() if timestamp is None else timestamp, vm_id, cpu, ram)])
+
+    def append_many(self, samples):
+        """
+        Appends an iterable of (timestamp, vm_id, cpu, ram) tuples and flushes them to disk.
+        """
+        with self._lock:
+            touched = set()
+            for timestamp, vm_id, cpu, ram in samples:
+                vm_id = int(vm_id)
+                writer = self._writers.get(vm_id)
+                if writer is None:
+                    writer = self._writers[vm_id] = self._open_writer(vm_id, timestamp)
+                elif writer[1] >= self.segment_records:
+                    writer[0].close()
+                    writer = self._writers[vm_id] = self._new_segment(
+                        vm_id, max(timestamp, writer[2]), writer[2])
+                timestamp = max(timestamp, writer[2])
+                writer[0].write(RECORD.pack(timestamp, vm_id, cpu, ram))
+                writer[1] += 1
+                writer[2] = timestamp
+                touched.add(vm_id)
+            for vm_id in touched:
+                self._writers[vm_id][0].flush()
+
+    def close(self):
+        with self._lock:
+            for writer in self._writers.values():
+                writer[0].close()
+            self._writers.clear()
+            for segments in self._segments.values():
+                for segment in segments:
+                    segment.close()
+            self._segments.clear()
+
+    # ---- Reading ----
+
+    def vm_ids(self):
+        """
+        Returns the ids of every VM with data in the store.
+        """
+        ids = []
+        for name in os.listdir(self.root):
+            if name.startswith("vm") and name[2:].isdigit():
+                ids.append(int(name[2:]))
+        return sorted(ids)
+
+    def _refresh_segments(self, vm_id):
+        vm_dir = self._vm_dir(vm_id)
+        try:
+            names = sorted(n for n in os.listdir(vm_dir) if n.endswith(SEGMENT_SUFFIX))
+        except FileNotFoundError:
+            names = []
+        segments = self._segments.get(vm_id, [])
+        known = {os.path.basename(s.path) for s in segments}
+        for name in names:
+            if name not in known:
+                segments.append(_Segment(os.path.join(vm_dir, name), _segment_start(name)))
+        segments.sort(key=lambda s: s.start)
+        self._segments[vm_id] = segments
+        return segments
+
+    def query(self, vm_id, start, end=None):
+        """
+        Returns the samples of one VM with start <= timestamp < end, oldest first,
+        as a list of (timestamp, vm_id, cpu, ram) tuples.
+        """
+        vm_id = int(vm_id)
+        end = float("inf") if end is None else end
+        results = []
+        with self._lock:
+            segments = self._refresh_segments(vm_id)
+            starts = [s.start for s in segments]
+            # The first segment that can hold `start` is the last one starting at or before it.
+            first = max(bisect.bisect_right(starts, start) - 1, 0)
+            for segment in segments[first:]:
+                if segment.start >= end:
+                    break
+                buf, count = segment.view()
+                index = _lower_bound(buf, count, start)
+                while index < count:
+                    record = RECORD.unpack_from(buf, index * RECORD_SIZE)
+                    if record[0] >= end:
+                        return results
+                    results.append(record)
+                    index += 1
+        return results
+
+    def last(self, vm_id, seconds, now=None):
+        """
+        Returns the samples of one VM from the last `seconds` seconds.
+        """
+        now = time.time() if now is None else now
+        return self.query(vm_id, now - seconds)
+
+    def latest(self, vm_id, n):
+        """
+        Returns the last n samples of one VM, oldest first.
+        """
+        vm_id = int(vm_id)
+        results = []
+        with self._lock:
+            for segment in reversed(self._refresh_segments(vm_id)):
+                buf, count = segment.view()
+                take = min(n - len(results), count)
+                chunk = [RECORD.unpack_from(buf, i * RECORD_SIZE) for i in range(count - take, count)]
+                results = chunk + results
+                if len(results) >= n:
+                    break
+        return results
+
+
+def import_logs(log_path, store, interval=1.1, end_time=None):
+    """
+    Imports the legacy logs.txt format (<ID>_<CPU>_<RAM> per line) into a store.
+
+    logs.txt carries no timestamps, so each VM's lines are given evenly spaced
+    timestamps `interval` seconds apart (the monitor reports roughly every 1.1 s),
+    with the last line of every VM ending at `end_time` (defaults to the file's
+    modification time). Returns the number of imported samples per VM id.
+    """
+    end_time = os.path.getmtime(log_path) if end_time is None else end_time
+    per_vm = {}
+    with open(log_path, "r") as f:
+        for line in f:
+            parts = line.strip().split("_")
+            if len(parts) != 3:
+                continue
+            try:
+                vm_id, cpu, ram = int(parts[0]), float(parts[1]), float(parts[2])
+            except ValueError:
+                continue
+            per_vm.setdefault(vm_id, []).append((cpu, ram))
+
+    counts = {}
+    for vm_id, samples in per_vm.items():
+        first = end_time - interval * (len(samples) - 1)
+        store.append_many((first + i * interval, vm_id, cpu, ram)
+                          for i, (cpu, ram) in enumerate(samples))
+        counts[vm_id] = len(samples)
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect or populate the VM metric store.")
+    parser.add_argument("--root", default=STORE_DIR, help="store directory")
+    sub = parser.add_subparsers(dest="command", required=True)
+    imp = sub.add_parser("import", help="import a legacy logs.txt file")
+    imp.add_argument("log_path")
+    imp.add_argument("--interval", type=float, default=1.1)
+    tail = sub.add_parser("tail", help="print the last N seconds for a VM")
+    tail.add_argument("vm_id", type=int)
+    tail.add_argument("seconds", type=float)
+    args = parser.parse_args()
+
+    store = MetricStore(args.root)
+    try:
+        if args.command == "import":
+            for vm_id, count in import_logs(args.log_path, store, args.interval).items():
+                print(f"VM{vm_id}: imported {count} samples")
+        else:
+            for timestamp, vm_id, cpu, ram in store.last(args.vm_id, args.seconds):
+                print(f"{timestamp:.3f} VM{vm_id} CPU: {cpu:.1f}% RAM: {ram:.1f}%")
+    finally:
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,205 +1,348 @@
-import socket
+import asyncio
 import json
-import threading
-import time
 import os
+import time
+from collections import deque
+from cluster import load_cluster_config
+from metric_store import MetricStore
+from metric_feed import FEED_HOST, FEED_PORT
+
+HOST = '0.0.0.0'
+
+# Directory holding ./vm_usage/vm<ID>/cpu.txt and ram.txt for the balancer and dashboard.
+USAGE_DIR = "./vm_usage"
+# Legacy text log of <ID>_<CPU>_<RAM> lines; the binary metric store replaces it.
+LOG_FILE = "logs.txt"
+WRITE_TEXT_LOG = False
+
+# Number of most recent values written to cpu.txt / ram.txt.
+FILE_WINDOW = 5
+# Number of samples kept in memory per VM.
+HISTORY_SIZE = 600
+# Seconds between flushes of the in-memory buffers to disk.
+FLUSH_INTERVAL = 0.5
+# Print every sample as it arrives (slow with many VMs).
+VERBOSE = False
+
+# Telemetry message versions this ingester understands (see vm-files/monitor.py).
+# Version 1 is the bare list [id, cpu, ram]; version 2 is a JSON object that adds
+# load average, available memory and per-service counters.
+SCHEMA_VERSIONS = (1, 2)
+# Fields of a version 2 message kept besides id/cpu/ram, written to telemetry.json.
+DETAIL_FIELDS = ("ts", "ram_available_mb", "load_avg", "services")
+
+# Samples per VM replayed to a new feed subscriber, and how many events may wait for
+# a slow subscriber before its oldest ones are dropped.
+FEED_REPLAY = 60
+FEED_QUEUE_SIZE = 1000
+
 
-# Global lock for synchronizing file writes
-log_lock = threading.Lock()
+def _write_atomic(path, content):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(content)
+    os.replace(tmp_path, path)
 
-def process_usage_list(usages):
+
+class MetricPublisher:
     """
-    Accepts either:
-      - a Python list of dicts, e.g. [{"id": "1", "cpu": 10, "ram": 20}, ...]
-      - a JSON string representing such a list.
-    
-    Each dict must have 'id', 'cpu', and 'ram' keys.
-    Writes to individual files:
-      - "./vm_usage/vm1.txt" for VM1 (id '1')
-      - "./vm_usage/vm2.txt" for VM2 (id '2')
-    
-    Each file will contain only the last 5 CPU usage values, comma separated.
-    Additionally, the usage is appended to logs.txt as <ID>_<CPU>_<RAM>
+    Pushes every sample to the subscribers of the local metric feed (see
+    metric_feed.py) as newline-delimited JSON. Runs on the event loop; publish()
+    must be called from the loop's thread.
     """
-    # Decode JSON string if necessary.
-    if isinstance(usages, str):
+
+    def __init__(self, replay=FEED_REPLAY, queue_size=FEED_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self._recent = {}
+        self._replay = replay
+        self._subscribers = set()
+
+    def publish(self, event):
+        line = (json.dumps(event) + "\n").encode()
+        recent = self._recent.setdefault(event["id"], deque(maxlen=self._replay))
+        recent.append(line)
+        for subscriber in self._subscribers:
+            if subscriber.full():
+                # A subscriber that can't keep up loses its oldest samples, not the newest.
+                subscriber.get_nowait()
+            subscriber.put_nowait(line)
+
+    async def handle_subscriber(self, reader, writer):
+        subscriber = asyncio.Queue(maxsize=self.queue_size)
+        for recent in self._recent.values():
+            for line in recent:
+                if not subscriber.full():
+                    subscriber.put_nowait(line)
+        self._subscribers.add(subscriber)
         try:
-            usage_list = json.loads(usages)
-        except json.JSONDecodeError as e:
-            raise ValueError("Invalid JSON string passed to process_usage_list") from e
-    else:
-        usage_list = usages
-
-    if not isinstance(usage_list, list):
-        raise ValueError("process_usage_list expects a list of usage dicts")
-
-    for usage in usage_list:
-        identifier = usage.get('id')
-        cpu = usage.get('cpu')
-        ram = usage.get('ram')
-        
-        # Determine target file based on identifier.
-        if str(identifier) == '1':
-            target_file_cpu = "./vm_usage/vm1/cpu.txt"
-            target_file_ram = "./vm_usage/vm1/ram.txt"
-            
-        elif str(identifier) == '2':
-            target_file_cpu = "./vm_usage/vm2/cpu.txt"
-            target_file_ram = "./vm_usage/vm2/ram.txt"
-            
+            while True:
+                writer.write(await subscriber.get())
+                await writer.drain()
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self._subscribers.discard(subscriber)
+            writer.close()
+
+
+class TelemetryIngester:
+    """
+    Collects CPU/RAM samples from any number of VMs into per-VM ring buffers.
+
+    Samples are only kept in memory when they arrive; flush() writes the latest
+    window of each VM to its cpu.txt/ram.txt and appends the pending samples to
+    the metric store (and to logs.txt, if a log file is given) in one batch.
+    The latest details of a version 2 message (service counters, load average,
+    available memory) go to the VM's telemetry.json. With a publisher, every sample
+    is also pushed to the metric feed right away.
+    """
+
+    def __init__(self, usage_dir=USAGE_DIR, log_file=None, history_size=HISTORY_SIZE,
+                 file_window=FILE_WINDOW, store=None, publisher=None):
+        self.usage_dir = usage_dir
+        self.publisher = publisher
+        self.log_file = log_file
+        self.store = store
+        self.file_window = file_window
+        self.history_size = history_size
+        self.cpu = {}
+        self.ram = {}
+        self.timestamps = {}
+        self.details = {}
+        self._pending = []
+        self._dirty = set()
+
+    def record(self, identifier, cpu, ram, timestamp=None, details=None):
+        """
+        Stores one sample for the given VM identifier, with the extra fields of a
+        version 2 message if there are any.
+        """
+        identifier = str(identifier)
+        if identifier not in self.cpu:
+            self.cpu[identifier] = deque(maxlen=self.history_size)
+            self.ram[identifier] = deque(maxlen=self.history_size)
+            self.timestamps[identifier] = deque(maxlen=self.history_size)
+        timestamp = time.time() if timestamp is None else timestamp
+        self.cpu[identifier].append(float(cpu))
+        self.ram[identifier].append(float(ram))
+        self.timestamps[identifier].append(timestamp)
+        self._pending.append((timestamp, identifier, float(cpu), float(ram)))
+        if details is not None:
+            self.details[identifier] = dict(details, received=timestamp)
+        if self.publisher is not None:
+            event = {"type": "sample", "id": identifier, "ts": timestamp, "cpu": float(cpu), "ram": float(ram)}
+            if details is not None:
+                event["details"] = details
+            self.publisher.publish(event)
+        self._dirty.add(identifier)
+        if VERBOSE:
+            print(f"ID: {identifier} | CPU: {cpu}% | RAM: {ram}%")
+
+    def process_usage_list(self, usages):
+        """
+        Accepts either:
+          - a Python list of dicts, e.g. [{"id": "1", "cpu": 10, "ram": 20}, ...]
+          - a JSON string representing such a list.
+
+        Each dict must have 'id', 'cpu', and 'ram' keys, and may have 'details'
+        (see parse_sample).
+        """
+        # Decode JSON string if necessary.
+        if isinstance(usages, str):
+            try:
+                usage_list = json.loads(usages)
+            except json.JSONDecodeError as e:
+                raise ValueError("Invalid JSON string passed to process_usage_list") from e
         else:
-            print(f"Unknown VM identifier: {identifier}")
-            continue
-        
-        # Ensure the directory exists
-        if not os.path.exists("./vm_usage"):
-            os.makedirs("./vm_usage")
-        
-        # Use the lock to ensure thread safety during file operations.
-        with log_lock:
-            # Read the current content from the file (if any)
-            current_values = []
-            if os.path.exists(target_file_cpu):
-                with open(target_file_cpu, "r") as f:
-                    content = f.read().strip()
-                    if content:
-                        try:
-                            current_values = [float(val) for val in content.split(',') if val]
-                        except Exception as e:
-                            print(f"Error parsing values from {target_file_cpu}: {e}")
-                            current_values = []
-            
-            # Append the new CPU value.
-            current_values.append(float(cpu))
-            # Keep only the last 5 CPU values.
-            if len(current_values) > 5:
-                current_values = current_values[-5:]
-            
-            # Write the updated CPU values back to the file, comma separated.
-            with open(target_file_cpu, "w") as f:
-                f.write(",".join(str(val) for val in current_values))
-                
-        with log_lock:
-            # Read the current content from the file (if any)
-            current_values = []
-            if os.path.exists(target_file_ram):
-                with open(target_file_ram, "r") as f:
-                    content = f.read().strip()
-                    if content:
-                        try:
-                            current_values = [float(val) for val in content.split(',') if val]
-                        except Exception as e:
-                            print(f"Error parsing values from {target_file_ram}: {e}")
-                            current_values = []
-            
-            # Append the new CPU value.
-            current_values.append(float(ram))
-            # Keep only the last 5 CPU values.
-            if len(current_values) > 5:
-                current_values = current_values[-5:]
-            
-            # Write the updated CPU values back to the file, comma separated.
-            with open(target_file_ram, "w") as f:
-                f.write(",".join(str(val) for val in current_values))
-        
-        print(f"ID: {identifier} | CPU: {cpu}% | RAM: {ram}%")
-        # Also log the raw usage.
-        log_line = f"{identifier}_{cpu}_{ram}\n"
-        with log_lock:
-            with open("logs.txt", "a") as log_file:
-                log_file.write(log_line)
-
-def handle_client(conn, addr):
+            usage_list = usages
+
+        if not isinstance(usage_list, list):
+            raise ValueError("process_usage_list expects a list of usage dicts")
+
+        for usage in usage_list:
+            identifier = str(usage.get('id'))
+            # The identifier becomes part of a directory name.
+            if not identifier.isalnum():
+                print(f"Unknown VM identifier: {identifier}")
+                continue
+            self.record(identifier, usage.get('cpu'), usage.get('ram'), details=usage.get('details'))
+
+    def take_snapshot(self):
+        """
+        Returns what needs to be written to disk and resets the pending state.
+        """
+        files = {}
+        for identifier in self._dirty:
+            vm_dir = os.path.join(self.usage_dir, f"vm{identifier}")
+            cpu_window = list(self.cpu[identifier])[-self.file_window:]
+            ram_window = list(self.ram[identifier])[-self.file_window:]
+            files[os.path.join(vm_dir, "cpu.txt")] = ",".join(str(val) for val in cpu_window)
+            files[os.path.join(vm_dir, "ram.txt")] = ",".join(str(val) for val in ram_window)
+            if identifier in self.details:
+                files[os.path.join(vm_dir, "telemetry.json")] = json.dumps(self.details[identifier])
+        samples = self._pending
+        self._dirty = set()
+        self._pending = []
+        return files, samples
+
+    def write_snapshot(self, files, samples):
+        """
+        Writes a snapshot produced by take_snapshot() to disk.
+        """
+        for path, content in files.items():
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            _write_atomic(path, content)
+        if not samples:
+            return
+        if self.store is not None:
+            # The binary store only takes numeric VM ids.
+            self.store.append_many(s for s in samples if s[1].isdigit())
+        if self.log_file:
+            with open(self.log_file, "a") as log_file:
+                log_file.write("".join(f"{vm}_{cpu}_{ram}\n" for _, vm, cpu, ram in samples))
+
+    def flush(self):
+        """
+        Writes all pending samples to disk.
+        """
+        self.write_snapshot(*self.take_snapshot())
+
+
+def parse_sample(line):
+    """
+    Parses one newline-terminated message, either version 1 ([id, cpu, ram]) or a
+    version 2 object ({"v": 2, "id", "cpu", "ram", ...}).
+    Returns a usage dict ({"id", "cpu", "ram"}, plus "details" for version 2), or
+    None if the message is malformed.
+    """
+    try:
+        raw = json.loads(line)
+    except json.JSONDecodeError:
+        print("[!] Invalid JSON:", line)
+        return None
+
+    if isinstance(raw, dict):
+        version = raw.get("v")
+        if version not in SCHEMA_VERSIONS:
+            print(f"[!] Unsupported telemetry version {version!r}")
+            return None
+        try:
+            return {
+                "id": raw["id"],
+                "cpu": float(raw["cpu"]),
+                "ram": float(raw["ram"]),
+                "details": {field: raw[field] for field in DETAIL_FIELDS if field in raw}
+            }
+        except Exception as e:
+            print(f"[!] Failed to parse {raw}: {e}")
+            return None
+
+    if not isinstance(raw, list) or len(raw) != 3:
+        print(f"[!] Unexpected format: {raw}")
+        return None
+
+    try:
+        identifier, cpu_val, ram_val = raw
+        return {
+            "id": identifier,
+            "cpu": float(cpu_val),
+            "ram": float(ram_val)
+        }
+    except Exception as e:
+        print(f"[!] Failed to parse {raw}: {e}")
+        return None
+
+
+async def handle_client(ingester, reader, writer):
     """
     Handles communication with a connected client.
-    Receives newline-terminated JSON messages and passes parsed usage data to process_usage_list.
+    Receives newline-terminated JSON messages and passes parsed usage data to the ingester.
     """
+    addr = writer.get_extra_info('peername')
     print(f"[✓] Connected by {addr}")
     try:
-        with conn.makefile('r') as sockfile:
-            for raw_line in sockfile:
-                line = raw_line.strip()
-                if not line:
-                    continue
-
-                try:
-                    raw_list = json.loads(line)
-                except json.JSONDecodeError:
-                    print("[!] Invalid JSON:", line)
-                    continue
-
-                if not isinstance(raw_list, list) or len(raw_list) != 3:
-                    print(f"[!] Unexpected format: {raw_list}")
-                    continue
-
-                try:
-                    identifier, cpu_val, ram_val = raw_list
-                    usage_list = [{
-                        "id": identifier,
-                        "cpu": float(cpu_val),
-                        "ram": float(ram_val)
-                    }]
-                except Exception as e:
-                    print(f"[!] Failed to parse {raw_list}: {e}")
-                    continue
-
-                process_usage_list(usage_list)
+        while True:
+            raw_line = await reader.readline()
+            if not raw_line:
+                break
+            line = raw_line.decode(errors="replace").strip()
+            if not line:
+                continue
+            usage = parse_sample(line)
+            if usage is not None:
+                ingester.process_usage_list([usage])
     except Exception as e:
         print(f"[!] Error handling client {addr}: {e}")
     finally:
-        conn.close()
+        writer.close()
+
 
-def accept_connections(server_socket):
+async def flush_periodically(ingester, interval):
     """
-    Loops on accept() and spawns a new thread to handle each incoming client.
+    Flushes the ingester to disk every `interval` seconds. File I/O runs in a
+    worker thread so it never stalls the event loop.
     """
+    loop = asyncio.get_running_loop()
     while True:
+        await asyncio.sleep(interval)
+        snapshot = ingester.take_snapshot()
         try:
-            conn, addr = server_socket.accept()
-            client_thread = threading.Thread(target=handle_client, args=(conn, addr))
-            client_thread.daemon = True
-            client_thread.start()
+            await loop.run_in_executor(None, ingester.write_snapshot, *snapshot)
         except Exception as e:
-            print(f"[!] Exception in accept_connections: {e}")
-            break
+            print(f"[!] Error flushing telemetry: {e}")
+
+
+def load_vm_ports(config):
+    """
+    Returns {VM name: listening port} for the VMs of the cluster config. Each VM
+    gets its own port (its monitor_port); VMs without one are not monitored.
+    """
+    vm_ports = {}
+    for vm in config["vms"]:
+        if "monitor_port" in vm:
+            vm_ports[vm["name"]] = int(vm["monitor_port"])
+        else:
+            print(f"[!] {vm['name']} has no monitor_port in the cluster config, not monitoring it")
+    return vm_ports
+
+
+async def serve(vm_ports=None, host=HOST, flush_interval=FLUSH_INTERVAL, ingester=None):
+    """
+    Listens on every port in vm_ports ({VM name: port}, by default one per VM of the
+    cluster config) and ingests samples until cancelled. If the ingester has a
+    publisher, the metric feed is served on FEED_HOST:FEED_PORT too.
+    """
+    if vm_ports is None:
+        vm_ports = load_vm_ports(load_cluster_config())
+    if ingester is None:
+        ingester = TelemetryIngester(log_file=LOG_FILE if WRITE_TEXT_LOG else None,
+                                     store=MetricStore(), publisher=MetricPublisher())
+    servers = []
+    if ingester.publisher is not None:
+        servers.append(await asyncio.start_server(ingester.publisher.handle_subscriber, FEED_HOST, FEED_PORT))
+        print(f"[✓] Publishing samples on {FEED_HOST}:{FEED_PORT}…")
+    for name, port in vm_ports.items():
+        server = await asyncio.start_server(
+            lambda r, w: handle_client(ingester, r, w), host, port)
+        servers.append(server)
+        print(f"[✓] Listening for {name} on {host}:{port}…")
+
+    flusher = asyncio.create_task(flush_periodically(ingester, flush_interval))
+    try:
+        await asyncio.gather(*(server.serve_forever() for server in servers))
+    finally:
+        flusher.cancel()
+        for server in servers:
+            server.close()
+        ingester.flush()
+
 
 def main():
-    HOST = '0.0.0.0'
-    PORT_VM1 = 9876  # Dedicated port for VM1
-    PORT_VM2 = 9877  # Dedicated port for VM2
-
-    # Create server socket for VM1.
-    server_socket_vm1 = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server_socket_vm1.bind((HOST, PORT_VM1))
-    server_socket_vm1.listen()
-    print(f"[✓] Listening for VM1 on {HOST}:{PORT_VM1}…")
-
-    # Create server socket for VM2.
-    server_socket_vm2 = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server_socket_vm2.bind((HOST, PORT_VM2))
-    server_socket_vm2.listen()
-    print(f"[✓] Listening for VM2 on {HOST}:{PORT_VM2}…")
-
-    # Start a thread to accept connections on VM1's socket.
-    t1 = threading.Thread(target=accept_connections, args=(server_socket_vm1,))
-    t1.daemon = True
-    t1.start()
-    print(f"[✓] Accept thread for VM1 started.")
-
-    # Start a thread to accept connections on VM2's socket.
-    t2 = threading.Thread(target=accept_connections, args=(server_socket_vm2,))
-    t2.daemon = True
-    t2.start()
-    print(f"[✓] Accept thread for VM2 started.")
-
-    # Keep the main thread running.
     try:
-        while True:
-            time.sleep(1)
+        asyncio.run(serve())
     except KeyboardInterrupt:
         print("\n[✓] Shutting down servers...")
-        server_socket_vm1.close()
-        server_socket_vm2.close()
+
 
 if __name__ == "__main__":
     main()
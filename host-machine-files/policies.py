@@ -0,0 +1,232 @@
+import random
+import time
+
+
+class TargetStats:
+    """
+    Everything a policy knows about one candidate target at decision time.
+
+    Attributes:
+        name (str): Target name, e.g. "VM1".
+        cpu (list): Recent CPU usage samples (%), oldest first.
+        ram (list): Recent RAM usage samples (%), oldest first.
+        in_flight (int): Requests of the operation currently being processed by the target.
+        ewma_latency (float or None): Smoothed request latency in seconds, None if unknown.
+        forecast_cpu (float or None): Predicted CPU usage (%) a few seconds ahead (see
+            load_estimator.py), None if there is no recent history.
+    """
+
+    def __init__(self, name, cpu=None, ram=None, in_flight=0, ewma_latency=None, forecast_cpu=None):
+        self.name = name
+        self.cpu = cpu or []
+        self.ram = ram or []
+        self.in_flight = in_flight
+        self.ewma_latency = ewma_latency
+        self.forecast_cpu = forecast_cpu
+
+    @property
+    def avg_cpu(self):
+        return compute_average(self.cpu)
+
+    @property
+    def avg_ram(self):
+        return compute_average(self.ram)
+
+    @property
+    def load(self):
+        """
+        CPU signal the policies compare: the forecast if there is one, else the average.
+        """
+        return self.avg_cpu if self.forecast_cpu is None else self.forecast_cpu
+
+    def __repr__(self):
+        return (f"TargetStats({self.name!r}, cpu={self.avg_cpu:.1f}, ram={self.avg_ram:.1f}, "
+                f"in_flight={self.in_flight}, ewma_latency={self.ewma_latency}, "
+                f"forecast_cpu={self.forecast_cpu})")
+
+
+def compute_average(values):
+    """
+    Computes the average of a list of numbers.
+    Returns 0 if the list is empty.
+    """
+    if not values:
+        return 0.0
+    return sum(values) / len(values)
+
+
+class Policy:
+    """
+    Base class for load-balancing policies.
+
+    A policy picks one target out of a non-empty list of TargetStats. Whether the
+    work should spill over to Cloud Run is decided separately by the caller.
+    """
+
+    name = "base"
+
+    def choose(self, candidates):
+        raise NotImplementedError
+
+    def __repr__(self):
+        return f"{type(self).__name__}()"
+
+
+class LowestCpuPolicy(Policy):
+    """
+    Picks the target with the lowest CPU load (forecast, or average over the recent
+    samples). This is the original load balancer behaviour.
+    """
+
+    name = "lowest_cpu"
+
+    def choose(self, candidates):
+        return min(candidates, key=lambda t: t.load)
+
+
+class LeastOutstandingPolicy(Policy):
+    """
+    Picks the target with the fewest requests in flight, breaking ties on CPU.
+    """
+
+    name = "least_outstanding"
+
+    def choose(self, candidates):
+        return min(candidates, key=lambda t: (t.in_flight, t.load))
+
+
+class PowerOfTwoPolicy(Policy):
+    """
+    Samples two targets at random and keeps the one with fewer requests in flight
+    (then lower CPU). Avoids every client herding onto the same "best" target.
+    """
+
+    name = "power_of_two"
+
+    def __init__(self, seed=None):
+        self._rng = random.Random(seed)
+
+    def choose(self, candidates):
+        if len(candidates) < 2:
+            return candidates[0]
+        a, b = self._rng.sample(candidates, 2)
+        return min((a, b), key=lambda t: (t.in_flight, t.load))
+
+
+class EwmaLatencyPolicy(Policy):
+    """
+    Picks the target with the lowest expected wait: smoothed latency times the
+    number of requests it would be serving. Targets without a latency estimate
+    yet are tried first, so every target gets measured.
+    """
+
+    name = "ewma_latency"
+
+    def choose(self, candidates):
+        unmeasured = [t for t in candidates if t.ewma_latency is None]
+        if unmeasured:
+            return min(unmeasured, key=lambda t: (t.in_flight, t.load))
+        return min(candidates, key=lambda t: t.ewma_latency * (t.in_flight + 1))
+
+
+class WeightedScorePolicy(Policy):
+    """
+    Picks the target with the lowest weighted score of CPU load, average RAM and
+    requests in flight. Useful for memory-hungry jobs such as BLIP captioning.
+    """
+
+    name = "weighted"
+
+    def __init__(self, cpu_weight=0.5, ram_weight=0.5, in_flight_weight=0.0):
+        self.cpu_weight = cpu_weight
+        self.ram_weight = ram_weight
+        self.in_flight_weight = in_flight_weight
+
+    def score(self, target):
+        return (self.cpu_weight * target.load
+                + self.ram_weight * target.avg_ram
+                + self.in_flight_weight * target.in_flight)
+
+    def choose(self, candidates):
+        return min(candidates, key=self.score)
+
+    def __repr__(self):
+        return (f"WeightedScorePolicy(cpu_weight={self.cpu_weight}, ram_weight={self.ram_weight}, "
+                f"in_flight_weight={self.in_flight_weight})")
+
+
+class SpillGuard:
+    """
+    Hysteresis and cooldown for the spill-over decision of one operation.
+
+    A VM becomes "hot" once its load goes above spill_cpu, and only cools down again
+    once its load is below spill_cpu - margin and it has been hot for at least
+    cooldown seconds. This stops the decision flapping between a VM and GCP while
+    the load hovers around the threshold.
+    """
+
+    def __init__(self, spill_cpu, margin=5.0, cooldown=10.0):
+        self.spill_cpu = spill_cpu
+        self.margin = margin
+        self.cooldown = cooldown
+        self._hot_since = {}
+
+    def is_hot(self, target, now=None):
+        """
+        Updates and returns the hot state of a target (a TargetStats).
+        """
+        now = time.monotonic() if now is None else now
+        since = self._hot_since.get(target.name)
+        if since is None:
+            if target.load > self.spill_cpu:
+                self._hot_since[target.name] = now
+                return True
+            return False
+        if target.load < self.spill_cpu - self.margin and now - since >= self.cooldown:
+            self._hot_since.pop(target.name, None)
+            return False
+        return True
+
+    def __repr__(self):
+        return f"SpillGuard(spill_cpu={self.spill_cpu}, margin={self.margin}, cooldown={self.cooldown})"
+
+
+def decide(policy, spill_cpu, candidates, max_in_flight=None, guard=None):
+    """
+    Lets the policy pick a VM and spills over to "GCP" if that VM's CPU load is above
+    spill_cpu. VMs that already have max_in_flight requests in flight are not
+    considered; if no VM is left, the request goes to GCP as well.
+
+    With a SpillGuard, hot VMs are left out instead, so the policy picks among the
+    VMs that have room and the request only spills over when none is left.
+    """
+    if guard is not None:
+        now = time.monotonic()
+        candidates = [t for t in candidates if not guard.is_hot(t, now)]
+    if max_in_flight is not None:
+        candidates = [t for t in candidates if t.in_flight < max_in_flight]
+    if not candidates:
+        return "GCP"
+    selected = policy.choose(candidates)
+    if guard is None and selected.load > spill_cpu:
+        return "GCP"
+    return selected.name
+
+
+POLICIES = {
+    cls.name: cls
+    for cls in (LowestCpuPolicy, LeastOutstandingPolicy, PowerOfTwoPolicy,
+                EwmaLatencyPolicy, WeightedScorePolicy)
+}
+
+
+def make_policy(name, **params):
+    """
+    Builds a policy by its registered name, passing params to its constructor.
+    """
+    try:
+        cls = POLICIES[name]
+    except KeyError:
+        raise ValueError(f"Unknown load-balancing policy {name!r}; "
+                         f"choose one of {', '.join(sorted(POLICIES))}") from None
+    return cls(**params)
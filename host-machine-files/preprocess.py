@@ -0,0 +1,101 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image, ImageOps
+
+# Longest side, in pixels, each operation needs from its input. BLIP resizes to
+# 384x384 and U^2-Net works at 320x320, so anything larger only costs upload time;
+# the sketch keeps more detail since its output is the image itself.
+MAX_SIDE = {
+    "sketch": 1600,
+    "bg_remove": 1024,
+    "caption": 768,
+}
+# Re-encoding settings for the prepared image (every service decodes JPEG).
+PREPARED_FORMAT = "JPEG"
+PREPARED_QUALITY = 90
+# Number of processes resizing and re-encoding images (Pillow work is CPU bound).
+PREPROCESS_WORKERS = max(1, min(4, os.cpu_count() or 1))
+# The workers are started by a fork server instead of being forked from this process:
+# it is multi-threaded (Streamlit, the job queue, the routing server), and a forked
+# child would inherit locks held by other threads and the listening sockets.
+START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def preprocess_params(operation):
+    """
+    Returns the settings that affect the prepared image, e.g. to include in a cache key.
+    """
+    return {"max_side": MAX_SIDE[operation], "format": PREPARED_FORMAT, "quality": PREPARED_QUALITY}
+
+
+def prepare_image(input_path, output_path, max_side, fmt=PREPARED_FORMAT, quality=PREPARED_QUALITY):
+    """
+    Downscales an image so its longest side is at most max_side and re-encodes it.
+
+    The camera's EXIF orientation is applied first, and transparency is flattened onto
+    white (as the services do anyway). The result is only written if it is smaller
+    than the original.
+
+    Returns:
+        tuple: (original size in bytes, size to upload in bytes, True if output_path was written).
+    """
+    original_size = os.path.getsize(input_path)
+    with Image.open(input_path) as img:
+        # For JPEGs, decode at a reduced scale (still at least max_side) straight away.
+        img.draft("RGB", (max_side, max_side))
+        img = ImageOps.exif_transpose(img)
+        if img.mode in ("RGBA", "LA", "P"):
+            img = img.convert("RGBA")
+            background = Image.new("RGB", img.size, (255, 255, 255))
+            background.paste(img, mask=img.getchannel("A"))
+            img = background
+        elif img.mode != "RGB":
+            img = img.convert("RGB")
+        # Keeps the aspect ratio and never upscales.
+        img.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+        tmp_path = f"{output_path}.tmp"
+        img.save(tmp_path, format=fmt, quality=quality, optimize=True)
+    prepared_size = os.path.getsize(tmp_path)
+    if prepared_size >= original_size:
+        os.remove(tmp_path)
+        return original_size, original_size, False
+    os.replace(tmp_path, output_path)
+    return original_size, prepared_size, True
+
+
+def _pool_executor():
+    # Created on first use, from whichever job queue worker gets there first.
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=PREPROCESS_WORKERS,
+                                        mp_context=multiprocessing.get_context(START_METHOD))
+        return _pool
+
+
+def prepare_images(operation, pairs):
+    """
+    Prepares several images in the process pool.
+
+    Parameters:
+        operation (str): Selects the maximum size (see MAX_SIDE).
+        pairs (list): (input path, output path) pairs.
+
+    Returns:
+        list: One prepare_image() result per pair, or the Exception that made it fail
+        (the original should then be sent as is).
+    """
+    max_side = MAX_SIDE[operation]
+    futures = [_pool_executor().submit(prepare_image, src, dst, max_side) for src, dst in pairs]
+    results = []
+    for future in futures:
+        try:
+            results.append(future.result())
+        except Exception as e:
+            results.append(e)
+    return results
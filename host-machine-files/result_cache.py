@@ -0,0 +1,187 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+from collections import OrderedDict
+
+# Directory holding cached results, and the most it may grow to before old entries go.
+CACHE_DIR = "cache"
+CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+
+def content_hash(data):
+    """
+    Returns the SHA-256 hex digest of an uploaded image's bytes.
+    """
+    return hashlib.sha256(data).hexdigest()
+
+
+def cache_key(digest, operation, params=None):
+    """
+    Builds the cache key of one job from the image's content hash, the operation and
+    its parameters (e.g. {"quality": "fast"}), so the same photo sketched with
+    different settings is cached separately.
+    """
+    material = json.dumps([operation, params or {}, digest], sort_keys=True)
+    return hashlib.sha256(material.encode()).hexdigest()
+
+
+class ResultCache:
+    """
+    Size-bounded LRU cache of processed results on local disk.
+
+    Each result is one file named after its key. The in-memory index (an OrderedDict
+    of key -> size, least recently used first) is rebuilt from the directory at
+    startup, ordered by modification time. Hits, misses and evictions are counted.
+    """
+
+    def __init__(self, root=CACHE_DIR, max_bytes=CACHE_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._index = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(root, exist_ok=True)
+        self._load_index()
+
+    def _path(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def _load_index(self):
+        entries = []
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                if name.endswith(".tmp"):
+                    os.remove(path)
+                    continue
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, name, stat.st_size))
+        for _, key, size in sorted(entries):
+            self._index[key] = size
+            self._bytes += size
+        self._evict()
+
+    def _evict(self):
+        # Caller holds the lock (or is the constructor).
+        while self._bytes > self.max_bytes and self._index:
+            key, size = self._index.popitem(last=False)
+            self._bytes -= size
+            self.evictions += 1
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+    def _lookup(self, key):
+        with self._lock:
+            if key not in self._index:
+                self.misses += 1
+                return None
+            self._index.move_to_end(key)
+            self.hits += 1
+            path = self._path(key)
+        try:
+            # Refresh the mtime so the LRU order survives a restart.
+            os.utime(path)
+        except FileNotFoundError:
+            self._forget(key)
+            return None
+        return path
+
+    def _forget(self, key):
+        # The file of a hit was removed behind our back (e.g. evicted by another
+        # thread after _lookup): forget it and count a miss instead.
+        with self._lock:
+            size = self._index.pop(key, None)
+            if size is not None:
+                self._bytes -= size
+            self.hits -= 1
+            self.misses += 1
+
+    def get_file(self, key, output_path):
+        """
+        On a hit, places the cached result at output_path (hard link if possible, copy
+        otherwise) and returns True. Returns False on a miss.
+        """
+        path = self._lookup(key)
+        if path is None:
+            return False
+        try:
+            if os.path.exists(output_path):
+                os.remove(output_path)
+            os.link(path, output_path)
+        except FileNotFoundError:
+            self._forget(key)
+            return False
+        except OSError:
+            try:
+                shutil.copyfile(path, output_path)
+            except FileNotFoundError:
+                self._forget(key)
+                return False
+        return True
+
+    def get_text(self, key):
+        """
+        Returns the cached text result (e.g. a caption), or None on a miss.
+        """
+        path = self._lookup(key)
+        if path is None:
+            return None
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return f.read()
+        except FileNotFoundError:
+            self._forget(key)
+            return None
+
+    def _store(self, key, write):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        write(tmp_path)
+        size = os.path.getsize(tmp_path)
+        if size > self.max_bytes:
+            os.remove(tmp_path)
+            return
+        os.replace(tmp_path, path)
+        with self._lock:
+            previous = self._index.pop(key, None)
+            if previous is not None:
+                self._bytes -= previous
+            self._index[key] = size
+            self._bytes += size
+            self._evict()
+
+    def put_file(self, key, source_path):
+        """
+        Stores a copy of a processed file under the key.
+        """
+        self._store(key, lambda tmp_path: shutil.copyfile(source_path, tmp_path))
+
+    def put_text(self, key, text):
+        """
+        Stores a text result under the key.
+        """
+        def write(tmp_path):
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(text)
+        self._store(key, write)
+
+    def stats(self):
+        """
+        Returns the hit/miss/eviction counters and the current size of the cache.
+        """
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._index),
+                "bytes": self._bytes,
+            }
@@ -0,0 +1,358 @@
+import http.client
+import json
+import os
+import socket
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs, urlencode
+
+# Address of the local routing decision API served by load_balancer.py.
+ROUTING_HOST = "127.0.0.1"
+ROUTING_PORT = 8765
+
+# Legacy file handshake, kept so older readers keep working.
+CHOICE_FILE = "choice.txt"
+
+# Smoothing factor of the per-target latency EWMA (weight of the newest sample).
+LATENCY_ALPHA = 0.3
+
+
+class RoutingState:
+    """
+    Holds the load balancer's current routing decisions in memory.
+
+    There is one decision per operation (plus a default for callers that do not
+    name one). Every change of decision bumps a version counter, so readers can tell
+    whether the value they hold is stale without comparing strings.
+
+    The backend also reports when requests start and finish, which gives the
+    policies the number of requests in flight and a smoothed latency per
+    (operation, target): each operation has its own service on a VM, and its own
+    max_in_flight. With a chooser set, acquire() picks a target for one
+    request at submit time and counts it as in flight in the same step.
+
+    With a breaker_factory set, finish reports that say whether the request
+    succeeded also feed one circuit breaker per (operation, target), created on
+    first use; target_available() tells whether its breaker lets requests through.
+    """
+
+    def __init__(self, choice="GCP", chooser=None, breaker_factory=None):
+        # Re-entrant, so the chooser can call target_stats() from inside acquire().
+        self._lock = threading.RLock()
+        self.chooser = chooser
+        self._default = choice
+        self._decisions = {}
+        self._version = 0
+        self._updated = time.time()
+        self._in_flight = {}
+        self._latency = {}
+        self.breaker_factory = breaker_factory
+        self._breakers = {}
+
+    def publish(self, choice, operation=None):
+        """
+        Stores a new decision for an operation (or the default decision if operation
+        is None). Returns the version number after the update.
+        """
+        with self._lock:
+            current = self._default if operation is None else self._decisions.get(operation)
+            if choice != current:
+                if operation is None:
+                    self._default = choice
+                else:
+                    self._decisions[operation] = choice
+                self._version += 1
+            self._updated = time.time()
+            return self._version
+
+    def snapshot(self, operation=None):
+        """
+        Returns a dict with the current choice for the operation, the version and when
+        the decisions were last confirmed.
+        """
+        with self._lock:
+            choice = self._decisions.get(operation, self._default)
+            return {"choice": choice, "version": self._version, "updated": self._updated}
+
+    def acquire(self, operation, exclude=()):
+        """
+        Picks a target for one request of the given operation and marks it in flight.
+        Targets in exclude (e.g. ones that already failed this request) are avoided
+        when the chooser has any alternative. Without a chooser, the last published
+        decision for the operation is used.
+
+        Returns (target, trial): trial is True if the request is the trial of the
+        target's half-open circuit breaker, and must be passed back to
+        request_finished().
+        """
+        with self._lock:
+            if self.chooser is not None:
+                target = self.chooser(operation, exclude)
+            else:
+                target = self._decisions.get(operation, self._default)
+            key = (operation, target)
+            self._in_flight[key] = self._in_flight.get(key, 0) + 1
+            breaker = self._breakers.get(key)
+            trial = breaker is not None and breaker.admit()
+            return target, trial
+
+    def choose(self, operation):
+        """
+        Returns the target the chooser picks for the operation right now, without
+        counting a request in flight (e.g. for the published decisions). Runs under
+        the same lock as acquire(), since choosing updates the policies' state.
+        """
+        with self._lock:
+            return self.chooser(operation, ())
+
+    def request_started(self, operation, target):
+        with self._lock:
+            key = (operation, target)
+            self._in_flight[key] = self._in_flight.get(key, 0) + 1
+
+    def request_finished(self, operation, target, latency=None, ok=None, trial=False):
+        with self._lock:
+            key = (operation, target)
+            self._in_flight[key] = max(self._in_flight.get(key, 0) - 1, 0)
+            if ok is not None and self.breaker_factory is not None:
+                if key not in self._breakers:
+                    self._breakers[key] = self.breaker_factory()
+                breaker = self._breakers[key]
+                was = breaker.state
+                breaker.record(ok, trial=trial)
+                if breaker.state != was:
+                    print(f"Circuit breaker of {target} for {operation}: {was} -> {breaker.state}")
+            if latency is not None:
+                previous = self._latency.get(key)
+                if previous is None:
+                    self._latency[key] = latency
+                else:
+                    self._latency[key] = LATENCY_ALPHA * latency + (1 - LATENCY_ALPHA) * previous
+
+    def target_stats(self, operation, target):
+        """
+        Returns (requests of the operation in flight, smoothed latency or None) for a
+        target.
+        """
+        with self._lock:
+            key = (operation, target)
+            return self._in_flight.get(key, 0), self._latency.get(key)
+
+    def target_available(self, operation, target):
+        """
+        Returns False while the circuit breaker of (operation, target) is open.
+        """
+        with self._lock:
+            breaker = self._breakers.get((operation, target))
+            return breaker is None or breaker.allow()
+
+    def breaker_states(self):
+        """
+        Returns {"<operation>/<target>": breaker state} for every breaker created so far.
+        """
+        with self._lock:
+            return {f"{op}/{target}": breaker.state for (op, target), breaker in self._breakers.items()}
+
+
+def _make_handler(state):
+    class RoutingHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def _send_json(self, data):
+            body = json.dumps(data).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            parts = urlsplit(self.path)
+            if parts.path.rstrip("/") not in ("", "/choice"):
+                self.send_error(404)
+                return
+            operation = parse_qs(parts.query).get("op", [None])[0]
+            self._send_json(state.snapshot(operation))
+
+        def do_POST(self):
+            path = self.path.rstrip("/")
+            if path not in ("/report", "/acquire"):
+                self.send_error(404)
+                return
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                report = json.loads(self.rfile.read(length))
+                if path == "/acquire":
+                    target, trial = state.acquire(report["op"], tuple(report.get("exclude") or ()))
+                    self._send_json({"target": target, "trial": trial})
+                    return
+                if report["event"] == "start":
+                    state.request_started(report.get("op"), report["target"])
+                else:
+                    state.request_finished(report.get("op"), report["target"], report.get("latency"),
+                                           report.get("ok"), bool(report.get("trial")))
+            except (ValueError, KeyError, TypeError):
+                self.send_error(400)
+                return
+            self._send_json({"ok": True})
+
+        def log_message(self, format, *args):
+            # Polled many times per second; keep the console quiet.
+            pass
+
+    return RoutingHandler
+
+
+def serve_routing_state(state, host=ROUTING_HOST, port=ROUTING_PORT):
+    """
+    Starts the routing decision API in a daemon thread and returns the server.
+      - GET /choice?op=<operation> returns {"choice": ..., "version": ..., "updated": ...}.
+      - POST /acquire takes {"op": ..., "exclude": [targets to avoid]} and returns
+        {"target": ..., "trial": true|false}, counting the request in flight; "trial"
+        marks the trial request of a half-open circuit breaker.
+      - POST /report takes {"event": "start"|"finish", "op": ..., "target": ..., "latency": ...,
+        "ok": true|false, "trial": true|false}; "ok" feeds the target's circuit breaker
+        and may be left out, "trial" echoes the value /acquire returned.
+    """
+    server = ThreadingHTTPServer((host, port), _make_handler(state))
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def write_choice_file(choice, path=CHOICE_FILE):
+    """
+    Atomically replaces the legacy choice file, so readers never see a truncated value.
+    """
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(choice)
+    os.replace(tmp_path, path)
+
+
+def read_choice_file(path=CHOICE_FILE):
+    """
+    Reads the legacy choice file. Returns None if it is missing or empty.
+    """
+    try:
+        with open(path, "r") as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+
+class RoutingClient:
+    """
+    Reads the routing decision from the local API over a kept-alive connection.
+
+    Each thread keeps its own connection, since http.client connections are not
+    thread-safe. If the API is unreachable the legacy choice file is used, and if
+    that fails too the default target is returned.
+    """
+
+    def __init__(self, host=ROUTING_HOST, port=ROUTING_PORT, timeout=0.5,
+                 fallback_path=CHOICE_FILE, default="GCP"):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.fallback_path = fallback_path
+        self.default = default
+        self._local = threading.local()
+
+    def _connection(self):
+        """
+        Returns (this thread's connection, True if it was used before).
+        """
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            return conn, True
+        conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        conn.connect()
+        conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._local.conn = conn
+        return conn, False
+
+    def _drop_connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def _request(self, method, path, body=None):
+        """
+        Sends one request over this thread's connection and returns the decoded JSON
+        reply. Raises on any failure.
+        """
+        # A kept-alive connection may have been closed by the server while idle; only
+        # then is the request retried, on a fresh connection. Any other failure (e.g.
+        # a timeout) may come after the server applied the request, and a retry would
+        # count an /acquire or /report twice.
+        for attempt in range(2):
+            try:
+                conn, reused = self._connection()
+                headers = {"Content-Type": "application/json"} if body is not None else {}
+                conn.request(method, path, body=body, headers=headers)
+                response = conn.getresponse()
+                data = response.read()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                self._drop_connection()
+                if reused and attempt == 0:
+                    continue
+                raise
+            except (OSError, http.client.HTTPException):
+                self._drop_connection()
+                raise
+            if response.status != 200:
+                raise http.client.HTTPException(f"HTTP {response.status}")
+            return json.loads(data)
+
+    def snapshot(self, operation=None):
+        """
+        Returns the decision as a dict with "choice" and "version" keys.
+        The version is None when the value came from the fallback file or the default.
+        """
+        path = "/choice" if operation is None else f"/choice?{urlencode({'op': operation})}"
+        try:
+            return self._request("GET", path)
+        except (OSError, http.client.HTTPException, ValueError):
+            choice = read_choice_file(self.fallback_path)
+            return {"choice": choice or self.default, "version": None}
+
+    def get(self, operation=None):
+        """
+        Returns the current routing choice for the operation ("VM1", "VM2", ... or "GCP").
+        """
+        return self.snapshot(operation)["choice"]
+
+    def acquire(self, operation, exclude=None):
+        """
+        Asks the load balancer for a target for one request, chosen at submit time
+        and counted as in flight until report("finish", ...) is sent. Targets in
+        exclude are avoided if possible. Falls back to the last published decision
+        if the balancer cannot be reached.
+
+        Returns (target, trial); trial must be passed back with report("finish", ...).
+        """
+        body = json.dumps({"op": operation, "exclude": list(exclude or ())})
+        try:
+            reply = self._request("POST", "/acquire", body)
+            return reply["target"], bool(reply.get("trial"))
+        except (OSError, http.client.HTTPException, ValueError, KeyError):
+            return self.get(operation), False
+
+    def report(self, event, target, operation=None, latency=None, ok=None, trial=False):
+        """
+        Tells the load balancer that a request to target started or finished, and for
+        a finished request whether the target served it (ok) or failed it, and whether
+        it was a circuit breaker's trial request (as returned by acquire()).
+        Failures are ignored: accounting is best-effort and must not break dispatch.
+        """
+        body = json.dumps({"event": event, "op": operation, "target": target, "latency": latency,
+                           "ok": ok, "trial": trial})
+        try:
+            self._request("POST", "/report", body)
+        except (OSError, http.client.HTTPException, ValueError):
+            pass
@@ -0,0 +1,350 @@
+"""
+Micro-benchmarks of the per-operation image kernels, stage by stage.
+
+    sketch:  decode, dodge (sharpen + colour dodge + equalize), denoise, encode,
+             for every quality preset (see sketch-app/sketch.py)
+    rembg:   decode, inference, composite, encode (the remove_background() path of
+             remove-bg/app.py, with the session of remove-bg/rembg_session.py)
+    caption: decode, preprocess (BlipProcessor), generate, decode text, for every
+             selected inference backend (see caption-service/backends.py)
+
+Every kernel is swept over image sizes, input/output formats and thread counts, and
+the median and minimum time of every stage and of the whole call are written as
+JSON. Two result files can be compared, e.g. before and after a commit; a stage
+whose median got slower by more than the threshold is flagged, so a change like
+the NL-means step suddenly dominating sketch latency shows up as a "denoise"
+regression rather than a vague "sketch got slower".
+
+Runs offline: the test images are vm-files/input.png (or a generated image with
+--source synthetic) resized to each size, and the BLIP weights must already be in
+the local Hugging Face cache (or CAPTION_MODEL must point at a local copy).
+
+Usage:
+    python benchmark.py run sketch --sizes 0.3,2,12 --threads 1,4 --json before.json
+    python benchmark.py run sketch rembg caption --sizes all --formats jpeg,png,webp
+    python benchmark.py run caption --caption-backends torch,int8,onnx --threads 1,2,4
+    python benchmark.py compare before.json after.json --threshold 0.1
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+import cv2
+import numpy as np
+
+VM_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(VM_DIR, "sketch-app"))
+sys.path.insert(0, os.path.join(VM_DIR, "caption-service"))
+sys.path.insert(0, os.path.join(VM_DIR, "remove-bg"))
+
+import sketch  # noqa: E402
+
+# Image sizes in megapixels; "--sizes all" runs every one of them.
+ALL_SIZES = (0.3, 1, 2, 6, 12, 24)
+DEFAULT_SIZES = (0.3, 2, 12)
+FORMATS = ("jpeg", "png", "webp")
+SOURCE_IMAGE = os.path.join(VM_DIR, "input.png")
+CAPTION_MODEL = os.environ.get("CAPTION_MODEL", "Salesforce/blip-image-captioning-base")
+# Every case runs at least once after one warm-up, then repeats until REPEAT runs or
+# BUDGET seconds, whichever comes first (NL-means on 24 MP takes tens of seconds).
+REPEAT = 5
+BUDGET = 10.0
+# Differences below this many seconds are noise, whatever the ratio.
+MIN_REGRESSION_SECONDS = 0.005
+
+
+# ---- Test images ----
+
+def synthetic_image(width, height, seed=0):
+    """
+    Returns a BGR image with gradients, shapes and noise, roughly like a photo for
+    the codecs and the denoiser.
+    """
+    rng = np.random.default_rng(seed)
+    x = np.linspace(0, 255, width, dtype=np.float32)
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+    image = np.stack([np.broadcast_to(x, (height, width)), np.broadcast_to(y, (height, width)),
+                      (x + y) / 2], axis=-1).astype(np.uint8)
+    for _ in range(30):
+        center = (int(rng.integers(width)), int(rng.integers(height)))
+        radius = int(rng.integers(max(2, min(width, height) // 20), max(3, min(width, height) // 4)))
+        cv2.circle(image, center, radius, [int(c) for c in rng.integers(0, 256, 3)], -1)
+    noise = rng.normal(0, 8, image.shape)
+    return np.clip(image + noise, 0, 255).astype(np.uint8)
+
+
+def test_image(megapixels, source):
+    """
+    Returns a BGR image of about `megapixels`, with the aspect ratio of input.png.
+    """
+    base = cv2.imread(SOURCE_IMAGE) if source == "input" else None
+    aspect = base.shape[1] / base.shape[0] if base is not None else 4 / 3
+    height = int(round((megapixels * 1e6 / aspect) ** 0.5))
+    width = int(round(height * aspect))
+    if base is None:
+        return synthetic_image(width, height)
+    return cv2.resize(base, (width, height), interpolation=cv2.INTER_CUBIC)
+
+
+# ---- Timing ----
+
+def measure(stages, repeat=REPEAT, budget=BUDGET):
+    """
+    Runs a pipeline of (stage name, function) pairs, each taking the previous one's
+    output (the first takes None), once to warm up and then up to `repeat` times
+    within `budget` seconds. Returns {stage: [seconds, ...]} plus "total".
+    """
+    def run_once():
+        value = None
+        times = {}
+        for name, fn in stages:
+            start = time.perf_counter()
+            value = fn(value)
+            times[name] = time.perf_counter() - start
+        times["total"] = sum(times.values())
+        return times
+
+    run_once()
+    timings = {}
+    deadline = time.monotonic() + budget
+    for _ in range(repeat):
+        for name, seconds in run_once().items():
+            timings.setdefault(name, []).append(seconds)
+        if time.monotonic() > deadline:
+            break
+    return timings
+
+
+def summarize(case, timings):
+    """
+    Returns one result row per stage of a case.
+    """
+    rows = []
+    total = statistics.median(timings["total"])
+    for stage, times in timings.items():
+        median = statistics.median(times)
+        rows.append(dict(case, stage=stage, median_s=round(median, 6), min_s=round(min(times), 6),
+                         runs=len(times), share=round(median / total, 3) if total else None))
+    return rows
+
+
+def print_rows(rows):
+    for row in rows:
+        if row["stage"] == "total":
+            stages = ", ".join(f"{r['stage']} {100 * r['share']:.0f}%" for r in rows if r["stage"] != "total")
+            print(f"  {row['kernel']:<8}{row['variant']:<10}{row['megapixels']:>6} MP {row['format']:<5}"
+                  f"{row['threads']:>3} threads: {row['median_s'] * 1000:9.1f} ms  ({stages})")
+
+
+# ---- Kernels ----
+
+def bench_sketch(images, threads, args):
+    rows = []
+    for n in threads:
+        cv2.setNumThreads(n)
+        for (megapixels, fmt), data in images.items():
+            for quality in sketch.QUALITY_PRESETS:
+                stages = [
+                    ("decode", lambda _: sketch.decode_image(data)),
+                    ("dodge", sketch.dodge_sketch),
+                    ("denoise", lambda grainy: sketch.denoise(grainy, quality)),
+                    ("encode", lambda result: sketch.encode_image(result, fmt)),
+                ]
+                case = {"kernel": "sketch", "variant": quality, "megapixels": megapixels,
+                        "format": fmt, "threads": n}
+                case_rows = summarize(case, measure(stages, args.repeat, args.budget))
+                print_rows(case_rows)
+                rows += case_rows
+    return rows
+
+
+def bench_rembg(images, threads, args):
+    from PIL import Image
+    from rembg import remove
+    from rembg_session import PNG_COMPRESS_LEVEL, REMBG_MODEL, create_session
+
+    # Same session options and PNG settings as the service.
+    rows = []
+    for n in threads:
+        session = create_session(intra_op_threads=n)
+
+        def composite(output):
+            visible = Image.new("RGB", output.size, (255, 255, 255))
+            visible.paste(output, mask=output.getchannel("A"))
+            return visible
+
+        def encode(visible):
+            buffer = io.BytesIO()
+            visible.save(buffer, format="PNG", compress_level=PNG_COMPRESS_LEVEL)
+            return buffer.getvalue()
+
+        for (megapixels, fmt), data in images.items():
+            stages = [
+                ("decode", lambda _: Image.open(io.BytesIO(data)).convert("RGB")),
+                ("inference", lambda img: remove(img, session=session)),
+                ("composite", composite),
+                ("encode", encode),
+            ]
+            case = {"kernel": "rembg", "variant": REMBG_MODEL, "megapixels": megapixels,
+                    "format": fmt, "threads": n}
+            case_rows = summarize(case, measure(stages, args.repeat, args.budget))
+            print_rows(case_rows)
+            rows += case_rows
+    return rows
+
+
+def bench_caption(images, threads, args):
+    import torch
+    from PIL import Image
+    from transformers import BlipProcessor, BlipForConditionalGeneration
+    from backends import load_backend
+
+    processor = BlipProcessor.from_pretrained(CAPTION_MODEL, local_files_only=True)
+    rows = []
+    for name in args.caption_backends.split(","):
+        model = BlipForConditionalGeneration.from_pretrained(CAPTION_MODEL, local_files_only=True).eval()
+        backend = load_backend(name, model)
+        for n in threads:
+            torch.set_num_threads(n)
+            if name == "onnx":
+                # ONNX Runtime sizes its thread pool per session; the exported files are reused.
+                backend = load_backend(name, model, intra_op_threads=n)
+            for (megapixels, fmt), data in images.items():
+                stages = [
+                    ("decode", lambda _: Image.open(io.BytesIO(data)).convert("RGB")),
+                    ("preprocess", lambda img: processor(images=img, return_tensors="pt")["pixel_values"]),
+                    ("generate", backend.generate),
+                    ("decode_text", lambda out: processor.batch_decode(out, skip_special_tokens=True)),
+                ]
+                case = {"kernel": "caption", "variant": name, "megapixels": megapixels,
+                        "format": fmt, "threads": n}
+                case_rows = summarize(case, measure(stages, args.repeat, args.budget))
+                print_rows(case_rows)
+                rows += case_rows
+    return rows
+
+
+KERNELS = {"sketch": bench_sketch, "rembg": bench_rembg, "caption": bench_caption}
+
+
+def environment():
+    """
+    Returns what the numbers depend on: machine, library versions and git commit.
+    Call it after the benchmarks, so the versions of the libraries they loaded are included.
+    """
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=VM_DIR, capture_output=True,
+                                text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {
+        "commit": commit,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "python": platform.python_version(),
+        "opencv": cv2.__version__,
+        "numpy": np.__version__,
+        **{name: getattr(sys.modules[name], "__version__", None)
+           for name in ("PIL", "onnxruntime", "rembg", "torch", "transformers") if name in sys.modules},
+    }
+
+
+def run(args):
+    sizes = ALL_SIZES if args.sizes == "all" else tuple(float(s) for s in args.sizes.split(","))
+    formats = args.formats.split(",")
+    threads = [int(n) for n in args.threads.split(",")] if args.threads else sorted({1, os.cpu_count() or 1})
+    print("Preparing test images...")
+    images = {}
+    for megapixels in sizes:
+        image = test_image(megapixels, args.source)
+        for fmt in formats:
+            images[(megapixels, fmt)] = sketch.encode_image(image, fmt)
+
+    results = []
+    for kernel in args.kernels:
+        print(f"{kernel}:")
+        results += KERNELS[kernel](images, threads, args)
+    report = {"environment": environment(), "source": args.source, "results": results}
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.json}")
+    return report
+
+
+def _key(row):
+    return (row["kernel"], row["variant"], row["megapixels"], row["format"], row["threads"], row["stage"])
+
+
+def compare(args):
+    """
+    Prints the median of every stage in both result files and flags regressions.
+    Returns the number of regressions.
+    """
+    with open(args.before) as f:
+        before = json.load(f)
+    with open(args.after) as f:
+        after = json.load(f)
+    old = {_key(row): row for row in before["results"]}
+    regressions = 0
+    print(f"{before['environment'].get('commit')} -> {after['environment'].get('commit')}")
+    for key in ("machine", "cpu_count", "opencv"):
+        if before["environment"].get(key) != after["environment"].get(key):
+            print(f"Warning: {key} differs ({before['environment'].get(key)} vs {after['environment'].get(key)})")
+    if before.get("source") != after.get("source"):
+        print(f"Warning: test images differ ({before.get('source')} vs {after.get('source')})")
+    for row in after["results"]:
+        previous = old.get(_key(row))
+        if previous is None:
+            continue
+        ratio = row["median_s"] / previous["median_s"] if previous["median_s"] else float("inf")
+        slower = (ratio > 1 + args.threshold
+                  and row["median_s"] - previous["median_s"] > MIN_REGRESSION_SECONDS)
+        regressions += slower
+        if slower or args.verbose:
+            kernel, variant, megapixels, fmt, threads, stage = _key(row)
+            print(f"{'REGRESSION' if slower else '':<11}{kernel:<8}{variant:<10}{megapixels:>6} MP {fmt:<5}"
+                  f"{threads:>3} threads {stage:<12}{previous['median_s'] * 1000:9.1f} ms -> "
+                  f"{row['median_s'] * 1000:9.1f} ms ({ratio:.2f}x, share {row['share']:.0%})")
+    print(f"{regressions} regressions above {args.threshold:.0%}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Micro-benchmarks of the image kernels.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run", help="run benchmarks")
+    run_parser.add_argument("kernels", nargs="+", choices=sorted(KERNELS))
+    run_parser.add_argument("--sizes", default=",".join(str(s) for s in DEFAULT_SIZES),
+                            help="comma-separated megapixels, or 'all' for " + ",".join(map(str, ALL_SIZES)))
+    run_parser.add_argument("--formats", default="jpeg", help="comma-separated: " + ",".join(FORMATS))
+    run_parser.add_argument("--threads", help="comma-separated thread counts (default: 1 and all cores)")
+    run_parser.add_argument("--caption-backends", default="torch",
+                            help="comma-separated caption backends: torch, int8, onnx")
+    run_parser.add_argument("--source", choices=("input", "synthetic"), default="input",
+                            help="resize input.png, or generate the test images")
+    run_parser.add_argument("--repeat", type=int, default=REPEAT)
+    run_parser.add_argument("--budget", type=float, default=BUDGET, help="seconds per case")
+    run_parser.add_argument("--json", metavar="PATH", help="write the results as JSON")
+    compare_parser = commands.add_parser("compare", help="compare two result files")
+    compare_parser.add_argument("before")
+    compare_parser.add_argument("after")
+    compare_parser.add_argument("--threshold", type=float, default=0.1, help="slowdown flagged (0.1 = 10%%)")
+    compare_parser.add_argument("--verbose", action="store_true", help="print every stage, not only regressions")
+    args = parser.parse_args(argv)
+    if args.command == "run":
+        run(args)
+    else:
+        sys.exit(1 if compare(args) else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,205 @@
 from flask import Flask, request, jsonify
 from transformers import BlipProcessor, BlipForConditionalGeneration
-from PIL import Image
+from PIL import Image, UnidentifiedImageError
+from concurrent.futures import Future, TimeoutError
 import torch
-import io
+from backends import CAPTION_BACKEND, configure_threads, load_backend
+import os
+import queue
+import sys
 import threading
+import time
+
+# The shared vm-files/common package sits next to app.py in the Docker image, and one
+# level up when the service is run from the repository.
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.request_stats import RequestStats  # noqa: E402
 
 app = Flask(__name__)
 
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+# The int8 and onnx backends are CPU-only.
+device = torch.device("cuda" if torch.cuda.is_available() and CAPTION_BACKEND == "torch" else "cpu")
+# Size PyTorch's thread pools to the VM before the model first runs (see backends.py).
+configure_threads()
+
+# Where the BLIP weights come from: a local directory (the Docker image bakes them
+# into /app/model at build time, see save_model.py), or a Hugging Face model id that
+# is downloaded on first start.
+CAPTION_MODEL = os.environ.get("CAPTION_MODEL", "Salesforce/blip-image-captioning-base")
+_local_model = os.path.isdir(CAPTION_MODEL)
+
+blip_processor = BlipProcessor.from_pretrained(CAPTION_MODEL, local_files_only=_local_model)
+# The backend owns the model: int8 quantizes it in place, onnx only needs it to export
+# its ONNX files the first time and lets it go.
+caption_backend = load_backend(CAPTION_BACKEND, BlipForConditionalGeneration.from_pretrained(
+    CAPTION_MODEL, local_files_only=_local_model, low_cpu_mem_usage=True).to(device).eval())
+print(f"Captioning with {caption_backend!r} ({torch.get_num_threads()} threads)")
+
+# Micro-batching: requests waiting for the model are grouped into one generate() call.
+# A batch is run as soon as it is full or the oldest request has waited MAX_WAIT_MS.
+MAX_BATCH_SIZE = int(os.environ.get("CAPTION_MAX_BATCH_SIZE", "8"))
+MAX_WAIT_MS = float(os.environ.get("CAPTION_MAX_WAIT_MS", "25"))
+# Seconds a request may wait for its captions before the service gives up on it and
+# answers 504 (/batch reports the unfinished images as errors). It is below the
+# host's 120 s socket timeout, so the host sees the failure and can fail over.
+REQUEST_TIMEOUT = float(os.environ.get("REQUEST_TIMEOUT", "60"))
+
+
+class CaptionBatcher:
+    """
+    Background inference worker that captions images in micro-batches.
+
+    Request threads preprocess their own image and call submit(), which blocks until
+    the worker has run the batch containing it. The worker is the only thread that
+    touches the model, so no lock is needed around generate().
+    """
+
+    def __init__(self, max_batch_size=MAX_BATCH_SIZE, max_wait_ms=MAX_WAIT_MS):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit_async(self, pixel_values):
+        """
+        Queues one preprocessed image (pixel_values of shape [1, 3, H, W]) and returns
+        a Future that resolves to its caption.
+        """
+        future = Future()
+        self._queue.put((pixel_values, future))
+        return future
+
+    def pending(self):
+        """
+        Returns the number of images waiting for a batch.
+        """
+        return self._queue.qsize()
+
+    def submit(self, pixel_values, timeout=None):
+        """
+        Like submit_async(), but blocks until the caption is ready. Raises TimeoutError
+        after timeout seconds; the image is then dropped if its batch has not started.
+        """
+        return self.wait(self.submit_async(pixel_values), timeout)
+
+    @staticmethod
+    def wait(future, timeout=None):
+        """
+        Returns the caption of a future from submit_async(), waiting at most timeout
+        seconds. On timeout the future is cancelled, so the worker skips it, and
+        TimeoutError is raised.
+        """
+        try:
+            return future.result(timeout)
+        except TimeoutError:
+            future.cancel()
+            raise
+
+    def _collect(self):
+        # Block for the first request, then gather more until the batch is full
+        # or the wait budget of the first request is spent.
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            # Requests that timed out while queued were cancelled; they are not run.
+            batch = [(values, future) for values, future in self._collect()
+                     if future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            futures = [future for _, future in batch]
+            try:
+                pixel_values = torch.cat([values for values, _ in batch]).to(device)
+                out = caption_backend.generate(pixel_values)
+                captions = blip_processor.batch_decode(out, skip_special_tokens=True)
+                for future, caption in zip(futures, captions):
+                    future.set_result(caption)
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+
+
+batcher = CaptionBatcher()
+
+
+# ---- Warm-up ----
+# The first generate() call is much slower than the next ones (lazy initialisation in
+# torch and transformers). One caption of a blank image is run at startup, and
+# GET /ready only answers 200 once it is done, so no user request pays for it.
+# If the warm-up caption fails, the model is broken: /ready keeps answering 503 (with
+# the error), so the host routes no captions here.
+WARM_UP = os.environ.get("CAPTION_WARM_UP", "1") != "0"
+ready = threading.Event()
+warm_up_error = None
 
-blip_processor = BlipProcessor.from_pretrained("Salesforce/blip-image-captioning-base")
-blip_model = BlipForConditionalGeneration.from_pretrained("Salesforce/blip-image-captioning-base").to(device)
-blip_model.eval()
 
-model_lock = threading.Lock()
+def warm_up():
+    global warm_up_error
+    started = time.perf_counter()
+    try:
+        image = Image.new("RGB", (384, 384), (127, 127, 127))
+        batcher.submit(blip_processor(images=image, return_tensors="pt")["pixel_values"])
+    except Exception as e:
+        warm_up_error = str(e)
+        print(f"Warm-up caption failed, not reporting ready: {e}")
+        return
+    print(f"Warm-up caption done in {time.perf_counter() - started:.1f}s")
+    ready.set()
+
+
+if WARM_UP:
+    threading.Thread(target=warm_up, daemon=True).start()
+else:
+    ready.set()
+
+
+# ---- Request counters, served on GET /stats for the VM's monitor.py ----
+request_stats = RequestStats(queue_depth=batcher.pending)
+
+
+app.wsgi_app = request_stats.wrap(app.wsgi_app)
+
+
+@app.route('/health', methods=['GET'])
+def health():
+    """
+    Liveness probe for the host's health checker (see host-machine-files/health.py).
+    """
+    return jsonify({"status": "ok"})
+
+
+@app.route('/ready', methods=['GET'])
+def readiness():
+    """
+    Readiness probe: 503 until the warm-up caption has succeeded, then 200; it stays
+    503 if the warm-up failed. The host's health checker probes this endpoint for the
+    caption service, and it can be used as the Cloud Run startup probe.
+    """
+    if warm_up_error is not None:
+        return jsonify({"status": "failed", "error": warm_up_error}), 503
+    if not ready.is_set():
+        return jsonify({"status": "warming_up"}), 503
+    return jsonify({"status": "ready"})
+
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    """
+    Returns the request counters and recent latency percentiles (in ms) as JSON.
+    """
+    return jsonify(request_stats.snapshot())
+
 
 @app.route('/caption', methods=['POST'])
 def generate_caption():
@@ -21,15 +207,60 @@ def generate_caption():
         return jsonify({"error": "No image uploaded"}), 400
 
     file = request.files['image']
-    image = Image.open(file.stream).convert("RGB")
-
-    inputs = blip_processor(images=image, return_tensors="pt").to(device)
+    try:
+        image = Image.open(file.stream).convert("RGB")
+    except (UnidentifiedImageError, OSError) as e:
+        # A bad upload is the client's fault: a 5xx would make the host fail over
+        # and count it against this target's circuit breaker.
+        return jsonify({"error": f"Could not decode image: {e}"}), 400
 
-    with model_lock:
-        out = blip_model.generate(**inputs)
-    caption = blip_processor.decode(out[0], skip_special_tokens=True)
+    # Preprocessing runs in the request thread, in parallel with other requests.
+    inputs = blip_processor(images=image, return_tensors="pt")
+    try:
+        caption = batcher.submit(inputs["pixel_values"], timeout=REQUEST_TIMEOUT)
+    except TimeoutError:
+        return jsonify({"error": f"Timed out after {REQUEST_TIMEOUT:g}s"}), 504
 
     return jsonify({"caption": caption})
 
+
+@app.route('/batch', methods=['POST'])
+def generate_caption_batch():
+    """
+    Captions every image of the multipart "images" field. All images are queued at
+    once, so they share micro-batches; images not captioned within REQUEST_TIMEOUT get
+    an error. Returns
+    {"results": [{"name": <input file name>, "caption": ...} or {"name": ..., "error": ...}]}
+    in input order.
+    """
+    files = request.files.getlist('images')
+    if not files:
+        return jsonify({"error": "No images uploaded"}), 400
+    deadline = time.monotonic() + REQUEST_TIMEOUT
+
+    pending = []
+    for index, file in enumerate(files):
+        name = os.path.basename(file.filename or f"image_{index}")
+        try:
+            image = Image.open(file.stream).convert("RGB")
+            inputs = blip_processor(images=image, return_tensors="pt")
+            pending.append((name, batcher.submit_async(inputs["pixel_values"]), None))
+        except Exception as e:
+            pending.append((name, None, str(e)))
+
+    results = []
+    for name, future, error in pending:
+        if future is not None:
+            try:
+                caption = batcher.wait(future, max(0, deadline - time.monotonic()))
+                results.append({"name": name, "caption": caption})
+                continue
+            except TimeoutError:
+                error = f"Timed out after {REQUEST_TIMEOUT:g}s"
+            except Exception as e:
+                error = str(e)
+        results.append({"name": name, "error": error})
+    return jsonify({"results": results})
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=8081, threaded=True)
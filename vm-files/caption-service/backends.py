@@ -0,0 +1,299 @@
+"""
+Inference backends for BLIP captioning on CPU.
+
+    torch  the fp32 PyTorch model (the original behaviour, and the reference)
+    int8   the same model with its Linear layers dynamically quantized to int8
+    onnx   ONNX Runtime sessions of the vision encoder and of one text decoder
+           step, driven by a greedy decoding loop
+
+Every backend takes a batch of preprocessed pixel_values and returns token ids for
+BlipProcessor.batch_decode(). Run this module to compare the backends' captions
+and speed against the fp32 baseline:
+
+    python backends.py parity --backends int8,onnx ../input.png photos/*.jpg
+    python backends.py export /app/model/onnx     # export the ONNX files ahead of time
+"""
+import difflib
+import inspect
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+
+# Which backend the service uses: "torch", "int8" or "onnx".
+CAPTION_BACKEND = os.environ.get("CAPTION_BACKEND", "torch")
+# Threads used inside one operator (matrix multiply, ...) and to run independent
+# operators in parallel. The service runs one generate() at a time, so by default
+# it gets every core and the graph runs sequentially.
+INTRA_OP_THREADS = int(os.environ.get("CAPTION_INTRA_OP_THREADS", str(os.cpu_count() or 1)))
+INTER_OP_THREADS = int(os.environ.get("CAPTION_INTER_OP_THREADS", "1"))
+# Where the ONNX files are exported to (on first use) and loaded from.
+ONNX_DIR = os.environ.get("CAPTION_ONNX_DIR", "onnx")
+ONNX_OPSET = 17
+
+
+def configure_threads(intra_op_threads=INTRA_OP_THREADS, inter_op_threads=INTER_OP_THREADS):
+    """
+    Sets PyTorch's thread pools. Call it before the model runs for the first time:
+    the inter-op pool can only be sized once per process.
+    """
+    torch.set_num_threads(intra_op_threads)
+    try:
+        torch.set_num_interop_threads(inter_op_threads)
+    except RuntimeError:
+        print("PyTorch inter-op threads were already set; keeping the current pool.")
+
+
+class TorchBackend:
+    """
+    Runs model.generate() of the PyTorch model as is.
+    """
+
+    name = "torch"
+
+    def __init__(self, model):
+        self.model = model
+
+    def generate(self, pixel_values):
+        with torch.inference_mode():
+            return self.model.generate(pixel_values=pixel_values)
+
+    def __repr__(self):
+        return f"{type(self).__name__}()"
+
+
+class Int8Backend(TorchBackend):
+    """
+    Dynamic int8 quantization of every Linear layer (weights stored as int8,
+    activations quantized on the fly). Most of BLIP's time on CPU is spent in these
+    layers, and the weights take a quarter of the memory. The model is quantized in
+    place.
+    """
+
+    name = "int8"
+
+    def __init__(self, model):
+        super().__init__(torch.ao.quantization.quantize_dynamic(
+            model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True))
+
+
+class _VisionEncoder(torch.nn.Module):
+    def __init__(self, vision_model):
+        super().__init__()
+        self.vision_model = vision_model
+
+    def forward(self, pixel_values):
+        return self.vision_model(pixel_values=pixel_values)[0]
+
+
+class _DecoderStep(torch.nn.Module):
+    # Logits of the next token for every sequence, given the tokens so far.
+    def __init__(self, text_decoder):
+        super().__init__()
+        self.text_decoder = text_decoder
+
+    def forward(self, input_ids, encoder_hidden_states):
+        output = self.text_decoder(input_ids=input_ids, encoder_hidden_states=encoder_hidden_states,
+                                   return_dict=True)
+        return output.logits[:, -1, :]
+
+
+def _onnx_export(module, args, path, **kwargs):
+    # Newer PyTorch releases default to the dynamo exporter; the TorchScript one
+    # handles these modules and needs no extra packages.
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        kwargs["dynamo"] = False
+    tmp_path = f"{path}.tmp"
+    torch.onnx.export(module, args, tmp_path, opset_version=ONNX_OPSET, **kwargs)
+    os.replace(tmp_path, path)
+
+
+def export_onnx(model, onnx_dir=ONNX_DIR):
+    """
+    Exports the vision encoder and one text decoder step of a BLIP model to
+    onnx_dir/vision.onnx and onnx_dir/decoder.onnx.
+    """
+    os.makedirs(onnx_dir, exist_ok=True)
+    model = model.to("cpu").eval()
+    size = model.config.vision_config.image_size
+    pixel_values = torch.zeros(1, 3, size, size)
+    vision = _VisionEncoder(model.vision_model)
+    with torch.no_grad():
+        image_embeds = vision(pixel_values)
+    _onnx_export(vision, (pixel_values,), os.path.join(onnx_dir, "vision.onnx"),
+                 input_names=["pixel_values"], output_names=["image_embeds"],
+                 dynamic_axes={"pixel_values": {0: "batch"}, "image_embeds": {0: "batch"}})
+    input_ids = torch.full((1, 2), model.config.text_config.bos_token_id, dtype=torch.long)
+    _onnx_export(_DecoderStep(model.text_decoder), (input_ids, image_embeds),
+                 os.path.join(onnx_dir, "decoder.onnx"),
+                 input_names=["input_ids", "encoder_hidden_states"], output_names=["logits"],
+                 dynamic_axes={"input_ids": {0: "batch", 1: "sequence"},
+                               "encoder_hidden_states": {0: "batch"}, "logits": {0: "batch"}})
+    print(f"Exported the BLIP encoder and decoder to {onnx_dir}")
+
+
+class OnnxBackend:
+    """
+    ONNX Runtime sessions of the vision encoder and the text decoder, with the same
+    greedy decoding as BLIP's generate(): start from the BOS token, append the most
+    likely token until every caption has produced SEP or max_length is reached.
+
+    The decoder has no key/value cache, so every step re-reads the whole (short)
+    caption so far. The files are exported from the model on first use.
+    """
+
+    name = "onnx"
+
+    def __init__(self, model, onnx_dir=ONNX_DIR, intra_op_threads=INTRA_OP_THREADS,
+                 inter_op_threads=INTER_OP_THREADS):
+        import onnxruntime as ort
+
+        vision_path = os.path.join(onnx_dir, "vision.onnx")
+        decoder_path = os.path.join(onnx_dir, "decoder.onnx")
+        if not (os.path.exists(vision_path) and os.path.exists(decoder_path)):
+            export_onnx(model, onnx_dir)
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = intra_op_threads
+        options.inter_op_num_threads = inter_op_threads
+        options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        providers = ["CPUExecutionProvider"]
+        self.vision = ort.InferenceSession(vision_path, options, providers=providers)
+        self.decoder = ort.InferenceSession(decoder_path, options, providers=providers)
+        text_config = model.config.text_config
+        self.bos_token_id = text_config.bos_token_id
+        self.eos_token_id = text_config.sep_token_id
+        self.pad_token_id = text_config.pad_token_id
+        self.max_length = model.generation_config.max_length or 20
+
+    def generate(self, pixel_values):
+        pixel_values = pixel_values.detach().cpu().numpy().astype(np.float32)
+        image_embeds = self.vision.run(None, {"pixel_values": pixel_values})[0]
+        batch_size = pixel_values.shape[0]
+        input_ids = np.full((batch_size, 1), self.bos_token_id, dtype=np.int64)
+        finished = np.zeros(batch_size, dtype=bool)
+        while input_ids.shape[1] < self.max_length:
+            logits = self.decoder.run(None, {"input_ids": input_ids, "encoder_hidden_states": image_embeds})[0]
+            next_tokens = np.where(finished, self.pad_token_id, logits.argmax(axis=-1))
+            input_ids = np.concatenate([input_ids, next_tokens[:, None]], axis=1)
+            finished |= next_tokens == self.eos_token_id
+            if finished.all():
+                break
+        return input_ids
+
+    def __repr__(self):
+        return f"OnnxBackend(max_length={self.max_length})"
+
+
+BACKENDS = {cls.name: cls for cls in (TorchBackend, Int8Backend, OnnxBackend)}
+
+
+def load_backend(name, model, **params):
+    """
+    Builds a backend by name around a loaded BLIP model, passing params on.
+    """
+    try:
+        cls = BACKENDS[name]
+    except KeyError:
+        raise ValueError(f"Unknown caption backend {name!r}; "
+                         f"choose one of {', '.join(sorted(BACKENDS))}") from None
+    return cls(model, **params)
+
+
+# ---- Parity checks ----
+
+def caption_images(backend, processor, images):
+    """
+    Returns (captions, seconds per image) of a backend for a list of PIL images,
+    one image at a time, after one warm-up run.
+    """
+    pixel_values = [processor(images=image, return_tensors="pt")["pixel_values"] for image in images]
+    backend.generate(pixel_values[0])
+    captions = []
+    started = time.perf_counter()
+    for values in pixel_values:
+        captions.append(processor.batch_decode(backend.generate(values), skip_special_tokens=True)[0].strip())
+    return captions, (time.perf_counter() - started) / len(images)
+
+
+def parity_report(name, captions, seconds, reference, reference_seconds):
+    """
+    Compares a backend's captions with the fp32 reference: exact matches, mean word
+    similarity (difflib ratio, 1.0 = identical) and speed-up.
+    """
+    similarity = [difflib.SequenceMatcher(None, a.split(), b.split()).ratio()
+                  for a, b in zip(captions, reference)]
+    return {
+        "backend": name,
+        "images": len(captions),
+        "exact_match_rate": round(sum(a == b for a, b in zip(captions, reference)) / len(captions), 3),
+        "word_similarity": round(sum(similarity) / len(similarity), 3),
+        "seconds_per_image": round(seconds, 4),
+        "speedup": round(reference_seconds / seconds, 2) if seconds else None,
+        "mismatches": [{"reference": b, "caption": a} for a, b in zip(captions, reference) if a != b],
+    }
+
+
+def test_images(paths):
+    """
+    Opens the given images, or input.png plus a few variations of it (mirrored,
+    grayscale, cropped) if there are none.
+    """
+    from PIL import Image, ImageOps
+
+    if paths:
+        return [Image.open(path).convert("RGB") for path in paths]
+    base = Image.open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "input.png")).convert("RGB")
+    width, height = base.size
+    return [base, ImageOps.mirror(base), ImageOps.grayscale(base).convert("RGB"),
+            base.crop((0, 0, width // 2, height)), base.crop((width // 2, 0, width, height))]
+
+
+def main(argv=None):
+    import argparse
+    from transformers import BlipProcessor, BlipForConditionalGeneration
+
+    parser = argparse.ArgumentParser(description="BLIP inference backends.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    parity = commands.add_parser("parity", help="compare backends with the fp32 baseline")
+    parity.add_argument("images", nargs="*", help="images to caption (default: input.png and variations)")
+    parity.add_argument("--backends", default="int8,onnx")
+    parity.add_argument("--json", metavar="PATH", help="also write the report as JSON")
+    export = commands.add_parser("export", help="export the ONNX files")
+    export.add_argument("onnx_dir", nargs="?", default=ONNX_DIR)
+    args = parser.parse_args(argv)
+
+    model_name = os.environ.get("CAPTION_MODEL", "Salesforce/blip-image-captioning-base")
+    local = os.path.isdir(model_name)
+    processor = BlipProcessor.from_pretrained(model_name, local_files_only=local)
+
+    def load_model():
+        return BlipForConditionalGeneration.from_pretrained(model_name, local_files_only=local).eval()
+
+    if args.command == "export":
+        export_onnx(load_model(), args.onnx_dir)
+        return
+
+    configure_threads()
+    images = test_images(args.images)
+    reference, reference_seconds = caption_images(TorchBackend(load_model()), processor, images)
+    reports = []
+    for name in args.backends.split(","):
+        captions, seconds = caption_images(load_backend(name, load_model()), processor, images)
+        report = parity_report(name, captions, seconds, reference, reference_seconds)
+        reports.append(report)
+        print(f"{name}: {report['exact_match_rate']:.0%} identical captions, word similarity "
+              f"{report['word_similarity']:.3f}, {seconds * 1000:.0f} ms/image ({report['speedup']}x fp32)")
+        for mismatch in report["mismatches"]:
+            print(f"    fp32: {mismatch['reference']!r}\n    {name}: {mismatch['caption']!r}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"threads": [INTRA_OP_THREADS, INTER_OP_THREADS],
+                       "fp32_seconds_per_image": round(reference_seconds, 4), "backends": reports}, f, indent=2)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
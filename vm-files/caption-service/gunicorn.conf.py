@@ -0,0 +1,35 @@
+import os
+import sys
+
+# Production server settings, read by `gunicorn app:app` (the Dockerfile's command).
+# `python app.py` still starts Flask's development server.
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.request_stats import create_stats_dir, remove_stats_dir, remove_worker_stats  # noqa: E402
+
+CORES = os.cpu_count() or 1
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8081')}"
+# One worker: the micro-batcher only merges requests that reach the same process.
+workers = int(os.environ.get("WEB_CONCURRENCY", "1"))
+# Requests wait on the batcher in their thread; a full batch needs CAPTION_MAX_BATCH_SIZE.
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", "16"))
+# Not preloaded: the batcher and warm-up threads start at import and torch/onnxruntime
+# thread pools are not fork-safe, so each worker loads its own model.
+preload_app = False
+# Seconds without a heartbeat before the master kills a frozen worker. A gthread
+# worker keeps heartbeating while one of its requests hangs, so requests have their
+# own deadline (REQUEST_TIMEOUT in app.py).
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "120"))
+graceful_timeout = 30
+# Off by default: recycling the only worker leaves no ready worker until it warms up again.
+max_requests = int(os.environ.get("GUNICORN_MAX_REQUESTS", "0"))
+max_requests_jitter = max_requests // 10
+
+# Split the cores between the workers' inference threads.
+os.environ.setdefault("CAPTION_INTRA_OP_THREADS", str(max(1, CORES // workers)))
+
+# Every worker publishes its request counters to STATS_DIR, so /stats covers all of them.
+create_stats_dir("caption")
+child_exit = remove_worker_stats
+on_exit = remove_stats_dir
@@ -0,0 +1,20 @@
+import sys
+from transformers import BlipProcessor, BlipForConditionalGeneration
+
+MODEL_NAME = "Salesforce/blip-image-captioning-base"
+
+
+def save_model(target_dir, model_name=MODEL_NAME):
+    """
+    Downloads the BLIP processor and weights once and saves them to target_dir, the
+    weights as safetensors (memory-mapped on load, no unpickling), so the service can
+    start from CAPTION_MODEL=target_dir without touching the network.
+    """
+    BlipProcessor.from_pretrained(model_name).save_pretrained(target_dir)
+    model = BlipForConditionalGeneration.from_pretrained(model_name)
+    model.save_pretrained(target_dir, safe_serialization=True)
+    print(f"Saved {model_name} to {target_dir}")
+
+
+if __name__ == "__main__":
+    save_model(sys.argv[1] if len(sys.argv) > 1 else "model")
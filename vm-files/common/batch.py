@@ -0,0 +1,86 @@
+"""
+Helpers of the multi-image /batch endpoints, shared by sketch-app and remove-bg.
+"""
+import io
+import os
+import time
+import zipfile
+from concurrent.futures import TimeoutError, as_completed
+
+from flask import request
+
+
+class _ChunkBuffer(io.RawIOBase):
+    """
+    Write-only, unseekable buffer that zipfile can write into while we stream it out.
+    """
+
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._chunks.append(bytes(b))
+        return len(b)
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def stream_zip(named_results):
+    """
+    Yields a ZIP archive piece by piece, adding each (name, bytes) entry as it arrives.
+    """
+    buffer = _ChunkBuffer()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED) as archive:
+        for name, data in named_results:
+            archive.writestr(name, data)
+            yield buffer.drain()
+    yield buffer.drain()
+
+
+def read_batch_uploads(default_extension=".png"):
+    """
+    Returns [(name, bytes)] for every file in the "images" field of the current
+    request, with names made unique. Unnamed files get default_extension.
+    """
+    uploads = []
+    seen = set()
+    for index, file in enumerate(request.files.getlist('images')):
+        name = os.path.basename(file.filename or f"image_{index}{default_extension}")
+        if name in seen:
+            name = f"{index}_{name}"
+        seen.add(name)
+        uploads.append((name, file.read()))
+    return uploads
+
+
+def batch_results(futures, deadline):
+    """
+    Yields (name, bytes) for each future of {future: input name} as it completes, or
+    ("<name>.error.txt", message) if it failed. Futures still running at the deadline
+    (a time.monotonic() value) are cancelled and reported as timed out; a thread
+    already working on one cannot be stopped, but its result is no longer waited for.
+    """
+    pending = dict(futures)
+    try:
+        for future in as_completed(futures, timeout=max(0, deadline - time.monotonic())):
+            yield _batch_entry(pending.pop(future), future)
+    except TimeoutError:
+        for future, name in pending.items():
+            if future.done():
+                yield _batch_entry(name, future)
+            else:
+                future.cancel()
+                yield f"{name}.error.txt", b"Timed out"
+
+
+def _batch_entry(name, future):
+    try:
+        return name, future.result()
+    except Exception as e:
+        return f"{name}.error.txt", str(e).encode()
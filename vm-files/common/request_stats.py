@@ -0,0 +1,163 @@
+"""
+Request counters of a VM service, served on GET /stats for the VM's monitor.py.
+Shared by sketch-app, remove-bg and caption-service.
+"""
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import deque
+
+from werkzeug.wsgi import ClosingIterator
+
+# Number of recent request latencies the percentiles are computed from.
+LATENCY_WINDOW = 256
+# Under gunicorn every worker process counts its own requests. With STATS_DIR set
+# in the environment (see create_stats_dir()), each worker also publishes its
+# counters there and /stats adds up every worker's.
+# The probes and the counters themselves are not user requests.
+UNTRACKED_PATHS = ("/stats", "/health", "/ready")
+
+
+class RequestStats:
+    """
+    Counts the requests in progress, completed and failed, and keeps the latencies
+    of the most recent ones. A request counts as finished once its response body
+    has been sent, so streamed /batch responses are timed in full.
+
+    queue_depth() returns the number of images waiting inside the service.
+    """
+
+    def __init__(self, window=LATENCY_WINDOW, queue_depth=None, stats_dir=None):
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=window)
+        self.active = 0
+        self.completed = 0
+        self.errors = 0
+        self.queue_depth = queue_depth
+        # Read when the service creates it: gunicorn.conf.py imports this module in
+        # the master before it sets STATS_DIR.
+        self.stats_dir = stats_dir or os.environ.get("STATS_DIR")
+
+    def _state(self):
+        queued = self.queue_depth() if self.queue_depth is not None else 0
+        with self._lock:
+            return {"active": self.active, "queued": queued, "completed": self.completed,
+                    "errors": self.errors, "latencies": list(self._latencies)}
+
+    def _publish(self):
+        # Atomically replaces this worker's file, so readers never see half of it.
+        if self.stats_dir is None:
+            return
+        path = os.path.join(self.stats_dir, f"{os.getpid()}.json")
+        try:
+            with open(f"{path}.tmp", "w") as f:
+                json.dump(self._state(), f)
+            os.replace(f"{path}.tmp", path)
+        except OSError:
+            pass
+
+    def _other_workers(self):
+        states = []
+        if self.stats_dir is None:
+            return states
+        own = f"{os.getpid()}.json"
+        for name in os.listdir(self.stats_dir):
+            if name.endswith(".json") and name != own:
+                try:
+                    with open(os.path.join(self.stats_dir, name)) as f:
+                        states.append(json.load(f))
+                except (OSError, ValueError):
+                    pass
+        return states
+
+    def start(self):
+        with self._lock:
+            self.active += 1
+        self._publish()
+        return time.perf_counter()
+
+    def finish(self, started, ok):
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self.active -= 1
+            self.completed += 1
+            if not ok:
+                self.errors += 1
+            self._latencies.append(elapsed)
+        self._publish()
+
+    def wrap(self, wsgi_app):
+        """
+        Returns WSGI middleware that counts every request except UNTRACKED_PATHS.
+        """
+        def tracked_app(environ, start_response):
+            if environ.get("PATH_INFO") in UNTRACKED_PATHS:
+                return wsgi_app(environ, start_response)
+            started = self.start()
+            status = {}
+
+            def tracked_start_response(status_line, headers, exc_info=None):
+                status["code"] = int(status_line.split()[0])
+                return start_response(status_line, headers, exc_info)
+
+            try:
+                body = wsgi_app(environ, tracked_start_response)
+            except Exception:
+                self.finish(started, False)
+                raise
+            return ClosingIterator(body, lambda: self.finish(started, status.get("code", 500) < 500))
+        return tracked_app
+
+    def snapshot(self):
+        """
+        Returns the counters and latency percentiles of this process, plus those
+        published by the other workers.
+        """
+        states = [self._state()] + self._other_workers()
+        latencies = sorted(latency for state in states for latency in state["latencies"])
+        stats = {key: sum(state[key] for state in states) for key in ("active", "queued", "completed", "errors")}
+        stats["workers"] = len(states)
+
+        def percentile(q):
+            if not latencies:
+                return None
+            return round(latencies[min(int(q * len(latencies)), len(latencies) - 1)] * 1000, 1)
+
+        stats["p50_ms"] = percentile(0.5)
+        stats["p95_ms"] = percentile(0.95)
+        return stats
+
+
+# ---- gunicorn hooks, used by each service's gunicorn.conf.py ----
+
+def create_stats_dir(service):
+    """
+    Creates the directory the workers publish their counters to (in tmpfs when there
+    is one) and exports it as STATS_DIR to the workers. Called by the gunicorn master.
+    """
+    if "STATS_DIR" not in os.environ:
+        tmpfs = "/dev/shm" if os.path.isdir("/dev/shm") else None
+        os.environ["STATS_DIR"] = tempfile.mkdtemp(prefix=f"{service}-stats-", dir=tmpfs)
+    return os.environ["STATS_DIR"]
+
+
+def remove_worker_stats(server, worker):
+    """
+    child_exit hook: drops the counters of a worker that exited (recycled, timed out
+    or crashed), so /stats stops adding them up.
+    """
+    try:
+        os.remove(os.path.join(os.environ["STATS_DIR"], f"{worker.pid}.json"))
+    except (KeyError, OSError):
+        pass
+
+
+def remove_stats_dir(server):
+    """
+    on_exit hook: removes the STATS_DIR when the master shuts down.
+    """
+    if "STATS_DIR" in os.environ:
+        shutil.rmtree(os.environ["STATS_DIR"], ignore_errors=True)
@@ -2,9 +2,62 @@ import psutil
 import socket
 import time
 import json
+import os
+import urllib.request
+
+# Where parallel_monitor.py listens for this VM, and the id this VM reports as.
+HOST = os.environ.get("MONITOR_HOST", '192.168.56.1')
+PORT = int(os.environ.get("MONITOR_PORT", "9877"))
+VM_ID = os.environ.get("VM_ID", "2")
+
+# Version of the telemetry message. Version 1 was the bare list [id, cpu, ram].
+SCHEMA_VERSION = 2
+# Local ports of the services whose /stats counters are included in every message.
+SERVICES = {
+    "sketch": 8080,
+    "caption": 8081,
+    "bg_remove": 8082,
+}
+STATS_TIMEOUT = 0.2
+
+
+def service_stats(port):
+    """
+    Returns the /stats counters of the service on a local port, or None if it is down.
+    """
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/stats", timeout=STATS_TIMEOUT) as response:
+            return json.loads(response.read())
+    except Exception:
+        return None
+
+
+def build_message(cpu):
+    """
+    Builds one telemetry message (schema version 2):
+        {"v": 2, "id": ..., "ts": <unix time>, "cpu": %, "ram": %,
+         "ram_available_mb": ..., "load_avg": [1 min, 5 min, 15 min],
+         "services": {name: {"active", "queued", "completed", "errors",
+                             "p50_ms", "p95_ms"}, ...}}
+    Services that don't answer are left out of "services".
+    """
+    memory = psutil.virtual_memory()
+    services = {}
+    for name, port in SERVICES.items():
+        stats = service_stats(port)
+        if stats is not None:
+            services[name] = stats
+    return {
+        "v": SCHEMA_VERSION,
+        "id": VM_ID,
+        "ts": time.time(),
+        "cpu": cpu,
+        "ram": memory.percent,
+        "ram_available_mb": round(memory.available / (1024 * 1024), 1),
+        "load_avg": [round(value, 2) for value in psutil.getloadavg()],
+        "services": services,
+    }
 
-HOST = '192.168.56.1'  
-PORT = 9877           
 
 while True:
     try:
@@ -12,10 +65,9 @@ while True:
             s.connect((HOST, PORT))
             while True:
                 cpu = psutil.cpu_percent(interval=1)
-                ram = psutil.virtual_memory().percent
-                data_list=["2", cpu, ram]
-                print(data_list)
-                s.sendall(json.dumps(data_list).encode() + b'\n')
+                message = build_message(cpu)
+                print(message)
+                s.sendall(json.dumps(message).encode() + b'\n')
                 time.sleep(0.1)
     except Exception as e:
         print(f"[!] Reconnecting... {e}")
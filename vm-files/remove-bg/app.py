@@ -1,36 +1,134 @@
-from flask import Flask, request, send_file
+from flask import Flask, request, send_file, Response, jsonify
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
 from rembg import remove
-from PIL import Image
-import numpy as np
+from PIL import Image, UnidentifiedImageError
+from rembg_session import PNG_COMPRESS_LEVEL, create_session
 import io
+import os
+import sys
+import threading
+import time
+
+# The shared vm-files/common package sits next to app.py in the Docker image, and one
+# level up when the service is run from the repository.
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.batch import batch_results, read_batch_uploads, stream_zip  # noqa: E402
+from common.request_stats import RequestStats  # noqa: E402
 
 app = Flask(__name__)
 
-@app.route('/remove_bg', methods=['POST'])
-def remove_bg():
-    if 'image' not in request.files:
-        return "No image uploaded", 400
+# ---- Model session ----
+# The ONNX session (model and options in rembg_session.py) is created once at startup
+# and shared by every request.
+# How many inferences may run at once. Times ORT_INTRA_OP_THREADS, it should not exceed
+# the number of cores, or the runs just fight each other.
+MAX_CONCURRENT_INFERENCES = int(os.environ.get("MAX_CONCURRENT_INFERENCES", "1"))
+
+session = create_session()
+inference_slots = threading.BoundedSemaphore(MAX_CONCURRENT_INFERENCES)
+# Images waiting for an inference slot (reported as "queued" on /stats).
+waiting_for_inference = 0
+_waiting_lock = threading.Lock()
+
+# Images of one /batch request are processed in parallel. /remove_bg runs its image in
+# the same pool, so it can stop waiting at the deadline.
+BATCH_WORKERS = int(os.environ.get("BATCH_WORKERS", str(os.cpu_count() or 1)))
+batch_pool = ThreadPoolExecutor(max_workers=BATCH_WORKERS)
+# Seconds a request may take before the service gives up on it: /remove_bg answers 504,
+# and /batch reports the images still unfinished as errors. It is below the host's
+# 120 s socket timeout, so the host sees the failure and can fail over.
+REQUEST_TIMEOUT = float(os.environ.get("REQUEST_TIMEOUT", "60"))
+
+
+# ---- Request counters, served on GET /stats for the VM's monitor.py ----
+request_stats = RequestStats(queue_depth=lambda: waiting_for_inference)
+
+
+app.wsgi_app = request_stats.wrap(app.wsgi_app)
+
 
-    image = request.files['image']
-    input_path = 'input.png' 
-    output_path = 'output.png'  
+@app.route('/health', methods=['GET'])
+def health():
+    """
+    Liveness probe for the host's health checker (see host-machine-files/health.py).
+    """
+    return jsonify({"status": "ok"})
 
-    image.save(input_path)
 
-    img = Image.open(input_path).convert("RGB")
+@app.route('/stats', methods=['GET'])
+def stats():
+    """
+    Returns the request counters and recent latency percentiles (in ms) as JSON.
+    """
+    return jsonify(request_stats.snapshot())
 
-    output = remove(img)
 
-    white_bg = Image.new("RGB", output.size, (255, 255, 255))
-    visible_output = Image.alpha_composite(white_bg.convert("RGBA"), output.convert("RGBA"))
+def remove_background(stream):
+    """
+    Removes the background of the image read from a file-like object and returns the
+    result composited on white, encoded as PNG bytes. Raises ValueError if the image
+    cannot be decoded.
+    """
+    # Decoding straight from the stream also avoids sharing one input.png on disk
+    # between concurrent requests.
+    try:
+        img = Image.open(stream).convert("RGB")
+    except (UnidentifiedImageError, OSError) as e:
+        raise ValueError(f"Could not decode image: {e}") from e
 
-    output_array = np.array(visible_output)
+    # Decoding, compositing and encoding run in parallel; only inference is limited.
+    global waiting_for_inference
+    with _waiting_lock:
+        waiting_for_inference += 1
+    with inference_slots:
+        with _waiting_lock:
+            waiting_for_inference -= 1
+        output = remove(img, session=session)
+
+    # Paste the cut-out onto white using its alpha channel as the mask.
+    visible_output = Image.new("RGB", output.size, (255, 255, 255))
+    visible_output.paste(output, mask=output.getchannel("A"))
 
     buffer = io.BytesIO()
-    Image.fromarray(output_array).save(buffer, format="PNG")
+    visible_output.save(buffer, format="PNG", compress_level=PNG_COMPRESS_LEVEL)
+    return buffer.getvalue()
+
+
+@app.route('/remove_bg', methods=['POST'])
+def remove_bg():
+    if 'image' not in request.files:
+        return "No image uploaded", 400
+
+    future = batch_pool.submit(remove_background, io.BytesIO(request.files['image'].read()))
+    try:
+        buffer = io.BytesIO(future.result(timeout=REQUEST_TIMEOUT))
+    except TimeoutError:
+        future.cancel()
+        return f"Timed out after {REQUEST_TIMEOUT:g}s", 504
+    except ValueError as e:
+        return str(e), 400
     buffer.seek(0)
 
     return send_file(buffer, mimetype='image/png')
 
+
+@app.route('/batch', methods=['POST'])
+def remove_bg_batch():
+    """
+    Removes the background of every image of the multipart "images" field in parallel
+    and streams back a ZIP archive with one PNG entry per input, named after the input
+    file. An input that fails, or is not done within REQUEST_TIMEOUT, produces a
+    "<name>.error.txt" entry instead.
+    """
+    uploads = read_batch_uploads()
+    if not uploads:
+        return "No images uploaded", 400
+
+    deadline = time.monotonic() + REQUEST_TIMEOUT
+    futures = {batch_pool.submit(remove_background, io.BytesIO(data)): name for name, data in uploads}
+
+    return Response(stream_zip(batch_results(futures, deadline)), mimetype='application/zip',
+                    headers={"Content-Disposition": "attachment; filename=results.zip"})
+
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=8082)
\ No newline at end of file
+    app.run(host='0.0.0.0', port=8082)
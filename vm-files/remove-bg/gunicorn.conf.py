@@ -0,0 +1,35 @@
+import os
+import sys
+
+# Production server settings, read by `gunicorn app:app` (the Dockerfile's command).
+# `python app.py` still starts Flask's development server.
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.request_stats import create_stats_dir, remove_stats_dir, remove_worker_stats  # noqa: E402
+
+CORES = os.cpu_count() or 1
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8082')}"
+# One worker per two cores; each holds its own u2net session (about 170 MB).
+workers = int(os.environ.get("WEB_CONCURRENCY", str(max(1, CORES // 2))))
+# Threads decode and encode while another request of the worker is in inference.
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", "4"))
+# Not preloaded: an onnxruntime session is not fork-safe, so each worker loads its own.
+preload_app = False
+# Seconds without a heartbeat before the master kills a frozen worker. A gthread
+# worker keeps heartbeating while one of its requests hangs, so requests have their
+# own deadline (REQUEST_TIMEOUT in app.py).
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "120"))
+graceful_timeout = 30
+# Recycle workers after this many requests (with jitter) to bound onnxruntime's arena.
+max_requests = int(os.environ.get("GUNICORN_MAX_REQUESTS", "1000"))
+max_requests_jitter = max_requests // 10
+
+# Split the cores between the workers' inference threads. The /batch pools keep one
+# thread per core (BATCH_WORKERS' default) for decoding and encoding.
+os.environ.setdefault("ORT_INTRA_OP_THREADS", str(max(1, CORES // workers)))
+
+# Every worker publishes its request counters to STATS_DIR, so /stats covers all of them.
+create_stats_dir("remove-bg")
+child_exit = remove_worker_stats
+on_exit = remove_stats_dir
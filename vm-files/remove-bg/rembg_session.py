@@ -0,0 +1,28 @@
+import os
+
+import onnxruntime as ort
+from rembg.sessions import sessions_class
+
+# Model and onnxruntime settings of the remove-bg service. Importing this module only
+# reads them; the session is built by create_session(), so the benchmark can build its
+# own without starting the service.
+REMBG_MODEL = os.environ.get("REMBG_MODEL", "u2net")
+# onnxruntime threads used by one inference.
+ORT_INTRA_OP_THREADS = int(os.environ.get("ORT_INTRA_OP_THREADS", str(os.cpu_count() or 1)))
+# zlib level for the PNG result; 1 is much faster than the default 6 for a slightly larger file.
+PNG_COMPRESS_LEVEL = int(os.environ.get("PNG_COMPRESS_LEVEL", "1"))
+
+
+def create_session(model_name=REMBG_MODEL, intra_op_threads=ORT_INTRA_OP_THREADS):
+    """
+    Builds the rembg session with tuned onnxruntime options.
+    """
+    sess_opts = ort.SessionOptions()
+    sess_opts.intra_op_num_threads = intra_op_threads
+    sess_opts.inter_op_num_threads = 1
+    sess_opts.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+    sess_opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    for session_class in sessions_class:
+        if session_class.name() == model_name:
+            return session_class(model_name, sess_opts)
+    raise ValueError(f"Unknown rembg model {model_name!r}")
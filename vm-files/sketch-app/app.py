@@ -1,42 +1,156 @@
-from flask import Flask, request, send_file
-import tempfile
+from flask import Flask, request, send_file, Response, jsonify
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
 import os
 import io
-from sketch import sketchify
+import sys
+import threading
+import time
+from sketch import sketchify_bytes, QUALITY_PRESETS, DEFAULT_QUALITY, OUTPUT_FORMATS, DEFAULT_FORMAT
+
+# The shared vm-files/common package sits next to app.py in the Docker image, and one
+# level up when the service is run from the repository.
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.batch import batch_results, read_batch_uploads, stream_zip  # noqa: E402
+from common.request_stats import RequestStats  # noqa: E402
 
 app = Flask(__name__)
 
+# Images of one /batch request are sketched in parallel (OpenCV releases the GIL).
+# /sketch runs its image in the same pool, so it can stop waiting at the deadline.
+BATCH_WORKERS = int(os.environ.get("BATCH_WORKERS", str(os.cpu_count() or 1)))
+batch_pool = ThreadPoolExecutor(max_workers=BATCH_WORKERS)
+# Seconds a request may take before the service gives up on it: /sketch answers 504,
+# and /batch reports the images still unfinished as errors. It is below the host's
+# 120 s socket timeout, so the host sees the failure and can fail over.
+REQUEST_TIMEOUT = float(os.environ.get("REQUEST_TIMEOUT", "60"))
+# Images submitted to batch_pool that no pool thread has picked up yet (reported as
+# "queued" on /stats).
+queued_images = 0
+_queued_lock = threading.Lock()
+
+
+def _dequeue():
+    global queued_images
+    with _queued_lock:
+        queued_images -= 1
+
+
+def submit_sketch(data, quality, fmt):
+    """
+    Submits one sketchify_bytes call to batch_pool and returns its future. The image
+    counts as queued until a pool thread starts it, or until it is cancelled before
+    that (a future that started cannot be cancelled).
+    """
+    global queued_images
+    with _queued_lock:
+        queued_images += 1
+
+    def run():
+        _dequeue()
+        return sketchify_bytes(data, quality, fmt)
+
+    future = batch_pool.submit(run)
+    future.add_done_callback(lambda done: done.cancelled() and _dequeue())
+    return future
+
+
+# ---- Request counters, served on GET /stats for the VM's monitor.py ----
+request_stats = RequestStats(queue_depth=lambda: queued_images)
+
+
+app.wsgi_app = request_stats.wrap(app.wsgi_app)
+
+
+@app.route('/health', methods=['GET'])
+def health():
+    """
+    Liveness probe for the host's health checker (see host-machine-files/health.py).
+    """
+    return jsonify({"status": "ok"})
+
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    """
+    Returns the request counters and recent latency percentiles (in ms) as JSON.
+    """
+    return jsonify(request_stats.snapshot())
+
+
+def requested_quality():
+    """
+    Returns the "quality" preset from the query string or form, or None if it is invalid.
+    """
+    quality = request.values.get('quality', DEFAULT_QUALITY)
+    return quality if quality in QUALITY_PRESETS else None
+
+
+def requested_format():
+    """
+    Returns the output "format" from the query string or form, or None if it is invalid.
+    """
+    fmt = request.values.get('format', DEFAULT_FORMAT)
+    return fmt if fmt in OUTPUT_FORMATS else None
+
+
 @app.route('/sketch', methods=['POST'])
 def generate_sketch():
+    """
+    Sketches the uploaded "image" in memory. Optional parameters (query string or
+    form field):
+      - "quality": denoising preset, "fast", "balanced" or "best" (default).
+      - "format": output encoding, "jpeg" (default), "png" or "webp".
+    """
     if 'image' not in request.files:
         return "No image uploaded", 400
+    quality = requested_quality()
+    if quality is None:
+        return f"quality must be one of {', '.join(QUALITY_PRESETS)}", 400
+    fmt = requested_format()
+    if fmt is None:
+        return f"format must be one of {', '.join(OUTPUT_FORMATS)}", 400
 
-    input_temp = tempfile.NamedTemporaryFile(suffix='.jpg', delete=False)
-    output_temp = tempfile.NamedTemporaryFile(suffix='.jpg', delete=False)
-
+    future = submit_sketch(request.files['image'].read(), quality, fmt)
     try:
-        request.files['image'].save(input_temp.name)
-
-        sketchify(input_temp.name, output_temp.name)
-
-        with open(output_temp.name, 'rb') as f:
-            img_bytes = io.BytesIO(f.read())
-        img_bytes.seek(0)
-
-        return send_file(
-            img_bytes,
-            mimetype='image/jpeg',
-            as_attachment=True,
-            download_name='result.jpg'
-        )
-    finally:
-        input_temp.close()
-        output_temp.close()
-        try:
-            os.remove(input_temp.name)
-            os.remove(output_temp.name)
-        except OSError:
-            pass
+        result = future.result(timeout=REQUEST_TIMEOUT)
+    except TimeoutError:
+        future.cancel()
+        return f"Timed out after {REQUEST_TIMEOUT:g}s", 504
+    except ValueError as e:
+        return str(e), 400
+    extension, mimetype = OUTPUT_FORMATS[fmt]
+
+    return send_file(
+        io.BytesIO(result),
+        mimetype=mimetype,
+        as_attachment=True,
+        download_name=f'result{extension}'
+    )
+
+
+@app.route('/batch', methods=['POST'])
+def generate_sketch_batch():
+    """
+    Sketches every image of the multipart "images" field in parallel and streams back a
+    ZIP archive with one entry per input, named after the input file. An input that
+    fails, or is not done within REQUEST_TIMEOUT, produces a "<name>.error.txt" entry
+    instead. Takes the same "quality" and "format" parameters as /sketch.
+    """
+    uploads = read_batch_uploads(default_extension=".jpg")
+    if not uploads:
+        return "No images uploaded", 400
+    quality = requested_quality()
+    if quality is None:
+        return f"quality must be one of {', '.join(QUALITY_PRESETS)}", 400
+    fmt = requested_format()
+    if fmt is None:
+        return f"format must be one of {', '.join(OUTPUT_FORMATS)}", 400
+
+    deadline = time.monotonic() + REQUEST_TIMEOUT
+    futures = {submit_sketch(data, quality, fmt): name for name, data in uploads}
+
+    return Response(stream_zip(batch_results(futures, deadline)), mimetype='application/zip',
+                    headers={"Content-Disposition": "attachment; filename=results.zip"})
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=8080, threaded=True)
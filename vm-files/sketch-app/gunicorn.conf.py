@@ -0,0 +1,33 @@
+import os
+import sys
+
+# Production server settings, read by `gunicorn app:app` (the Dockerfile's command).
+# `python app.py` still starts Flask's development server.
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.request_stats import create_stats_dir, remove_stats_dir, remove_worker_stats  # noqa: E402
+
+CORES = os.cpu_count() or 1
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8080')}"
+# One worker process per core, so concurrent requests do not share one interpreter.
+# Each worker still keeps one /batch thread per core (BATCH_WORKERS' default), so a
+# batch can use every idle core; when several workers are busy the OS shares them.
+workers = int(os.environ.get("WEB_CONCURRENCY", str(CORES)))
+# A few threads per worker, so a slow upload does not hold a whole worker.
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", "2"))
+# OpenCV and NumPy are imported once in the master and shared copy-on-write.
+preload_app = True
+# Seconds without a heartbeat before the master kills a frozen worker. A gthread
+# worker keeps heartbeating while one of its requests hangs, so requests have their
+# own deadline (REQUEST_TIMEOUT in app.py).
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "120"))
+graceful_timeout = 30
+# Recycle workers after this many requests (with jitter) to bound heap growth.
+max_requests = int(os.environ.get("GUNICORN_MAX_REQUESTS", "1000"))
+max_requests_jitter = max_requests // 10
+
+# Every worker publishes its request counters to STATS_DIR, so /stats covers all of them.
+create_stats_dir("sketch")
+child_exit = remove_worker_stats
+on_exit = remove_stats_dir